@@ -1,4 +1,9 @@
-from thermals.main import main
+import sys
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if sys.argv[1:2] == ["query"]:
+        # Answered from the archive without loading GTK
+        from thermals.query import main
+        sys.exit(main(sys.argv[2:]))
+    from thermals.main import main
+    main()
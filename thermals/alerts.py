@@ -0,0 +1,249 @@
+"""Alert rules evaluated on every historized sample.
+
+Rules are built per sensor on its first sample, from the driver's limits
+(`tempN_max`, `tempN_crit`, `fanN_min`, `*_alarm`) and the sensor's section
+in `thermals.ini`:
+
+    [coretemp.0:temp1]
+    alerts = True           ; set to False to disable all rules
+    alert_max = 85          ; overrides the driver's _max
+    alert_crit = 100        ; overrides the driver's _crit
+    alert_min = 300         ; overrides the driver's _min (fans)
+    alert_rate = 5          ; max change per second
+    alert_stuck = 300       ; seconds without any change
+    alert_hysteresis = 2    ; distance from the limit needed to clear
+    alert_debounce = 3      ; seconds a condition must hold to fire
+    alert_stall_pwm = 77    ; PWM (0-255) above which fanN must spin
+"""
+from time import monotonic_ns
+
+from gi.repository import Gio
+
+from thermals.utils import Unit
+
+DEFAULT_DEBOUNCE = 3
+# Seconds between reads of `*_alarm` attributes
+ALARM_INTERVAL = 5
+# PWM above which a fan is expected to spin, 30% duty. Many fans stop
+# below a start threshold (zero RPM modes), that's not a stall.
+DEFAULT_STALL_PWM = 77
+
+class Rule:
+    """Debounced condition on a sensor's samples.
+
+    `evaluate` returns True when the rule fires, False when it clears and
+    None otherwise. It fires when `condition` held for `debounce` seconds
+    and clears once `cleared` holds."""
+    severity = "warning"
+    active = False
+    since = None
+
+    def __init__(self, debounce=DEFAULT_DEBOUNCE):
+        self.debounce = debounce
+
+    def condition(self, value, t) -> bool:
+        raise NotImplementedError
+
+    def cleared(self, value, t) -> bool:
+        return not self.condition(value, t)
+
+    def describe(self, sensor) -> str:
+        raise NotImplementedError
+
+    def evaluate(self, value, t):
+        if not self.active:
+            if self.condition(value, t):
+                if self.since is None:
+                    self.since = t
+                if t - self.since >= self.debounce:
+                    self.active = True
+                    return True
+            else:
+                self.since = None
+        elif self.cleared(value, t):
+            self.active = False
+            self.since = None
+            return False
+
+class ThresholdRule(Rule):
+    def __init__(self, limit, above=True, hysteresis=0, severity="warning", **kw):
+        super().__init__(**kw)
+        self.limit = limit
+        self.above = above
+        self.hysteresis = hysteresis
+        self.severity = severity
+
+    def condition(self, value, t):
+        return value > self.limit if self.above else value < self.limit
+
+    def cleared(self, value, t):
+        if self.above:
+            return value < self.limit - self.hysteresis
+        return value > self.limit + self.hysteresis
+
+    def describe(self, sensor):
+        return "{} {}".format("above" if self.above else "below",
+                              Unit(sensor.unit).format_value(self.limit))
+
+class RateRule(Rule):
+    """Fires when the value changes faster than `rate` per second"""
+    def __init__(self, rate, **kw):
+        super().__init__(**kw)
+        self.rate = rate
+        self.previous = None
+
+    def condition(self, value, t):
+        previous, self.previous = self.previous, (value, t)
+        if previous is None or t <= previous[1]:
+            return False
+        return abs(value - previous[0]) / (t - previous[1]) > self.rate
+
+    def describe(self, sensor):
+        return "changing faster than {}/s".format(Unit(sensor.unit).format_value(self.rate))
+
+class StuckRule(Rule):
+    """Fires when the value didn't change for `seconds`"""
+    def __init__(self, seconds, **kw):
+        super().__init__(debounce=0)
+        self.seconds = seconds
+        self.value = None
+        self.changed = None
+
+    def condition(self, value, t):
+        if value != self.value:
+            self.value = value
+            self.changed = t
+        return t - self.changed >= self.seconds
+
+    def describe(self, sensor):
+        return "stuck at {} for {}s".format(Unit(sensor.unit).format_value(self.value), self.seconds)
+
+class FanStallRule(Rule):
+    """Fires when a fan is below `rpm` (or stopped, if None) while its PWM
+    output is above `start`"""
+    severity = "critical"
+
+    def __init__(self, pwm, rpm, start, **kw):
+        super().__init__(**kw)
+        self.pwm = pwm
+        self.rpm = rpm
+        self.start = start
+
+    def condition(self, value, t):
+        if self.pwm.value is None or self.pwm.value <= self.start:
+            return False
+        return value <= 0 if self.rpm is None else value < self.rpm
+
+    def describe(self, sensor):
+        return "stalled while {} is at {}".format(self.pwm.name, self.pwm.format_value())
+
+class AlarmRule(Rule):
+    """Follows the driver's `*_alarm` flag, read every `ALARM_INTERVAL` seconds"""
+    severity = "critical"
+
+    def __init__(self, sensor, **kw):
+        super().__init__(debounce=0)
+        self.sensor = sensor
+        self.read_at = None
+        self.state = False
+
+    def condition(self, value, t):
+        if self.read_at is None or t - self.read_at >= ALARM_INTERVAL:
+            self.read_at = t
+            self.state = bool(self.sensor.alarm())
+        return self.state
+
+    def describe(self, sensor):
+        return "driver alarm raised"
+
+def build_rules(sensor) -> list[Rule]:
+    cfg = sensor.config
+    if not cfg.getboolean('alerts', fallback=True):
+        return []
+    debounce = cfg.getfloat('alert_debounce', fallback=DEFAULT_DEBOUNCE)
+
+    def limit(attr):
+        value = cfg.getfloat('alert_' + attr, fallback=None)
+        if value is None:
+            value = sensor.limit(attr)
+        # Drivers report 0 for limits that aren't set
+        return value or None
+
+    rules = []
+    for (attr, above, severity) in (("max", True, "warning"),
+                                    ("crit", True, "critical"),
+                                    ("min", False, "warning")):
+        value = limit(attr)
+        if value is not None:
+            hysteresis = cfg.getfloat('alert_hysteresis', fallback=abs(value) * 0.02)
+            rules.append(ThresholdRule(value, above=above, hysteresis=hysteresis,
+                                       severity=severity, debounce=debounce))
+    rate = cfg.getfloat('alert_rate', fallback=None)
+    if rate:
+        rules.append(RateRule(rate, debounce=debounce))
+    stuck = cfg.getfloat('alert_stuck', fallback=None)
+    if stuck:
+        rules.append(StuckRule(stuck))
+    if sensor.alarm() is not None:
+        rules.append(AlarmRule(sensor))
+    if Unit(sensor.unit) == Unit.RPM and hasattr(sensor, 'device'):
+        # fanN is driven by pwmN by convention
+        pwm_name = "pwm" + sensor.measurement[3:]
+        for pwm in sensor.device.get_sensors(unit=Unit.PWM.value):
+            if pwm.measurement == pwm_name:
+                start = cfg.getfloat('alert_stall_pwm', fallback=DEFAULT_STALL_PWM)
+                rules.append(FanStallRule(pwm, limit("min"), start, debounce=debounce))
+    return rules
+
+class LogAction:
+    def __call__(self, sensor, rule, fired, message):
+        print("ALERT {}: {}".format("FIRED" if fired else "cleared", message))
+
+class NotifyAction:
+    """Desktop notifications through the `Gio.Application`"""
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, sensor, rule, fired, message):
+        notification_id = "alert-{}-{}".format(sensor.config.name, id(rule))
+        if not fired:
+            self.app.withdraw_notification(notification_id)
+            return
+        notification = Gio.Notification.new("{} {}".format(
+            "Critical:" if rule.severity == "critical" else "Warning:", sensor.name))
+        notification.set_body(message)
+        if rule.severity == "critical":
+            notification.set_priority(Gio.NotificationPriority.URGENT)
+        self.app.send_notification(notification_id, notification)
+
+class AlertEngine:
+    def __init__(self, app):
+        self.rules = {}
+        self.actions = [LogAction()]
+        if isinstance(app, Gio.Application):
+            self.actions.append(NotifyAction(app))
+
+    def has_rules(self, sensor) -> bool:
+        return bool(self.rules.get(sensor))
+
+    def evaluate(self, sensor):
+        """Evaluate the rules of `sensor` on its current value"""
+        rules = self.rules.get(sensor)
+        if rules is None:
+            rules = self.rules[sensor] = build_rules(sensor)
+        if not rules:
+            return
+        t = sensor.read_ns / 1000000000
+        for rule in rules:
+            fired = rule.evaluate(sensor.value, t)
+            if fired is not None:
+                self.dispatch(sensor, rule, fired)
+
+    def dispatch(self, sensor, rule, fired):
+        latency = (monotonic_ns() - sensor.read_ns) / 1000000
+        device = getattr(sensor, 'device', None)
+        message = "{}{} {} (now {}, latency {:.2f}ms)".format(
+            device.name + "/" if device else "", sensor.name, rule.describe(sensor),
+            sensor.format_value(), latency)
+        for action in self.actions:
+            action(sensor, rule, fired, message)
@@ -0,0 +1,218 @@
+"""Cross-correlation and lag analysis of historized sensors.
+
+Series are copied out of `History` on the main loop, then resampled onto a
+common time grid and correlated with NumPy in a worker thread. Results are
+handed back to the main loop with `GLib.idle_add`.
+"""
+import threading
+from math import isfinite
+
+from gi.repository import Gtk, GLib
+
+from thermals.utils import monotonic_s, time_it
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Largest lag searched, as a fraction of the window
+MAX_LAG_FRACTION = 0.25
+
+def pick_resolution(history, seconds):
+    """Finest resolution whose retention covers `seconds`"""
+    for res in history.resolutions:
+        if res * history.retention >= seconds:
+            return res
+    return history.resolutions[-1]
+
+def snapshot(history, sensors, seconds):
+    """Copy (times, values) of `sensors` over the last `seconds`"""
+    res = pick_resolution(history, seconds)
+    t_min = monotonic_s() - seconds
+    series = []
+    for sensor in sensors:
+        points = []
+        for m in history.sensors[sensor][res]:
+            if m.time_end < t_min:
+                continue
+            points.append((m.time, m.value))
+            if m.time_end != m.time:
+                # A run, flat until its end
+                points.append((m.time_end, m.value))
+        series.append(points)
+    return res, series
+
+def resample(series, step):
+    """Interpolate all series onto one grid covering their common range.
+    Returns (grid, matrix) with one row per series."""
+    arrays = [np.array(points, dtype=float).reshape(-1, 2) for points in series]
+    if any(len(a) < 2 for a in arrays):
+        return None, None
+    start = max(a[0, 0] for a in arrays)
+    end = min(a[-1, 0] for a in arrays)
+    if end - start < step * 2:
+        return None, None
+    grid = np.arange(start, end, step)
+    matrix = np.vstack([np.interp(grid, a[:, 0], a[:, 1]) for a in arrays])
+    return grid, matrix
+
+def standardize(matrix):
+    matrix = matrix - matrix.mean(axis=1, keepdims=True)
+    std = matrix.std(axis=1, keepdims=True)
+    std[std == 0] = 1
+    return matrix / std
+
+def cross_correlation(matrix, reference, max_lag):
+    """Correlation of every row with row `reference` at lags -max_lag..max_lag.
+
+    Computed with FFTs for all rows at once. A positive lag means the row
+    follows the reference."""
+    z = standardize(matrix)
+    n = z.shape[1]
+    size = 1 << (2 * n - 1).bit_length()
+    spectrum = np.fft.rfft(z, size, axis=1)
+    corr = np.fft.irfft(spectrum * np.conj(spectrum[reference]), size, axis=1) / n
+    # Reorder circular lags to -max_lag..max_lag
+    return np.concatenate([corr[:, size - max_lag:], corr[:, :max_lag + 1]], axis=1)
+
+class Result:
+    def __init__(self, sensors, step, points, matrix, reference, xcorr, max_lag):
+        self.sensors = sensors
+        self.step = step
+        self.matrix = matrix
+        self.reference = reference
+        self.points = points
+        best = np.abs(xcorr).argmax(axis=1)
+        self.lags = (best - max_lag) * step
+        self.lag_corr = xcorr[np.arange(len(sensors)), best]
+
+@time_it("Correlation analysis")
+def analyze(sensors, step, series, reference):
+    grid, matrix = resample(series, step)
+    if matrix is None:
+        return None
+    max_lag = max(1, int(matrix.shape[1] * MAX_LAG_FRACTION))
+    corr = np.corrcoef(matrix)
+    xcorr = cross_correlation(matrix, reference, max_lag)
+    return Result(sensors, step, len(grid), corr, reference, xcorr, max_lag)
+
+class AnalysisWindow(Gtk.ApplicationWindow):
+    def __init__(self, app, plots):
+        super().__init__(application=app, title="Correlation")
+        self.set_default_size(800, 700)
+        self.app = app
+        self.plots = plots
+        self.result = None
+        # Increased on every run, results of older runs are dropped
+        self.generation = 0
+        self.sensors = list(app.hwmon.get_sensors(plot=True))
+
+        self.reference = Gtk.DropDown.new_from_strings(
+            ["{}/{}".format(s.device.name, s.name) for s in self.sensors])
+        self.reference.connect('notify::selected', lambda *a: self.run())
+        self.window = Gtk.DropDown.new_from_strings([s for (s, _) in plots.timeSelections])
+        self.window.set_selected([sec for (_, sec) in plots.timeSelections].index(plots.plotSeconds))
+        self.window.connect('notify::selected', lambda *a: self.run())
+        self.status = Gtk.Label(xalign=0, hexpand=True)
+
+        top = Gtk.Box(spacing=10, margin_start=6, margin_end=6, margin_top=6, margin_bottom=6)
+        top.append(Gtk.Label(label="Reference:"))
+        top.append(self.reference)
+        top.append(Gtk.Label(label="Window:"))
+        top.append(self.window)
+        top.append(self.status)
+
+        self.lags = Gtk.Grid(column_spacing=12, row_spacing=4, margin_start=6, margin_end=6)
+        self.heatmap = Gtk.DrawingArea(hexpand=True, vexpand=True)
+        self.heatmap.set_draw_func(self.draw_matrix, None)
+        motion = Gtk.EventControllerMotion()
+        motion.connect('motion', self.on_motion)
+        self.heatmap.add_controller(motion)
+
+        pane = Gtk.Paned(orientation=Gtk.Orientation.VERTICAL)
+        pane.set_start_child(Gtk.ScrolledWindow(child=self.lags, min_content_height=150))
+        pane.set_end_child(self.heatmap)
+        box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
+        box.append(top)
+        box.append(pane)
+        self.set_child(box)
+        self.run()
+
+    def run(self):
+        if np is None:
+            self.status.set_text("NumPy is required for the analysis")
+            return
+        if len(self.sensors) < 2:
+            self.status.set_text("Plot at least two sensors to correlate them")
+            return
+        seconds = self.plots.timeSelections[self.window.get_selected()][1]
+        reference = self.reference.get_selected()
+        step, series = snapshot(self.app.history, self.sensors, seconds)
+        self.status.set_text("Analyzing…")
+        self.generation += 1
+        generation = self.generation
+
+        def work():
+            result = analyze(self.sensors, step, series, reference)
+            GLib.idle_add(self.show_result, result, generation)
+        threading.Thread(target=work, daemon=True).start()
+
+    def show_result(self, result, generation):
+        if generation != self.generation:
+            # The window or reference changed while analyzing
+            return GLib.SOURCE_REMOVE
+        self.result = result
+        if result is None:
+            self.status.set_text("Not enough overlapping history")
+            return GLib.SOURCE_REMOVE
+        self.status.set_text("{} sensors, {} points at {}s".format(
+            len(result.sensors), result.points, result.step))
+        while (child := self.lags.get_first_child()) is not None:
+            self.lags.remove(child)
+        for (col, title) in enumerate(["Sensor", "Lag", "Correlation at lag", "Correlation"]):
+            label = Gtk.Label(xalign=0)
+            label.set_markup("<b>{}</b>".format(title))
+            self.lags.attach(label, col, 0, 1, 1)
+        order = np.argsort(-np.abs(result.lag_corr))
+        for (row, i) in enumerate(order, start=1):
+            sensor = result.sensors[i]
+            cells = ["{}/{}".format(sensor.device.name, sensor.name),
+                     "{:+.0f}s".format(result.lags[i]),
+                     "{:+.2f}".format(result.lag_corr[i]),
+                     "{:+.2f}".format(result.matrix[result.reference, i])]
+            for (col, text) in enumerate(cells):
+                self.lags.attach(Gtk.Label(label=text, xalign=0), col, row, 1, 1)
+        self.heatmap.queue_draw()
+        return GLib.SOURCE_REMOVE
+
+    def draw_matrix(self, area, c, w, h, data):
+        c.set_source_rgb(0.5, 0.5, 0.5)
+        c.paint()
+        if self.result is None:
+            return
+        matrix = self.result.matrix
+        n = matrix.shape[0]
+        cw, ch = w / n, h / n
+        for i in range(n):
+            for j in range(n):
+                v = matrix[i, j]
+                if not isfinite(v):
+                    continue
+                # Blue for negative, red for positive correlation
+                if v >= 0:
+                    c.set_source_rgb(1, 1 - v, 1 - v)
+                else:
+                    c.set_source_rgb(1 + v, 1 + v, 1)
+                c.rectangle(j * cw, i * ch, cw + 0.5, ch + 0.5)
+                c.fill()
+
+    def on_motion(self, ctrl, x, y):
+        if self.result is None:
+            return
+        n = self.result.matrix.shape[0]
+        i = min(n - 1, int(y / self.heatmap.get_height() * n))
+        j = min(n - 1, int(x / self.heatmap.get_width() * n))
+        a, b = self.result.sensors[i], self.result.sensors[j]
+        self.heatmap.set_tooltip_text("{}/{} ~ {}/{}: {:+.2f}".format(
+            a.device.name, a.name, b.device.name, b.name, self.result.matrix[i, j]))
@@ -0,0 +1,201 @@
+"""On-disk archive of recorded sensor values, read by `thermals query`.
+
+Enabled in `thermals.ini`:
+
+    [archive]
+    enabled = True
+    # Record every sensor, not only those with `record = True`
+    all = False
+    keep_days = 30
+
+Values are appended to one chunk file per hour of wall time (UTC), named
+`YYYYMMDDTHH.N.chunk`. A chunk starts with a line of JSON describing its
+columns, followed by fixed size records of a little endian double (the
+time in seconds since the epoch) and one float per column, NaN when a
+sensor had no value. A new chunk is started every hour and whenever the
+recorded sensors change, so readers can skip chunks by name and seek
+within a chunk by bisecting its records.
+"""
+import json
+import math
+import mmap
+import os
+import os.path
+import re
+import struct
+from bisect import bisect_left
+from time import time, gmtime, strftime, strptime
+from calendar import timegm
+
+from gi.repository import GLib
+
+from thermals.utils import Unit
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+VERSION = 1
+HOUR = 3600
+# Seconds between flushes of the chunk file
+FLUSH_INTERVAL = 60
+CHUNK_NAME = re.compile(r"^(\d{8}T\d{2})\.(\d+)\.chunk$")
+
+def default_directory():
+    return os.path.join(GLib.get_user_data_dir(), "thermals", "archive")
+
+def directory_from_config(config):
+    return config['archive'].get('path', default_directory())
+
+def column(sensor):
+    return {
+        'key': "{}:{}".format(sensor.device.id, sensor.measurement),
+        'device': sensor.device.id,
+        'device_name': sensor.device.name,
+        'measurement': sensor.measurement,
+        'label': sensor.name,
+        'unit': Unit(sensor.unit).name,
+    }
+
+class ArchiveWriter:
+    def __init__(self, directory, record_all=False, keep_days=30):
+        self.directory = directory
+        self.record_all = record_all
+        self.keep_days = keep_days
+        self.fd = None
+        self.hour = None
+        self.columns = None
+        self.struct = None
+        self.flushed = 0
+        # sensor -> whether it is recorded, looked up once per sensor
+        self.selected = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def from_config(config):
+        section = config['archive']
+        if not section.getboolean('enabled', fallback=False):
+            return None
+        return ArchiveWriter(directory_from_config(config),
+                             record_all=section.getboolean('all', fallback=False),
+                             keep_days=section.getint('keep_days', fallback=30))
+
+    def records(self, sensor) -> bool:
+        recorded = self.selected.get(sensor)
+        if recorded is None:
+            recorded = self.selected[sensor] = self.record_all or \
+                sensor.config.getboolean('record', fallback=False)
+        return recorded
+
+    def record(self, sensors, now=None, fresh=None):
+        """Append the current values of the recorded `sensors`. Sensors not
+        in `fresh` (if given) weren't read again and are recorded as NaN."""
+        now = time() if now is None else now
+        columns = [s for s in sensors if self.records(s)]
+        if not columns:
+            return
+        if fresh is not None:
+            fresh = set(fresh)
+            if not any(s in fresh for s in columns):
+                return
+        hour = now - now % HOUR
+        if hour != self.hour or columns != self.columns:
+            self.open(hour, columns)
+        self.fd.write(self.struct.pack(now, *[
+            math.nan if s.value is None or (fresh is not None and s not in fresh) else s.value
+            for s in columns]))
+        if now - self.flushed >= FLUSH_INTERVAL:
+            self.fd.flush()
+            self.flushed = now
+
+    def open(self, hour, columns):
+        self.close()
+        if hour != self.hour:
+            self.prune(hour)
+        name = strftime("%Y%m%dT%H", gmtime(hour))
+        n = 0
+        while os.path.exists(os.path.join(self.directory, "{}.{}.chunk".format(name, n))):
+            n += 1
+        header = {'version': VERSION, 'hour': hour, 'columns': [column(s) for s in columns]}
+        self.fd = open(os.path.join(self.directory, "{}.{}.chunk".format(name, n)), 'wb')
+        self.fd.write(json.dumps(header).encode('utf-8') + b"\n")
+        self.hour = hour
+        self.columns = columns
+        self.struct = struct.Struct("<d{}f".format(len(columns)))
+
+    def prune(self, hour):
+        """Delete chunks older than `keep_days`"""
+        oldest = hour - self.keep_days * 24 * HOUR
+        for (chunk_hour, path) in list_chunks(self.directory):
+            if chunk_hour < oldest:
+                os.unlink(path)
+
+    def close(self):
+        if self.fd is not None:
+            self.fd.close()
+            self.fd = None
+
+def list_chunks(directory, start=None, end=None):
+    """(hour, path) of the chunks in `directory` overlapping [start, end),
+    ordered by time"""
+    found = []
+    for name in os.listdir(directory):
+        match = CHUNK_NAME.match(name)
+        if not match:
+            continue
+        hour = timegm(strptime(match.group(1), "%Y%m%dT%H"))
+        if start is not None and hour + HOUR <= start:
+            continue
+        if end is not None and hour >= end:
+            continue
+        found.append((hour, int(match.group(2)), os.path.join(directory, name)))
+    return [(hour, path) for (hour, _, path) in sorted(found)]
+
+class Chunk:
+    """Read access to one chunk file"""
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fd:
+            line = fd.readline()
+        self.header = json.loads(line)
+        self.columns = self.header['columns']
+        self.offset = len(line)
+        self.struct = struct.Struct("<d{}f".format(len(self.columns)))
+        # A record still being written is ignored
+        self.count = (os.path.getsize(path) - self.offset) // self.struct.size
+        self.mm = None
+        if self.count:
+            with open(path, 'rb') as fd:
+                self.mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return self.count
+
+    def time_at(self, i) -> float:
+        return struct.unpack_from("<d", self.mm, self.offset + i * self.struct.size)[0]
+
+    def search(self, t) -> int:
+        """Index of the first record at or after `t`"""
+        return bisect_left(range(self.count), t, key=self.time_at)
+
+    def rows(self, first, last):
+        """(time, values...) of records first..last-1"""
+        begin = self.offset + first * self.struct.size
+        end = self.offset + last * self.struct.size
+        return self.struct.iter_unpack(self.mm[begin:end])
+
+    def array(self, first, last):
+        """Records first..last-1 as a NumPy structured array of `time` and
+        `values`, mapped rather than read"""
+        dtype = np.dtype([('time', '<f8'), ('values', '<f4', (len(self.columns),))])
+        records = np.frombuffer(self.mm, dtype=dtype, count=self.count, offset=self.offset)
+        return records[first:last]
+
+    def close(self):
+        if self.mm is not None:
+            try:
+                self.mm.close()
+            except BufferError:
+                # Still referenced by an array, unmapped when it is freed
+                pass
+            self.mm = None
@@ -0,0 +1,335 @@
+"""Benchmarks for the sampling, history and drawing hot paths.
+
+Builds a synthetic hwmon tree, prefills `History` to full retention and
+times the hot paths. A fraction of the series is flat (`--flat`), which
+`History` stores as runs; the size of the history is reported too. Results
+are written as JSON so runs can be compared:
+
+    python -m thermals.bench --devices 8 --sensors 16 -o before.json
+    python -m thermals.bench --devices 8 --sensors 16 --compare before.json
+
+Drawing needs Gtk widgets, so a display is required (use `xvfb-run` or
+`GDK_BACKEND=broadway` on headless machines).
+"""
+import argparse
+import json
+import os
+import os.path
+import platform
+import random
+import resource
+import statistics
+import sys
+import tempfile
+from time import monotonic_ns
+
+import gi
+gi.require_version('Gtk', '4.0')
+gi.require_version('Adw', '1')
+from gi.repository import Gtk, GLib
+import cairo
+
+from thermals.config import Config
+from thermals.hwmon import Hwmon
+from thermals.sensorview import SensorView
+from thermals.history import History, Measurement
+from thermals.plots import Plots, PlotCanvas
+from thermals.memory import series_bytes, signal_handlers
+from thermals.utils import Unit, monotonic_s
+
+SIZES = [(400, 200), (1280, 720), (3840, 2160)]
+
+# (file suffix, value generator) per sensor kind
+SENSOR_KINDS = [
+    ("temp{}_input", lambda r: str(r.randint(30000, 90000))),
+    ("fan{}_input", lambda r: str(r.randint(500, 3000))),
+    ("pwm{}", lambda r: str(r.randint(0, 255))),
+    ("power{}_input", lambda r: str(r.randint(1000000, 200000000))),
+]
+
+class BenchConfig(Config):
+    def __init__(self, root):
+        self.root = root
+        super().__init__()
+        self['DEFAULT']['expanded'] = 'True'
+        self['DEFAULT']['color'] = "rgb(127, 127, 127)"
+        self['DEFAULT']['plot'] = 'True'
+    def filepath(self):
+        return os.path.join(self.root, "thermals.ini")
+    def write(self):
+        pass
+
+class BenchApp:
+    """Stands in for `Thermals` with the attributes the hot paths use."""
+    win = None
+
+    def __init__(self, root):
+        self.config = BenchConfig(root)
+        self.hwmon = Hwmon(self)
+        self.history = History(self)
+
+def build_tree(root, devices, sensors, seed=0):
+    """Create `devices` hwmon directories with `sensors` sensors each"""
+    rand = random.Random(seed)
+    hwmon_root = os.path.join(root, "hwmon")
+    for d in range(devices):
+        dev = os.path.join(root, "devices", "bench.{}".format(d))
+        dir = os.path.join(hwmon_root, "hwmon{}".format(d))
+        os.makedirs(dev)
+        os.makedirs(dir)
+        os.symlink(dev, os.path.join(dir, "device"))
+        with open(os.path.join(dir, "name"), 'w') as fd:
+            fd.write("bench{}\n".format(d))
+        for s in range(sensors):
+            suffix, gen = SENSOR_KINDS[s % len(SENSOR_KINDS)]
+            index = s // len(SENSOR_KINDS) + 1
+            with open(os.path.join(dir, suffix.format(index)), 'w') as fd:
+                fd.write(gen(rand) + "\n")
+            if suffix.startswith("power"):
+                # Power sensors are discovered through their label
+                with open(os.path.join(dir, "power{}_label".format(index)), 'w') as fd:
+                    fd.write("bench power {}\n".format(index))
+    return hwmon_root
+
+def prefill(history, sensors, flat=0.0, seed=0):
+    """Fill every resolution of `history` to full retention. A `flat`
+    fraction of the sensors keeps one value, like a fan pinned at a speed."""
+    rand = random.Random(seed)
+    now = monotonic_s()
+    for sensor in sensors:
+        base = sensor.value if sensor.value is not None else 50
+        noise = 0 if rand.random() < flat else 5
+        for res in history.resolutions:
+            dq = history.sensors[sensor][res]
+            dq.clear()
+            for i in range(history.retention, 0, -1):
+                ms = Measurement()
+                ms.time = ms.time_end = now - i * res
+                ms.value = base + rand.uniform(-noise, noise)
+                ms.sensor = sensor
+                # Like `historize_sensors`, so flat series become runs
+                history.append(dq, ms, res)
+
+def history_size(history):
+    series = [dq for tiers in history.sensors.values() for dq in tiers.values()]
+    return {
+        "entries": sum(len(dq) for dq in series),
+        "kb": sum(series_bytes(dq) for dq in series) // 1024,
+    }
+
+def measure(func, repeat, setup=None):
+    """Run `func` `repeat` times and return timing statistics in ms,
+    `setup` runs untimed before each"""
+    samples = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        ns0 = monotonic_ns()
+        func()
+        samples.append((monotonic_ns() - ns0) / 1000000)
+    samples.sort()
+    return {
+        "min": samples[0],
+        "median": statistics.median(samples),
+        "p95": samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        "max": samples[-1],
+        "repeat": repeat,
+    }
+
+def bench_draw(app, repeat):
+    results = {}
+    for unit in sorted({Unit(s.unit) for s in app.hwmon.get_sensors()}, key=lambda u: u.value):
+        canvas = PlotCanvas(unit, app.hwmon, app)
+        canvas.history = app.history
+        canvas.heatmapToggle.set_active(False)
+        for (window, seconds) in Plots.timeSelections:
+            canvas.plotSeconds = seconds
+            for (w, h) in SIZES:
+                surface = cairo.ImageSurface(cairo.FORMAT_RGB24, w, h)
+                ctx = cairo.Context(surface)
+                canvas._history_resolution = None
+                canvas.clear_min_max()
+                key = "{} {} {}x{}".format(unit.title(), window, w, h)
+                results[key] = measure(lambda: canvas.draw(None, ctx, w, h, None), repeat)
+    return results
+
+def bench_heatmap(app, repeat):
+    """Per tick update and drawing of the heatmap mode"""
+    results = {}
+    w, h = SIZES[1]
+    for unit in sorted({Unit(s.unit) for s in app.hwmon.get_sensors()}, key=lambda u: u.value):
+        canvas = PlotCanvas(unit, app.hwmon, app)
+        canvas.history = app.history
+        canvas.heatmapToggle.set_active(True)
+        for (window, seconds) in Plots.timeSelections:
+            canvas.plotSeconds = seconds
+            surface = cairo.ImageSurface(cairo.FORMAT_RGB24, w, h)
+            ctx = cairo.Context(surface)
+            canvas._history_resolution = None
+            canvas.clear_min_max()
+            # The first draw builds the image from history
+            canvas.draw(None, ctx, w, h, None)
+            results["{} {}".format(unit.title(), window)] = {
+                "update": measure(canvas.update_heatmap, repeat),
+                "draw": measure(lambda: canvas.draw(None, ctx, w, h, None), repeat),
+            }
+    return results
+
+def bench_hover(app, repeat, seed=0):
+    rand = random.Random(seed)
+    results = {}
+    for unit in sorted({Unit(s.unit) for s in app.hwmon.get_sensors()}, key=lambda u: u.value):
+        canvas = PlotCanvas(unit, app.hwmon, app)
+        canvas.history = app.history
+        canvas.heatmapToggle.set_active(False)
+        w, h = SIZES[1]
+        surface = cairo.ImageSurface(cairo.FORMAT_RGB24, w, h)
+        canvas.draw(None, cairo.Context(surface), w, h, None)
+        coords = [(rand.uniform(0, w), rand.uniform(0, h)) for _ in range(repeat)]
+        it = iter(coords)
+        results[unit.title()] = measure(
+            lambda: canvas.get_info_at_coord(*next(it), multiple=True), repeat)
+    return results
+
+def rss_kb() -> int:
+    with open("/proc/self/statm") as fd:
+        return int(fd.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+
+def bench_rebind(app, rounds):
+    """Rebind the rows of the largest device `rounds` times and check that
+    live bindings, signal handlers of a sensor and memory stay flat."""
+    device = max(app.hwmon.devices, key=lambda d: d.store.get_n_items())
+    view = SensorView(app, app.hwmon)
+    win = Gtk.Window(child=view, default_width=400, default_height=600)
+    win.present()
+    ctx = GLib.MainContext.default()
+    def pump():
+        while ctx.pending():
+            ctx.iteration(False)
+
+    sensors = list(device.store)
+    def rebind():
+        device.store.remove_all()
+        pump()
+        device.store.splice(0, 0, sensors)
+        pump()
+
+    def handlers():
+        counts = signal_handlers(sensors[:1])
+        return sum(counts.values()) if counts is not None else None
+
+    # Warm up so caches and recycled widgets exist before measuring
+    for _ in range(10):
+        rebind()
+    bindings0, handlers0, rss0 = len(view.bindings), handlers(), rss_kb()
+    timing = measure(rebind, rounds)
+    bindings1, handlers1, rss1 = len(view.bindings), handlers(), rss_kb()
+    win.destroy()
+    return {
+        "rows": len(sensors),
+        "rounds": rounds,
+        "rebind": timing,
+        "bindings_before": bindings0,
+        "bindings_after": bindings1,
+        "handlers_before": handlers0,
+        "handlers_after": handlers1,
+        "rss_growth_kb": rss1 - rss0,
+    }
+
+def run(devices, sensors, repeat, rebind_rounds, flat):
+    with tempfile.TemporaryDirectory(prefix="thermals-bench-") as root:
+        hwmon_root = build_tree(root, devices, sensors)
+        app = BenchApp(root)
+        ns0 = monotonic_ns()
+        app.hwmon.find_devices(hwmon_root)
+        discovery = (monotonic_ns() - ns0) / 1000000
+        sensor_list = list(app.hwmon.get_sensors())
+
+        def read_all():
+            # Read every sensor each time, however fast the reads follow
+            for sensor in sensor_list:
+                sensor.due_ns = 0
+            app.hwmon.refresh()
+
+        refresh = measure(read_all, repeat)
+        refresh["sensors_per_s"] = len(sensor_list) / (refresh["median"] / 1000) \
+            if refresh["median"] else None
+
+        prefill(app.history, sensor_list, flat)
+        size = history_size(app.history)
+        # Sensors not read again since are skipped, so read before each
+        historize = measure(app.history.historize_sensors, repeat, setup=read_all)
+
+        results = {
+            "params": {"devices": devices, "sensors": sensors, "repeat": repeat,
+                       "total_sensors": len(sensor_list),
+                       "retention": app.history.retention, "flat": flat},
+            "system": {"python": platform.python_version(), "machine": platform.machine()},
+            "discovery_ms": discovery,
+            "refresh": refresh,
+            "historize": historize,
+            "history": size,
+            "draw": bench_draw(app, repeat),
+            "heatmap": bench_heatmap(app, repeat),
+            "hover": bench_hover(app, repeat),
+            "rebind": bench_rebind(app, rebind_rounds),
+        }
+    # ru_maxrss is in kilobytes on Linux
+    results["peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return results
+
+def compare(old, new, prefix=""):
+    """Print median ratios new/old for every timing present in both"""
+    for key, value in new.items():
+        if key not in old:
+            continue
+        if isinstance(value, dict) and "median" in value:
+            if old[key]["median"]:
+                print("{}{}: {:.3f}ms -> {:.3f}ms ({:+.1f}%)".format(
+                    prefix, key, old[key]["median"], value["median"],
+                    (value["median"] / old[key]["median"] - 1) * 100))
+        elif key == "history":
+            for (name, n) in value.items():
+                if name in old[key] and old[key][name]:
+                    print("history / {}: {} -> {} ({:+.1f}%)".format(
+                        name, old[key][name], n, (n / old[key][name] - 1) * 100))
+        elif isinstance(value, dict) and key not in ("params", "system"):
+            compare(old[key], value, prefix + key + " / ")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m thermals.bench",
+                                     description="Benchmark Thermals hot paths")
+    parser.add_argument("--devices", type=int, default=4)
+    parser.add_argument("--sensors", type=int, default=16, help="sensors per device")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--rebind-rounds", type=int, default=1000,
+                        help="times every row of a device list is rebound")
+    parser.add_argument("--flat", type=float, default=0.0,
+                        help="fraction of sensors whose history is flat (default 0)")
+    parser.add_argument("-o", "--output", help="write JSON results to file instead of stdout")
+    parser.add_argument("--compare", help="JSON results of a previous run to compare against")
+    args = parser.parse_args(argv)
+    if args.compare:
+        with open(args.compare) as fd:
+            baseline = json.load(fd)
+        # Runs without --flat predate it and had no flat series
+        flat = baseline["params"].get("flat", 0.0)
+        if flat != args.flat:
+            parser.error("{} was run with --flat {}, not {}".format(args.compare, flat, args.flat))
+
+    results = run(args.devices, args.sensors, args.repeat, args.rebind_rounds, args.flat)
+    if args.output:
+        with open(args.output, 'w') as fd:
+            json.dump(results, fd, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        compare(baseline, results)
+    rebind = results["rebind"]
+    if rebind["handlers_before"] is not None and rebind["handlers_after"] > rebind["handlers_before"]:
+        sys.exit("Signal handlers of a sensor grew from {} to {} over {} rebinds".format(
+            rebind["handlers_before"], rebind["handlers_after"], rebind["rounds"]))
+
+if __name__ == "__main__":
+    main()
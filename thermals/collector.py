@@ -0,0 +1,480 @@
+"""Collector daemon sharing sampled history with any number of subscribers.
+
+The collector owns `Hwmon.refresh` and `History` and publishes every tick
+into a shared-memory ring, one ring per `History` resolution. Subscribers
+map the ring read-only and read it in place. The schema (which sensor is in
+which column) is announced as a JSON line over a Unix socket to every client
+on connect and again whenever it changes, together with the path of the
+ring file for that schema.
+
+Ring file layout (little endian):
+
+    header  magic, version, n_sensors, n_tiers, capacity, generation
+    tiers   n_tiers x (seq, count)   seqlock counter, rows appended so far
+    data    n_tiers x capacity rows of (time, value_0 .. value_n) doubles
+
+A row is updated in place while a tier's bucket is open (values are
+averaged like `Measurement.avg`) and a new row is started when the bucket
+closes. Writers make `seq` odd while touching a tier; readers copy the
+count and rows and retry when `seq` was odd or changed meanwhile. A `seq`
+staying odd means the collector died while writing, subscribers then fall
+back to sampling themselves.
+
+Run with `python -m thermals.collector`. Run as root, the collector listens
+on `SYSTEM_SOCKET`, which subscribers of every user try first. Otherwise it
+listens in the user's runtime directory, which other users can't reach;
+set the same `[collector] socket` for the collector and all users then.
+"""
+import json
+import math
+import mmap
+import os
+import os.path
+import socket
+import struct
+import sys
+import time
+from collections import deque
+
+from gi.repository import GLib
+
+from thermals.config import Config
+from thermals.hwmon import Hwmon
+from thermals.history import History
+from thermals.topology import TopologyCache
+from thermals.stats import Statistics
+from thermals.utils import monotonic_s, time_it
+
+MAGIC = b"THERMALS"
+VERSION = 1
+HEADER = struct.Struct("<8sIIIIQ")
+TIER = struct.Struct("<QQ")
+# Seconds a reader waits for a writer to leave a tier before taking the
+# collector as lost, it died while writing
+LOST_AFTER = 0.5
+# Rows copied per consistent read while iterating a `RingSeries`
+CHUNK = 64
+
+# Socket of a collector shared by all users
+SYSTEM_SOCKET = "/run/thermals/collector.sock"
+
+class RingLost(Exception):
+    """The collector stopped inside a write"""
+
+def socket_path(config=None) -> str:
+    if config is not None and config.has_option('collector', 'socket'):
+        return config.get('collector', 'socket')
+    if os.geteuid() == 0 or os.path.exists(SYSTEM_SOCKET):
+        return SYSTEM_SOCKET
+    return os.path.join(GLib.get_user_runtime_dir(), "thermals", "collector.sock")
+
+def sensor_key(sensor) -> str:
+    return "{}:{}".format(sensor.device.id, sensor.measurement)
+
+class Ring:
+    """Shared-memory ring file, opened for writing or read-only"""
+    def __init__(self, path, writable=False, n_sensors=0, resolutions=(), capacity=0, generation=0):
+        self.path = path
+        if writable:
+            self.n_sensors = n_sensors
+            self.n_tiers = len(resolutions)
+            self.capacity = capacity
+            size = self.data_offset() + 8 * self.n_tiers * capacity * (1 + n_sensors)
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                os.ftruncate(fd, size)
+                self.mm = mmap.mmap(fd, size)
+            finally:
+                os.close(fd)
+            HEADER.pack_into(self.mm, 0, MAGIC, VERSION, n_sensors, self.n_tiers, capacity, generation)
+        else:
+            with open(path, 'rb') as fd:
+                self.mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, version, self.n_sensors, self.n_tiers, self.capacity, generation = \
+                HEADER.unpack_from(self.mm, 0)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError("{} is not a thermals ring".format(path))
+        self.generation = generation
+        self.stride = 1 + self.n_sensors
+        self.tiers = memoryview(self.mm)[HEADER.size:self.data_offset()].cast('Q')
+        self.data = memoryview(self.mm)[self.data_offset():].cast('d')
+
+    def data_offset(self) -> int:
+        return HEADER.size + TIER.size * self.n_tiers
+
+    def row_base(self, tier, row) -> int:
+        return (tier * self.capacity + row % self.capacity) * self.stride
+
+    def read(self, tier, copy):
+        """`copy(count)` of a consistent state of `tier`, retried while the
+        writer is inside it. Raises `RingLost` after `LOST_AFTER` seconds."""
+        deadline = None
+        while True:
+            seq = self.tiers[tier * 2]
+            if not seq & 1:
+                result = copy(self.tiers[tier * 2 + 1])
+                if seq == self.tiers[tier * 2]:
+                    return result
+            if deadline is None:
+                deadline = time.monotonic() + LOST_AFTER
+            elif time.monotonic() > deadline:
+                raise RingLost(self.path)
+            time.sleep(0)
+
+    def count(self, tier) -> int:
+        """Rows appended to `tier`, read under the seqlock"""
+        return self.read(tier, lambda count: count)
+
+    def close(self):
+        self.tiers.release()
+        self.data.release()
+        self.mm.close()
+
+class RingWriter:
+    """Publishes samples of `sensors` into a new `Ring` at `path`"""
+    def __init__(self, path, sensors, resolutions, capacity, generation):
+        self.sensors = sensors
+        self.resolutions = resolutions
+        self.ring = Ring(path, writable=True, n_sensors=len(sensors),
+                         resolutions=resolutions, capacity=capacity, generation=generation)
+        # Number of samples averaged into the open row, per tier and sensor
+        self.counts = [[0] * len(sensors) for _ in resolutions]
+
+    def publish(self, time):
+        ring = self.ring
+        for (tier, res) in enumerate(self.resolutions):
+            seq = ring.tiers[tier * 2]
+            count = ring.tiers[tier * 2 + 1]
+            ring.tiers[tier * 2] = seq + 1
+            # Same bucketing as `History.historize_sensors`
+            if count < 2 or time - ring.data[ring.row_base(tier, count - 2)] > res:
+                base = ring.row_base(tier, count)
+                ring.data[base] = time
+                for (i, sensor) in enumerate(self.sensors):
+                    ring.data[base + 1 + i] = math.nan if sensor.value is None else sensor.value
+                    self.counts[tier][i] = 0 if sensor.value is None else 1
+                ring.tiers[tier * 2 + 1] = count + 1
+            else:
+                base = ring.row_base(tier, count - 1)
+                counts = self.counts[tier]
+                for (i, sensor) in enumerate(self.sensors):
+                    if sensor.value is None:
+                        continue
+                    if counts[i] == 0:
+                        ring.data[base + 1 + i] = sensor.value
+                    else:
+                        ring.data[base + 1 + i] = \
+                            (ring.data[base + 1 + i] * counts[i] + sensor.value) / (counts[i] + 1)
+                    counts[i] += 1
+            ring.tiers[tier * 2] = seq + 2
+
+    def close(self):
+        self.ring.close()
+        try:
+            os.unlink(self.ring.path)
+        except FileNotFoundError:
+            pass
+
+class Collector:
+    def __init__(self, config, path=None):
+        self.config = config
+        self.win = None
+        self.path = path or socket_path(config)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        self.hwmon = Hwmon(self)
+        self.hwmon.find_devices(cache=TopologyCache().load())
+        self.history = History(self)
+
+        self.generation = 0
+        self.writer = None
+        self.schema = None
+        self.clients = []
+
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.path)
+        os.chmod(self.path, 0o666)
+        self.server.listen()
+        self.server.setblocking(False)
+        GLib.io_add_watch(self.server.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_IN, self.on_accept)
+
+    def update_schema(self):
+        """Start a new ring when the set of sensors changed"""
+        sensors = list(self.hwmon.get_sensors())
+        keys = [sensor_key(s) for s in sensors]
+        # Compare identity, re-probed devices have new sensor objects
+        if self.writer is not None and sensors == self.writer.sensors:
+            return
+        if self.writer:
+            self.writer.close()
+        self.generation += 1
+        ring_path = "{}.{}.ring".format(self.path, self.generation)
+        self.writer = RingWriter(ring_path, sensors, self.history.resolutions,
+                                 self.history.retention, self.generation)
+        self.schema = {
+            'generation': self.generation,
+            'ring': ring_path,
+            'resolutions': self.history.resolutions,
+            'capacity': self.history.retention,
+            'sensors': keys,
+        }
+        print("Publishing {} sensors to {}".format(len(keys), ring_path))
+        for client in list(self.clients):
+            self.send_schema(client)
+
+    def send_schema(self, client):
+        try:
+            client.sendall(json.dumps(self.schema).encode('utf-8') + b"\n")
+        except OSError:
+            self.clients.remove(client)
+            client.close()
+
+    def on_accept(self, *args):
+        client, _ = self.server.accept()
+        self.clients.append(client)
+        if self.schema is not None:
+            self.send_schema(client)
+        GLib.io_add_watch(client.fileno(), GLib.PRIORITY_DEFAULT,
+                          GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR,
+                          lambda *a: self.on_client_event(client))
+        return True
+
+    def on_client_event(self, client):
+        # Subscribers never send anything, readable means closed
+        try:
+            data = client.recv(4096)
+        except OSError:
+            data = b""
+        if data:
+            return True
+        if client in self.clients:
+            self.clients.remove(client)
+        client.close()
+        return False
+
+    @time_it("Collector tick")
+    def on_timer(self):
+        self.hwmon.refresh()
+        self.history.historize_sensors()
+        self.update_schema()
+        self.writer.publish(monotonic_s())
+        return True
+
+    def run(self, interval=1000):
+        self.on_timer()
+        GLib.timeout_add(interval, self.on_timer)
+        loop = GLib.MainLoop()
+        try:
+            loop.run()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.history.close()
+            self.writer.close()
+            self.server.close()
+            os.unlink(self.path)
+
+class Sample:
+    __slots__ = ('time', 'value')
+
+    def __init__(self, time, value):
+        self.time = time
+        self.value = value
+
+    @property
+    def time_end(self):
+        # Rings store every row, there are no runs
+        return self.time
+
+class RingSeries:
+    """Sequence over one sensor's column in one tier of a `Ring`.
+
+    Reads the mapped memory directly. Rows without a value are skipped
+    when iterating."""
+    def __init__(self, ring, tier, column):
+        self.ring = ring
+        self.tier = tier
+        self.column = column
+
+    def __len__(self):
+        return min(self.ring.count(self.tier), self.ring.capacity)
+
+    def _copy(self, rows, count):
+        """Samples of `rows` still in the ring when it had `count` rows"""
+        ring = self.ring
+        data = ring.data
+        samples = []
+        for row in rows:
+            if not count - ring.capacity <= row < count:
+                continue
+            base = ring.row_base(self.tier, row)
+            value = data[base + 1 + self.column]
+            if value == value: # not NaN
+                samples.append(Sample(data[base], value))
+        return samples
+
+    def _rows(self, indices):
+        # Copied a chunk at a time under the seqlock, rows being rewritten
+        # (the open bucket, or wrapping) are never read torn
+        for i in range(0, len(indices), CHUNK):
+            part = indices[i:i + CHUNK]
+            yield from self.ring.read(self.tier, lambda count: self._copy(part, count))
+
+    def __iter__(self):
+        count = self.ring.count(self.tier)
+        return self._rows(range(max(0, count - self.ring.capacity), count))
+
+    def __reversed__(self):
+        count = self.ring.count(self.tier)
+        return self._rows(range(count - 1, max(0, count - self.ring.capacity) - 1, -1))
+
+    def __getitem__(self, index):
+        def copy(count):
+            n = min(count, self.ring.capacity)
+            i = index + n if index < 0 else index
+            if not 0 <= i < n:
+                raise IndexError(index)
+            base = self.ring.row_base(self.tier, count - n + i)
+            return Sample(self.ring.data[base], self.ring.data[base + 1 + self.column])
+        return self.ring.read(self.tier, copy)
+
+class SharedHistory:
+    """Read-only `History` backed by a collector's `Ring`"""
+    def __init__(self, schema):
+        self.resolutions = schema['resolutions']
+        self.retention = schema['capacity']
+        self.ring = Ring(schema['ring'])
+        self.columns = {key: i for (i, key) in enumerate(schema['sensors'])}
+        self.sensors = SharedSensors(self)
+        # Kept by the subscriber from the samples it reads
+        self.stats = Statistics()
+        # Triggers run in the subscriber, see `thermals.trigger`
+        self.captures = deque([], History.captures_retention)
+
+    def close(self):
+        self.ring.close()
+
+class SharedSensors:
+    """Maps `Sensor` -> {resolution: RingSeries}, like `History.sensors`"""
+    def __init__(self, history):
+        self.history = history
+        self.cache = {}
+
+    def __getitem__(self, sensor):
+        if sensor not in self.cache:
+            column = self.history.columns.get(sensor_key(sensor))
+            if column is None:
+                self.cache[sensor] = {res: [] for res in self.history.resolutions}
+            else:
+                self.cache[sensor] = {res: RingSeries(self.history.ring, tier, column)
+                                      for (tier, res) in enumerate(self.history.resolutions)}
+        return self.cache[sensor]
+
+    def __contains__(self, sensor):
+        return sensor_key(sensor) in self.history.columns
+
+class Subscriber:
+    """Connection to a running collector.
+
+    `on_schema` is called with the new `SharedHistory` whenever the
+    collector announces a schema, `on_lost` when the collector goes away."""
+    def __init__(self, sock, on_schema, on_lost):
+        self.sock = sock
+        self.on_schema = on_schema
+        self.on_lost = on_lost
+        self.buffer = b""
+        self.history = None
+        self.watch = GLib.io_add_watch(sock.fileno(), GLib.PRIORITY_DEFAULT,
+                                       GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR, self.on_event)
+
+    def connect(path, on_schema, on_lost):
+        """Return a `Subscriber`, or None if no collector is running"""
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+        except OSError:
+            sock.close()
+            return None
+        subscriber = Subscriber(sock, on_schema, on_lost)
+        # Wait for the first schema so the caller starts with history
+        sock.settimeout(2)
+        try:
+            while subscriber.history is None:
+                if not subscriber.read():
+                    subscriber.close()
+                    return None
+        except OSError:
+            subscriber.close()
+            return None
+        sock.setblocking(False)
+        return subscriber
+
+    def read(self) -> bool:
+        data = self.sock.recv(65536)
+        if not data:
+            return False
+        self.buffer += data
+        while b"\n" in self.buffer:
+            line, self.buffer = self.buffer.split(b"\n", 1)
+            schema = json.loads(line)
+            if self.history:
+                self.history.close()
+            self.history = SharedHistory(schema)
+            print("Subscribed to collector ring {}".format(schema['ring']))
+            self.on_schema(self.history)
+        return True
+
+    def on_event(self, *args):
+        try:
+            if self.read():
+                return True
+        except BlockingIOError:
+            return True
+        except OSError:
+            pass
+        print("Collector went away")
+        self.watch = None
+        self.close()
+        self.on_lost()
+        return False
+
+    def update_sensors(self, sensors):
+        """Set the latest values of `sensors` from the ring"""
+        try:
+            self.read_sensors(sensors)
+        except RingLost:
+            print("Collector stopped while writing")
+            self.close()
+            self.on_lost()
+
+    def read_sensors(self, sensors):
+        history = self.history
+        for sensor in sensors:
+            if sensor not in history.sensors:
+                continue
+            series = history.sensors[sensor][history.resolutions[0]]
+            if len(series):
+                sample = series[-1]
+                if sample.time == sensor.time:
+                    continue
+                sensor.time = int(sample.time)
+                sensor.value = sample.value if sample.value == sample.value else None
+                if sensor.value is not None:
+                    history.stats.add(sensor)
+
+    def close(self):
+        if self.watch is not None:
+            GLib.source_remove(self.watch)
+            self.watch = None
+        self.sock.close()
+
+def main():
+    config = Config()
+    config.read()
+    path = sys.argv[sys.argv.index("--socket") + 1] if "--socket" in sys.argv else None
+    Collector(config, path).run()
+
+if __name__ == "__main__":
+    main()
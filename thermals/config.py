@@ -0,0 +1,27 @@
+import os, os.path
+import configparser
+
+from gi.repository import GLib
+
+class Config(configparser.ConfigParser):
+    def __init__(self, *args, **kw):
+        super().__init__(*args, **kw)
+        os.makedirs(os.path.dirname(self.filepath()), exist_ok=True)
+    def filepath(self):
+        return os.path.join(GLib.get_user_config_dir(), "thermals", "thermals.ini")
+    def read(self):
+        super().read(self.filepath())
+        self['DEFAULT']['expanded'] = 'True'
+        self['DEFAULT']['color'] = "rgb(127, 127, 127)"
+        self['DEFAULT']['plot'] = 'True'
+    def write(self):
+        with open(self.filepath(), 'w') as configfile:
+            super().write(configfile)
+    def __getitem__(self, section):
+        if not self.has_section(section) and \
+           not section == "DEFAULT":
+            self.add_section(section)
+        section = super().__getitem__(section)
+        # Monkeypatch a write method
+        section.write = self.write
+        return section
@@ -10,6 +10,8 @@ import os
 from itertools import takewhile, dropwhile, count
 from thermals.utils import Unit, readlineStrip
 from thermals.sensor import Sensor
+from thermals.frametime import monitor
+from thermals.simulate import SimulationPanel
 import subprocess
 
 class Curve(Gtk.DrawingArea):
@@ -43,7 +45,7 @@ class Curve(Gtk.DrawingArea):
         self.y_unit = y_unit
         self.x_unit = x_unit
 
-        self.set_draw_func(self.draw, None)
+        monitor.instrument(self, self.draw, "Curve", lambda: len(self.data) + 2)
 
         ctrl = Gtk.EventControllerMotion()
         ctrl.connect('motion', self.on_motion)
@@ -254,6 +256,10 @@ class CurveHwmonWindow(Gtk.ApplicationWindow):
         applyBtn.set_halign(Gtk.Align.END)
         applyBtn.connect('clicked', self.on_apply)
 
+        simulateBtn = Gtk.ToggleButton.new_with_label("Simulate")
+        simulateBtn.set_tooltip_text("Replay recorded temperatures through the curve")
+        simulateBtn.connect('toggled', self.on_simulate)
+
         restoreBtn = Gtk.Button.new_with_label("Restore")
         restoreBtn.set_halign(Gtk.Align.END)
         restoreBtn.connect('clicked', self.restore_original_data)
@@ -262,9 +268,19 @@ class CurveHwmonWindow(Gtk.ApplicationWindow):
                         #  margin_bottom=10, margin_top=10, margin_start=10, margin_end=10)
         self.box.append(self.curve)
 
+        self.simulation = None
+        if application is not None:
+            self.simulation = SimulationPanel(application, sensor, self.curve)
+            self.simulation.set_visible(False)
+            self.box.append(self.simulation)
+            # After `Curve`'s own handler moved the point
+            self.curve.drag.connect_after('drag-update', lambda *a: self.update_simulation())
+        simulateBtn.set_sensitive(self.simulation is not None)
+
         bottomBox = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=10)
         bottomBox.append(Gtk.Label(label="Monitor temperature:"))
         bottomBox.append(self.tempSelect)
+        bottomBox.append(simulateBtn)
         restoreBtn.set_hexpand(True)
         bottomBox.append(restoreBtn)
         bottomBox.append(applyBtn)
@@ -331,6 +347,7 @@ class CurveHwmonWindow(Gtk.ApplicationWindow):
             return
         self.curve.data = self._original_data.copy()
         self.curve.queue_draw()
+        self.update_simulation()
         if self._original_temp_selected_index:
             self.tempSelect.set_selected(self._original_temp_selected_index)
     
@@ -339,7 +356,19 @@ class CurveHwmonWindow(Gtk.ApplicationWindow):
         print("tempSel dropdown selected {}".format(dropdown.get_selected_item().measurement))
         hwmon_index = int(item.measurement[4:])
         self.tempSelected = hwmon_index
+        if self.simulation is not None and self.simulation.get_visible():
+            self.simulation.set_temp(item)
+
+    def on_simulate(self, button):
+        self.simulation.set_visible(button.get_active())
+        if button.get_active():
+            self.simulation.set_temp(self.tempSelect.get_selected_item())
+
+    def update_simulation(self):
+        if self.simulation is not None and self.simulation.get_visible():
+            self.simulation.update()
     
     def on_apply(self, _):
         self.write_hwmon()
         self.restore_hwmon()
+        self.update_simulation()
@@ -0,0 +1,182 @@
+"""Energy accounting from the energy counters of hwmon devices.
+
+`Energy` sensors read `energyN_input`, a counter of microjoules, and keep a
+`Counter` of it. The difference of two reads is exact however long apart
+they were, so the power shown is the true average since the previous read
+and reading once a second (or less often in the background) loses nothing
+that polling `powerN_input` quickly would catch. A counter going backwards
+has wrapped at its range, 2^64 µJ unless the sensor's section says
+otherwise:
+
+    [amd_energy.0:energy1]
+    counter_range = 4294967296     ; µJ at which the counter wraps
+
+`History.energy` adds up the joules of every interval into hours and days
+of wall time, shown in the title of the power plot and exported as
+`thermals_energy_joules_total`.
+"""
+from collections import deque
+from time import time, localtime, mktime
+
+# µJ at which hwmon counters wrap, they are unsigned 64 bit
+DEFAULT_RANGE = 2 ** 64
+# Power above this after wrapping means the counter was reset (e.g. the
+# driver was reloaded), the interval is dropped
+MAX_WATTS = 10000
+HOUR = 3600
+# Hours and days of totals kept
+HOURS = 48
+DAYS = 31
+# Seconds between the checkpoints `Account.watts` interpolates between
+CHECKPOINT = 60
+CHECKPOINTS = 24 * HOUR // CHECKPOINT
+
+def counter_range(config) -> int:
+    try:
+        return int(config.get('counter_range', DEFAULT_RANGE))
+    except ValueError:
+        return DEFAULT_RANGE
+
+class Counter:
+    """Integrates reads of a wrapping counter of microjoules"""
+    def __init__(self, range=DEFAULT_RANGE):
+        self.range = range
+        self.previous = None
+        self.previous_ns = None
+        # Joules and nanoseconds of the last interval, None after the first
+        # read and after resets
+        self.joules = None
+        self.interval_ns = None
+        # Joules since the first read
+        self.total = 0.0
+        self.wraps = 0
+
+    def add(self, uj, ns):
+        """Add a read of `uj` at `monotonic_ns` `ns`, returns the average
+        Watts since the previous read or None"""
+        previous, previous_ns = self.previous, self.previous_ns
+        self.previous, self.previous_ns = uj, ns
+        self.joules = self.interval_ns = None
+        if previous is None or ns <= previous_ns:
+            return None
+        delta = uj - previous
+        wrapped = delta < 0
+        if wrapped:
+            delta += self.range
+        seconds = (ns - previous_ns) / 1000000000
+        if delta < 0 or delta / 1000000 / seconds > MAX_WATTS:
+            print("Energy counter reset from {} to {} µJ".format(previous, uj))
+            return None
+        self.wraps += wrapped
+        self.joules = delta / 1000000
+        self.interval_ns = ns - previous_ns
+        self.total += self.joules
+        return self.joules / seconds
+
+def hour_start(t) -> float:
+    """Start of the local hour of wall time `t`, which isn't a multiple of
+    `HOUR` in time zones with half hour offsets"""
+    tm = localtime(t)
+    # The DST flag tells apart the hour repeated when DST ends
+    return mktime((tm.tm_year, tm.tm_mon, tm.tm_mday, tm.tm_hour, 0, 0, 0, 0, tm.tm_isdst))
+
+def day_start(t) -> float:
+    """Local midnight of the day of wall time `t`"""
+    tm = localtime(t)
+    return mktime((tm.tm_year, tm.tm_mon, tm.tm_mday, 0, 0, 0, 0, 0, -1))
+
+class Account:
+    """Energy of one sensor by hour and day, and checkpoints for windows"""
+    def __init__(self):
+        # (start in wall time, joules), oldest first
+        self.hours = deque([], HOURS)
+        self.days = deque([], DAYS)
+        # (monotonic_ns, total joules) every `CHECKPOINT` seconds
+        self.checkpoints = deque([], CHECKPOINTS)
+        self.total = 0.0
+        self.total_ns = None
+        # `read_ns` of the last interval added
+        self.read_ns = None
+
+    def add(self, joules, interval_ns, read_ns, now):
+        """Add the `joules` of the interval ending at `read_ns`, `now`
+        being the wall time of that"""
+        self.read_ns = read_ns
+        self.total += joules
+        self.total_ns = read_ns
+        if not self.checkpoints or \
+           read_ns - self.checkpoints[-1][0] >= CHECKPOINT * 1000000000:
+            self.checkpoints.append((read_ns, self.total))
+        start = now - interval_ns / 1000000000
+        self.spread(self.hours, joules, start, now, hour_start, HOUR)
+        # Days are 23 to 25 hours long around DST changes
+        self.spread(self.days, joules, start, now, day_start, 26 * HOUR)
+
+    def spread(self, buckets, joules, start, end, bucket_of, span):
+        """Add `joules` to the buckets of [start, end], in proportion to
+        the time in each. `bucket_of(bucket + span)` is the next bucket."""
+        t = start
+        while t < end:
+            bucket = bucket_of(t)
+            part_end = min(end, bucket_of(bucket + span))
+            share = joules * (part_end - t) / (end - start)
+            if not buckets or buckets[-1][0] < bucket:
+                buckets.append((bucket, 0.0))
+            if buckets[-1][0] == bucket:
+                buckets[-1] = (bucket, buckets[-1][1] + share)
+            t = part_end
+
+    def since(self, start, buckets) -> float:
+        """Joules of the buckets starting at or after `start`"""
+        return sum(j for (b, j) in buckets if b >= start)
+
+    def watts(self, seconds, now_ns) -> float | None:
+        """Average power over the last `seconds`, from the checkpoint at or
+        before their start"""
+        if self.total_ns is None:
+            return None
+        begin = now_ns - seconds * 1000000000
+        for (ns, total) in reversed(self.checkpoints):
+            if ns <= begin:
+                break
+        else:
+            if not self.checkpoints:
+                return None
+            (ns, total) = self.checkpoints[0]
+        if self.total_ns <= ns:
+            return None
+        return (self.total - total) / ((self.total_ns - ns) / 1000000000)
+
+class EnergyAccounting:
+    """`Account`s of the sensors with a `Counter`, kept by `History`"""
+    def __init__(self):
+        self.accounts = {}
+
+    def add(self, sensor, now=None):
+        counter = sensor.counter
+        if counter.joules is None:
+            return
+        account = self.accounts.get(sensor)
+        if account is None:
+            account = self.accounts[sensor] = Account()
+        if account.read_ns == counter.previous_ns:
+            # Not read again since, e.g. backing off
+            return
+        account.add(counter.joules, counter.interval_ns, counter.previous_ns,
+                    time() if now is None else now)
+
+    def watts(self, sensors, seconds, now_ns) -> float | None:
+        """Summed average power of `sensors` over the last `seconds`"""
+        averages = [self.accounts[s].watts(seconds, now_ns) for s in sensors if s in self.accounts]
+        averages = [w for w in averages if w is not None]
+        return sum(averages) if averages else None
+
+    def totals(self, sensors, now=None) -> tuple[float, float] | None:
+        """(Wh this hour, Wh today) of `sensors`, None if none has an account"""
+        now = time() if now is None else now
+        accounts = [self.accounts[s] for s in sensors if s in self.accounts]
+        if not accounts:
+            return None
+        hour = sum(a.since(hour_start(now), a.hours) for a in accounts)
+        day = sum(a.since(day_start(now), a.days) for a in accounts)
+        return (hour / HOUR, day / HOUR)
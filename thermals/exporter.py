@@ -0,0 +1,150 @@
+"""Prometheus/OpenMetrics endpoint serving the values of the last refresh.
+
+The values of every sampling tick are copied on the main loop into an
+immutable snapshot that is swapped in. Scrapes are answered from a server
+thread, which renders a snapshot on its first scrape and never touches
+sysfs, sensors or the GTK loop.
+"""
+import gzip
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from thermals.utils import Unit
+
+DEFAULT_ADDRESS = "127.0.0.1"
+DEFAULT_PORT = 9778
+
+PROMETHEUS_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+OPENMETRICS_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+# Unit -> (metric name, help text)
+METRICS = {
+    Unit.CELCIUS: ("thermals_temperature_celsius", "Temperature in degrees Celsius"),
+    Unit.RPM: ("thermals_fan_rpm", "Fan speed in revolutions per minute"),
+    Unit.PWM: ("thermals_pwm", "PWM duty cycle (0-255)"),
+    Unit.WATT: ("thermals_power_watts", "Power in Watts"),
+    Unit.MHZ: ("thermals_frequency_mhz", "Frequency in MHz"),
+    Unit.PERCENT: ("thermals_utilization_percent", "Utilization in percent"),
+}
+
+def escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def capture(sensors) -> list[tuple]:
+    """(unit, label values, value, joules) of `sensors`, copied on the main
+    loop so the server thread never touches a sensor"""
+    rows = []
+    for sensor in sensors:
+        device = sensor.device
+        counter = getattr(sensor, 'counter', None)
+        rows.append((Unit(sensor.unit),
+                     (device.id, device.name, device.hwmonInstance, sensor.measurement, sensor.name),
+                     sensor.value, counter.total if counter is not None else None))
+    return rows
+
+def format_labels(labels) -> str:
+    return 'device="{}",name="{}",hwmon="{}",sensor="{}",label="{}"'.format(
+        *(escape(value) for value in labels))
+
+def render(rows, openmetrics=False) -> bytes:
+    """Render the exposition text for `rows` from `capture`"""
+    by_unit = {}
+    for (unit, labels, value, _) in rows:
+        if value is None:
+            continue
+        by_unit.setdefault(unit, []).append((labels, value))
+
+    lines = []
+    for unit, unit_rows in sorted(by_unit.items(), key=lambda i: i[0].value):
+        metric, help = METRICS.get(unit) or ("thermals_" + unit.name.lower(), unit.title())
+        lines.append("# HELP {} {}".format(metric, help))
+        lines.append("# TYPE {} gauge".format(metric))
+        for (labels, value) in unit_rows:
+            lines.append('{}{{{}}} {}'.format(metric, format_labels(labels), repr(float(value))))
+    counted = [(labels, joules) for (_, labels, _, joules) in rows if joules is not None]
+    if counted:
+        # Joules since startup, integrated across counter wraps. OpenMetrics
+        # names the family without the `_total` of its samples.
+        metric = "thermals_energy_joules_total"
+        family = "thermals_energy_joules" if openmetrics else metric
+        lines.append("# HELP {} Energy in Joules since thermals started".format(family))
+        lines.append("# TYPE {} counter".format(family))
+        for (labels, joules) in counted:
+            lines.append('{}{{{}}} {}'.format(metric, format_labels(labels), repr(float(joules))))
+    if openmetrics:
+        lines.append("# EOF")
+    return ("\n".join(lines) + "\n").encode('utf-8')
+
+class Snapshot:
+    """Values of one refresh, never changed. Each response is rendered on
+    the first scrape asking for it and cached, nothing is rendered for
+    refreshes nobody scrapes."""
+    def __init__(self, sensors=()):
+        self.rows = capture(sensors)
+        # (openmetrics, gzip) -> body
+        self.responses = {}
+        self.lock = threading.Lock()
+
+    def response(self, openmetrics, gz) -> bytes:
+        with self.lock:
+            body = self.responses.get((openmetrics, gz))
+            if body is None:
+                body = self.responses.get((openmetrics, False))
+                if body is None:
+                    body = self.responses[(openmetrics, False)] = render(self.rows, openmetrics)
+                if gz:
+                    body = self.responses[(openmetrics, True)] = gzip.compress(body, compresslevel=1)
+            return body
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        # Grab the reference once; the exporter swaps it atomically
+        snapshot = self.server.snapshot
+        openmetrics = "application/openmetrics-text" in self.headers.get("Accept", "")
+        content_type = OPENMETRICS_TYPE if openmetrics else PROMETHEUS_TYPE
+        gz = "gzip" in self.headers.get("Accept-Encoding", "")
+        body = snapshot.response(openmetrics, gz)
+
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        if gz:
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class MetricsServer(ThreadingHTTPServer):
+    daemon_threads = True
+    snapshot = Snapshot()
+
+class Exporter:
+    def __init__(self, address=DEFAULT_ADDRESS, port=DEFAULT_PORT):
+        self.server = MetricsServer((address, port), MetricsHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       name="thermals-exporter", daemon=True)
+
+    @staticmethod
+    def from_config(config):
+        """Raises OSError if the address can't be bound"""
+        return Exporter(config.get('exporter', 'address', fallback=DEFAULT_ADDRESS),
+                        config.getint('exporter', 'port', fallback=DEFAULT_PORT))
+
+    def start(self):
+        self.thread.start()
+        print("Serving metrics on http://{}:{}/metrics".format(*self.server.server_address[:2]))
+
+    def update(self, sensors):
+        """Build a snapshot of `sensors` and publish it to scrapers"""
+        self.server.snapshot = Snapshot(sensors)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
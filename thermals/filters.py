@@ -0,0 +1,167 @@
+"""Per-sensor filter chains, applied to each value as it is read.
+
+Configured in the sensor's section of `thermals.ini`, applied in order:
+
+    [nct6775.656:fan2]
+    filter = outlier:4, median:5, ema:10
+
+- `ema:TAU` exponential moving average with a time constant of TAU seconds
+- `median:N` median of the last N values
+- `rate:MAX` change limited to MAX units per second
+- `outlier:K` values more than K standard deviations from the recent mean
+  are replaced by the previous output, until they persist
+
+Every filter keeps fixed-size state and costs O(1) per value (median-of-N
+sorts N values, N is fixed). `FilterChain.batch` runs a chain over an
+existing series, vectorized with NumPy where a filter allows it.
+"""
+import math
+from collections import deque
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+class Filter:
+    def apply(self, value, t):
+        raise NotImplementedError
+
+    def batch(self, values, times):
+        """Filter a whole series, starting from this filter's state"""
+        return [self.apply(v, t) for (v, t) in zip(values, times)]
+
+class Ema(Filter):
+    def __init__(self, tau):
+        if tau <= 0:
+            raise ValueError("ema needs a positive time constant")
+        self.tau = tau
+        self.value = None
+        self.t = None
+
+    def apply(self, value, t):
+        if self.value is None:
+            self.value, self.t = value, t
+            return value
+        # Weighted by the time since the last value, so irregular
+        # intervals (e.g. background sampling) are handled
+        alpha = 1 - math.exp(-max(t - self.t, 0) / self.tau)
+        self.value += alpha * (value - self.value)
+        self.t = t
+        return self.value
+
+class Median(Filter):
+    def __init__(self, n):
+        if n < 1:
+            raise ValueError("median needs at least one value")
+        self.window = deque([], int(n))
+
+    def apply(self, value, t):
+        self.window.append(value)
+        ordered = sorted(self.window)
+        mid = len(ordered) // 2
+        if len(ordered) % 2:
+            return ordered[mid]
+        return (ordered[mid - 1] + ordered[mid]) / 2
+
+    def batch(self, values, times):
+        n = self.window.maxlen
+        if np is None or self.window or len(values) <= n:
+            return super().batch(values, times)
+        # The first values see a growing window, like with `apply`
+        head = super().batch(values[:n - 1], times[:n - 1])
+        windows = np.lib.stride_tricks.sliding_window_view(np.asarray(values, dtype=float), n)
+        self.window.clear()
+        self.window.extend(values[-n:])
+        return head + np.median(windows, axis=1).tolist()
+
+class RateLimit(Filter):
+    def __init__(self, rate):
+        if rate <= 0:
+            raise ValueError("rate needs a positive limit")
+        self.rate = rate
+        self.value = None
+        self.t = None
+
+    def apply(self, value, t):
+        if self.value is not None:
+            step = self.rate * max(t - self.t, 0)
+            value = min(max(value, self.value - step), self.value + step)
+        self.value, self.t = value, t
+        return value
+
+class Outlier(Filter):
+    # Exponential weight of the running mean and variance
+    ALPHA = 0.1
+    # Values needed before anything is rejected
+    WARMUP = 10
+    # Consecutive rejections after which a value is taken as a new level
+    PERSIST = 5
+
+    def __init__(self, k):
+        if k <= 0:
+            raise ValueError("outlier needs a positive number of deviations")
+        self.k = k
+        self.n = 0
+        self.mean = 0.0
+        self.var = 0.0
+        self.rejected = 0
+        self.value = None
+
+    def apply(self, value, t):
+        if self.n >= self.WARMUP and self.rejected < self.PERSIST:
+            if abs(value - self.mean) > self.k * math.sqrt(self.var) + 1e-9:
+                self.rejected += 1
+                return self.value
+        self.rejected = 0
+        self.n += 1
+        if self.n == 1:
+            self.mean = value
+        else:
+            delta = value - self.mean
+            self.mean += self.ALPHA * delta
+            self.var = (1 - self.ALPHA) * (self.var + self.ALPHA * delta * delta)
+        self.value = value
+        return value
+
+FILTERS = {
+    'ema': Ema,
+    'median': Median,
+    'rate': RateLimit,
+    'outlier': Outlier,
+}
+
+class FilterChain:
+    def __init__(self, spec, filters):
+        self.spec = spec
+        self.filters = filters
+
+    def apply(self, value, t):
+        for f in self.filters:
+            value = f.apply(value, t)
+        return value
+
+    def batch(self, values, times):
+        for f in self.filters:
+            values = f.batch(values, times)
+        return values
+
+def parse_chain(spec):
+    """FilterChain for `spec` like "median:5, ema:10", None if empty.
+    Raises ValueError for invalid specs."""
+    if not spec or not spec.strip():
+        return None
+    filters = []
+    for item in spec.split(","):
+        name, _, arg = item.strip().partition(":")
+        if name not in FILTERS:
+            raise ValueError("Unknown filter {!r}".format(name))
+        try:
+            filters.append(FILTERS[name](float(arg)))
+        except ValueError as e:
+            raise ValueError("Invalid filter {!r}: {}".format(item.strip(), e))
+    return FilterChain(spec, filters)
+
+def fresh(chain):
+    """A chain with the same filters and no state, for recomputing"""
+    return parse_chain(chain.spec) if chain else None
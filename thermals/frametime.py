@@ -0,0 +1,154 @@
+"""Frame-time instrumentation of the plot canvases and fan curves.
+
+Ctrl+Shift+F (or starting with `--frame-overlay`) toggles an overlay on every
+instrumented drawing area with its draw duration, path vertices, redraw rate,
+skipped frames and a histogram of recent draw durations. While it is on, a
+summary per drawing area is also printed every `LOG_INTERVAL` seconds.
+
+Frames are counted as skipped when a drawing area redraws continuously
+(e.g. while resizing or dragging) and the frame clock advanced more than one
+refresh interval between two of its draws. Nothing is measured while the
+overlay is off.
+"""
+import sys
+import weakref
+from bisect import bisect_left
+from collections import deque
+from time import monotonic_ns
+
+# Draws kept for percentiles, rates and histograms
+WINDOW = 240
+# Upper bounds in milliseconds of the histogram bins, the last bin is open
+BINS = [0.5, 1, 2, 4, 8, 16, 33]
+# Milliseconds per frame at 60 Hz, one of `BINS`
+FRAME_MS = 16
+# Draws closer than this many seconds are taken as continuous redrawing
+CONTINUOUS = 0.1
+# Used when the frame clock doesn't know the display's refresh interval
+DEFAULT_REFRESH_US = 16667
+LOG_INTERVAL = 10
+
+class FrameStats:
+    """Rolling draw statistics of one drawing area"""
+    def __init__(self, name):
+        self.name = name
+        # (frame time in seconds, draw duration in ms, vertices)
+        self.draws = deque([], WINDOW)
+        self.skipped = 0
+        self.logged = None
+
+    def add(self, frame_time, ms, vertices, refresh):
+        if self.draws:
+            gap = frame_time - self.draws[-1][0]
+            if 0 < gap < CONTINUOUS:
+                self.skipped += max(0, round(gap / refresh) - 1)
+        self.draws.append((frame_time, ms, vertices))
+
+    def percentile(self, q) -> float:
+        durations = sorted(ms for (_, ms, _) in self.draws)
+        if not durations:
+            return 0.0
+        return durations[min(int(len(durations) * q / 100), len(durations) - 1)]
+
+    def rate(self) -> float:
+        """Draws during the last second"""
+        if not self.draws:
+            return 0.0
+        last = self.draws[-1][0]
+        return sum(1 for (t, _, _) in self.draws if t > last - 1)
+
+    def histogram(self) -> list[int]:
+        counts = [0] * (len(BINS) + 1)
+        for (_, ms, _) in self.draws:
+            counts[bisect_left(BINS, ms)] += 1
+        return counts
+
+    def lines(self) -> list[str]:
+        if not self.draws:
+            return [self.name, "no draws"]
+        return [
+            self.name,
+            "draw {:.2f}ms p50 {:.2f} p95 {:.2f}".format(
+                self.draws[-1][1], self.percentile(50), self.percentile(95)),
+            "{} vertices {:.0f}/s {} skipped".format(
+                self.draws[-1][2], self.rate(), self.skipped),
+        ]
+
+    def summary(self) -> str:
+        name, *details = self.lines()
+        return "{}: {}".format(name, ", ".join(details))
+
+def draw_overlay(c, w, h, stats):
+    """Summary and histogram in the top right corner"""
+    lines = stats.lines()
+    histogram = stats.histogram()
+    box_w, bar_h = 300, 40
+    box_h = 16 * len(lines) + bar_h + 24
+    x0, y0 = w - box_w - 8, 8
+    c.save()
+    c.set_source_rgba(0, 0, 0, 0.7)
+    c.rectangle(x0, y0, box_w, box_h)
+    c.fill()
+    c.set_source_rgb(1, 1, 1)
+    c.select_font_face("Monospace")
+    c.set_font_size(11)
+    for (i, line) in enumerate(lines):
+        c.move_to(x0 + 6, y0 + 16 * (i + 1))
+        c.show_text(line)
+    bar_w = (box_w - 12) / len(histogram)
+    top = y0 + 16 * len(lines) + 6
+    most = max(histogram) or 1
+    for (i, n) in enumerate(histogram):
+        height = bar_h * n / most
+        # Draws longer than a frame at 60 Hz are red
+        c.set_source_rgb(*((0.9, 0.3, 0.2) if i > BINS.index(FRAME_MS) else (0.4, 0.8, 0.5)))
+        c.rectangle(x0 + 6 + i * bar_w, top + bar_h - height, bar_w - 2, height)
+        c.fill()
+    c.set_source_rgb(0.8, 0.8, 0.8)
+    c.set_font_size(9)
+    for (i, bound) in enumerate(BINS + [None]):
+        c.move_to(x0 + 6 + i * bar_w, top + bar_h + 12)
+        c.show_text("<{}".format(bound) if bound is not None else ">{}".format(BINS[-1]))
+    c.restore()
+
+class FrameMonitor:
+    def __init__(self):
+        self.enabled = "--frame-overlay" in sys.argv
+        self.areas = weakref.WeakSet()
+
+    def instrument(self, area, draw, name, vertices=None):
+        """Set `draw` as the draw function of `area`, measured while
+        enabled. `vertices` returns the vertices of the last draw."""
+        stats = FrameStats(name)
+        self.areas.add(area)
+
+        def measured(area, c, w, h, data):
+            if not self.enabled:
+                return draw(area, c, w, h, data)
+            ns0 = monotonic_ns()
+            draw(area, c, w, h, data)
+            ms = (monotonic_ns() - ns0) / 1000000
+            clock = area.get_frame_clock()
+            if clock is not None:
+                frame_time = clock.get_frame_time() / 1000000
+                timings = clock.get_current_timings()
+                refresh = timings.get_refresh_interval() if timings is not None else 0
+            else:
+                frame_time, refresh = ns0 / 1000000000, 0
+            stats.add(frame_time, ms, vertices() if vertices else 0,
+                      (refresh or DEFAULT_REFRESH_US) / 1000000)
+            draw_overlay(c, w, h, stats)
+            if stats.logged is None or frame_time - stats.logged >= LOG_INTERVAL:
+                print(stats.summary())
+                stats.logged = frame_time
+
+        area.set_draw_func(measured, None)
+        return stats
+
+    def toggle(self):
+        self.enabled = not self.enabled
+        print("Frame-time overlay {}".format("on" if self.enabled else "off"))
+        for area in self.areas:
+            area.queue_draw()
+
+monitor = FrameMonitor()
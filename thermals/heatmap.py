@@ -0,0 +1,185 @@
+"""Time × sensor heatmap, an alternative to lines for plots with many sensors.
+
+The image has one pixel per sensor and history step and is scaled to the
+canvas when drawn, so drawing costs the same however many sensors there
+are. Columns form a ring: each tick advances the ring by one column and
+writes only the newest column from the tails of the `History` buffers. The
+whole image is rebuilt from history when the sensors, resolution or time
+window change, and recolored when a value falls outside the color range.
+"""
+import math
+from array import array
+
+import cairo
+
+# (position, (r, g, b)) stops of the colormap, low to high
+COLORMAP = [
+    (0.0, (0.05, 0.03, 0.25)),
+    (0.25, (0.35, 0.06, 0.5)),
+    (0.5, (0.75, 0.2, 0.35)),
+    (0.75, (0.97, 0.55, 0.08)),
+    (1.0, (0.99, 0.99, 0.6)),
+]
+LUT_SIZE = 256
+# Headroom added to the color range when a value falls outside of it, so
+# the image is not recolored on every new extreme
+RANGE_MARGIN = 0.1
+
+def build_lut(stops, size=LUT_SIZE) -> list[bytes]:
+    """RGB24 pixels (B, G, R, x in memory) interpolated between `stops`"""
+    lut = []
+    for i in range(size):
+        x = i / (size - 1)
+        for ((x0, c0), (x1, c1)) in zip(stops, stops[1:]):
+            if x <= x1:
+                f = (x - x0) / (x1 - x0)
+                r, g, b = (lo + (hi - lo) * f for (lo, hi) in zip(c0, c1))
+                break
+        lut.append(bytes((round(b * 255), round(g * 255), round(r * 255), 0)))
+    return lut
+
+LUT = build_lut(COLORMAP)
+
+class Heatmap:
+    def __init__(self, background=(0.5, 0.5, 0.5)):
+        self.background = bytes(round(v * 255) for v in reversed(background)) + b"\0"
+        self.surface = None
+        # (resolution, columns, sensors) the image was built for
+        self.key = None
+        self.sensors = []
+        self.columns = 0
+        self.res = 1
+        # Values by ring column and row, NaN where there is none
+        self.values = None
+        # History step (time // res) of the newest column and its ring index
+        self.step = None
+        self.head = 0
+        self.v_min = None
+        self.v_max = None
+
+    def update(self, history, sensors, res, seconds, now):
+        """Shift in the newest column, or rebuild if the layout changed"""
+        columns = max(1, seconds // res)
+        key = (res, columns, tuple(sensors))
+        if key != self.key:
+            self.rebuild(history, sensors, res, columns, now)
+            self.key = key
+            return
+        step = now // res
+        if step - self.step > 1:
+            # Ticks were missed (e.g. in the background), fill from history
+            self.rebuild(history, sensors, res, columns, now)
+            return
+        if step > self.step:
+            for _ in range(min(step - self.step, columns)):
+                self.head = (self.head + 1) % columns
+                self.clear_column(self.head)
+            self.step = step
+        # The tail of a buffer is averaged into until its step is over,
+        # so it may still belong to the column before the newest.
+        cells = []
+        for (row, sensor) in enumerate(sensors):
+            dq = history.sensors[sensor][res]
+            if dq:
+                age = step - dq[-1].time // res
+                if 0 <= age < columns:
+                    cells.append(((self.head - age) % columns, row, dq[-1].value))
+        if self.extend_range([value for (_, _, value) in cells]):
+            self.recolor()
+        self.write_cells(cells)
+
+    def rebuild(self, history, sensors, res, columns, now):
+        self.sensors = list(sensors)
+        self.columns = columns
+        self.res = res
+        rows = max(1, len(self.sensors))
+        self.surface = cairo.ImageSurface(cairo.FORMAT_RGB24, columns, rows)
+        self.values = array('d', [math.nan]) * (columns * rows)
+        self.step = now // res
+        self.head = columns - 1
+        for (row, sensor) in enumerate(self.sensors):
+            for m in reversed(history.sensors[sensor][res]):
+                newest = self.step - m.time_end // res
+                if newest >= columns:
+                    break
+                # Runs cover every column from their start to their end
+                for age in range(max(newest, 0), min(self.step - m.time // res, columns - 1) + 1):
+                    self.values[(self.head - age) % columns * rows + row] = m.value
+        self.v_min = self.v_max = None
+        self.extend_range(self.values)
+        self.recolor()
+
+    def extend_range(self, values) -> bool:
+        """Widen the color range to include `values`, True if it changed"""
+        present = [v for v in values if not math.isnan(v)]
+        if not present:
+            return False
+        low, high = min(present), max(present)
+        if self.v_min is not None and low >= self.v_min and high <= self.v_max:
+            return False
+        if self.v_min is not None:
+            low, high = min(low, self.v_min), max(high, self.v_max)
+        margin = max(high - low, 1) * RANGE_MARGIN
+        self.v_min, self.v_max = low - margin, high + margin
+        return True
+
+    def pixel(self, value) -> bytes:
+        if math.isnan(value):
+            return self.background
+        i = int((value - self.v_min) / (self.v_max - self.v_min) * (LUT_SIZE - 1))
+        return LUT[min(max(i, 0), LUT_SIZE - 1)]
+
+    def write_cells(self, cells):
+        """Set (ring column, row, value) `cells`"""
+        rows = len(self.sensors)
+        stride = self.surface.get_stride()
+        self.surface.flush()
+        data = self.surface.get_data()
+        for (col, row, value) in cells:
+            self.values[col * rows + row] = value
+            offset = row * stride + col * 4
+            data[offset:offset + 4] = self.pixel(value)
+        self.surface.mark_dirty()
+
+    def write_column(self, col, column):
+        self.write_cells([(col, row, value) for (row, value) in enumerate(column)])
+
+    def clear_column(self, col):
+        self.write_column(col, [math.nan] * len(self.sensors))
+
+    def recolor(self):
+        rows = len(self.sensors)
+        for col in range(self.columns):
+            self.write_column(col, self.values[col * rows:(col + 1) * rows])
+
+    def draw(self, c, w, h):
+        """Paint oldest to newest, left to right, scaled to `w` × `h`"""
+        if self.surface is None or not self.sensors:
+            return
+        rows = len(self.sensors)
+        c.save()
+        c.scale(w / self.columns, h / rows)
+        split = (self.head + 1) % self.columns
+        for (src, dst, width) in ((split, 0, self.columns - split),
+                                  (0, self.columns - split, split)):
+            if width <= 0:
+                continue
+            c.set_source_surface(self.surface, dst - src, 0)
+            c.get_source().set_filter(cairo.FILTER_NEAREST)
+            c.rectangle(dst, 0, width, rows)
+            c.fill()
+        c.restore()
+
+    def lookup(self, x, y, w, h):
+        """(sensor, time, value) of the cell at `x`, `y`"""
+        if self.surface is None or not self.sensors or not w or not h:
+            return (None, None, None)
+        rows = len(self.sensors)
+        display = min(max(int(x / w * self.columns), 0), self.columns - 1)
+        row = min(max(int(y / h * rows), 0), rows - 1)
+        col = (self.head + 1 + display) % self.columns
+        value = self.values[col * rows + row]
+        if math.isnan(value):
+            return (None, None, None)
+        time = (self.step - (self.columns - 1 - display)) * self.res
+        return (self.sensors[row], time, value)
@@ -1,18 +1,36 @@
 from collections import defaultdict, deque
 
-from thermals.utils import time_it
+from thermals.utils import Unit, time_it
 from thermals.sensor import Sensor
+from thermals.alerts import AlertEngine
+from thermals.stats import Statistics
+from thermals.archive import ArchiveWriter
+from thermals.filters import fresh
+from thermals.energy import EnergyAccounting
+
+# Values at most this far from the value of a run extend it, half the
+# precision they are shown with. Other units need equal values.
+RUN_EPSILON = {
+    Unit.CELCIUS: 0.05,
+    Unit.RPM: 0.5,
+    Unit.PWM: 0.5,
+    Unit.WATT: 0.05,
+    Unit.MHZ: 0.5,
+    Unit.PERCENT: 0.05,
+}
 
 class Measurement:
     time = None
+    # Time of the last value of a run of equal values, `time` otherwise
+    time_end = None
     value = None
     sensor = None
     count = 1
 
-    def create(sensor: Sensor):
+    def create(sensor: Sensor, raw=False):
         ms = Measurement()
-        ms.time = sensor.time
-        ms.value = sensor.value
+        ms.time = ms.time_end = sensor.time
+        ms.value = sensor.raw if raw else sensor.value
         ms.sensor = sensor
         return ms
     
@@ -27,28 +45,98 @@ class Measurement:
 
 class History:
     resolutions = [1, 3, 10, 30]
+    # Number of measurements kept per sensor and resolution
+    retention = 1024 * 2
+    # Number of high-rate captures kept, see `thermals.trigger`
+    captures_retention = 32
 
     def __init__(self, app):
         self.app = app
-        self.sensors = defaultdict(
-            lambda: {res: deque([], 1024 * 2) for res in self.resolutions}
-        )
+        self.sensors = defaultdict(self.create_series)
+        # Unfiltered values of sensors with filters, see `thermals.filters`
+        self.raw = defaultdict(self.create_series)
+        self.captures = deque([], self.captures_retention)
+        self.alerts = AlertEngine(app)
+        self.stats = Statistics()
+        # Energy by hour and day of sensors with energy counters
+        self.energy = EnergyAccounting()
+        # `read_ns` of the last value historized per sensor. Sensors not read
+        # since (backing off, or slow and spaced out) are skipped.
+        self.historized = {}
+        self.archive = ArchiveWriter.from_config(app.config)
     
     @time_it("historize_sensors")
-    def historize_sensors(self):
-        for sensor in self.app.hwmon.get_sensors():
+    def historize_sensors(self, sensors=None):
+        sensors = list(sensors if sensors is not None else self.app.hwmon.get_sensors())
+        updated = [s for s in sensors
+                   if s.read_ns is not None and self.historized.get(s) != s.read_ns]
+        for sensor in updated:
+            self.historized[sensor] = sensor.read_ns
+        if self.archive:
+            self.archive.record(sensors, fresh=updated)
+        for sensor in updated:
             if sensor.value is None:
                 continue
+            self.alerts.evaluate(sensor)
+            self.stats.add(sensor)
+            if hasattr(sensor, 'counter'):
+                self.energy.add(sensor)
             for res in self.resolutions:
-                measurement = Measurement.create(sensor)
-                dq = self.sensors[sensor][res]
-                # First and second measurements are always added.
-                # For lower resolutions, we replace the tail but need the measurement
-                # before the tail for time comparison
-                if len(dq) in (0, 1):
-                    dq.append(measurement)
-                else:
-                    if measurement.time - dq[-2].time <= res:
-                        dq[-1] += measurement
-                    else:
-                        dq.append(measurement)
+                self.append(self.sensors[sensor][res], Measurement.create(sensor), res)
+                if sensor.filters is not None:
+                    self.append(self.raw[sensor][res], Measurement.create(sensor, raw=True), res)
+
+    def create_series(self):
+        return {res: deque([], self.retention) for res in self.resolutions}
+
+    def append(self, dq, measurement, res):
+        # First and second measurements are always added.
+        # For lower resolutions, we replace the tail but need the measurement
+        # before the tail for time comparison
+        if len(dq) in (0, 1):
+            dq.append(measurement)
+        else:
+            if measurement.time - dq[-2].time_end <= res:
+                dq[-1] += measurement
+            else:
+                # The tail is complete. If it has the value of the one
+                # before, that one becomes (or stays) a run until the tail.
+                tail, previous = dq[-1], dq[-2]
+                epsilon = RUN_EPSILON.get(Unit(measurement.sensor.unit), 0)
+                if abs(tail.value - previous.value) <= epsilon:
+                    previous.time_end = tail.time
+                    dq.pop()
+                dq.append(measurement)
+
+    @time_it("History refilter")
+    def refilter(self, sensor):
+        """Recompute the filtered values of `sensor` from its raw values,
+        after its filters changed. Coarser resolutions filter their
+        averages rather than averaging filtered values, runs are filtered
+        as one value at their end."""
+        had_raw = sensor in self.raw
+        raw = self.raw[sensor] if had_raw else self.sensors[sensor]
+        for res in self.resolutions:
+            source = list(raw[res])
+            chain = fresh(sensor.filters)
+            values = [m.value for m in source]
+            if chain is not None:
+                values = chain.batch(values, [m.time_end for m in source])
+                if res == self.resolutions[0]:
+                    # Continue live filtering from the recomputed state
+                    sensor.filters = chain
+            dq = self.sensors[sensor][res]
+            dq.clear()
+            for (m, value) in zip(source, values):
+                ms = Measurement()
+                ms.time, ms.time_end, ms.value = m.time, m.time_end, value
+                ms.sensor, ms.count = sensor, m.count
+                dq.append(ms)
+            if sensor.filters is not None and not had_raw:
+                self.raw[sensor][res].extend(source)
+        if sensor.filters is None:
+            self.raw.pop(sensor, None)
+
+    def close(self):
+        if self.archive:
+            self.archive.close()
@@ -1,13 +1,24 @@
 
-from gi.repository import Gtk, GObject, Gio, GLib, Pango
+from gi.repository import GLib
 import glob
 from os.path import basename
 import os.path
-from collections.abc import Iterator
+from time import monotonic_ns
 
-from thermals.utils import Unit, readlineStrip, readGio, time_it, empty, reglob, monotonic_s
+from thermals.utils import Unit, readlineStrip, readGio, readGioAsync, time_it, empty, reglob
 from thermals.sensor import Sensor
-from thermals.curve import CurveHwmonWindow
+from thermals.energy import Counter, counter_range
+from thermals.source import Source, Device
+from thermals.system import ThermalZoneSource, CpuFreqSource, ProcStatSource
+from thermals.virtual import VirtualDevice, SECTION_PREFIX
+
+# Sources besides hwmon, enabled in the `[sources]` config section.
+# Other sources can be appended before `Hwmon.find_devices`.
+SOURCES = [ThermalZoneSource, CpuFreqSource, ProcStatSource]
+# Milliseconds between checks whether labels were read, before caching them
+LABEL_WAIT_MS = 100
+# Cached label of sensors without a `_label` file, None is not read yet
+NO_LABEL = False
 
 def convertTemp(inp: str):
     return float(inp) / 1000.0
@@ -15,202 +26,247 @@ def convertTemp(inp: str):
 def convertWatt(inp: str):
     return float(inp) / 1000000.0
 
-class Hwmon(Gtk.Box):
+class Hwmon:
+    """Model of all devices and sensors of all sources. Holds no widgets,
+    see `SensorView`."""
     def __init__(self, app):
-        super().__init__(orientation=Gtk.Orientation.VERTICAL)
         self.app = app
         self.devices = []
+        self.sources = []
+        self.virtual = None
+
+    @time_it("Hwmon find_devices")
+    def find_devices(self, root="/sys/class/hwmon", cache=None):
+        """Find the devices of all enabled sources, hwmon devices under
+        `root`. See `HwmonSource` for the `cache`."""
+        sources = [HwmonSource(self, root)] + [cls(self) for cls in SOURCES]
+        self.sources = [source for source in sources if source.enabled()]
+        for source in self.sources:
+            source.find_devices(cache)
+            self.devices.extend(source.devices)
+        self.load_virtual()
+
+    def load_virtual(self):
+        """Create or recompile the virtual sensors, see `thermals.virtual`"""
+        if self.virtual is None:
+            if not any(s.startswith(SECTION_PREFIX) for s in self.app.config.sections()):
+                return
+            self.virtual = VirtualDevice(self.app)
+            self.devices.append(self.virtual)
+        self.virtual.load(self)
 
-    def find_devices(self):
-        for dir in reglob("/sys/class/hwmon/hwmon[0-9]+"):
-            device = HwmonDevice(self.app, dir)
-            if empty(device.get_sensors()):
-                print("Found no sensors in {}".format(dir))
+    @time_it("Hwmon refresh")
+    def refresh(self, sensors=None):
+        """Read `sensors` (default all), batched per source"""
+        batches = {source: [] for source in self.sources}
+        virtual = []
+        # Checked once per device and refresh
+        suspended = {}
+        now = monotonic_ns()
+        for sensor in sensors if sensors is not None else self.get_sensors():
+            device = sensor.device
+            if device.source is None:
+                virtual.append(sensor)
                 continue
+            if device not in suspended:
+                suspended[device] = device.suspended()
+            if suspended[device]:
+                sensor.suspend(now)
             else:
-                self.devices.append(device)
-                self.append(device)
-            
-    @time_it("Hwmon refresh")
-    def refresh(self):
-        for sensor in self.get_sensors():
-            time_it("{} refresh".format(sensor))(sensor.refresh)()
+                batches[device.source].append(sensor)
+        for (source, batch) in batches.items():
+            if batch:
+                source.read(batch)
+        # Virtual sensors are computed from the values just read
+        for sensor in virtual:
+            sensor.refresh()
 
     def get_sensors(self, **kw):
         for dev in self.devices:
             for sensor in dev.get_sensors(**kw):
                 yield sensor
-    
-    def select_sensor(self, sensor):
-        for dev in self.devices:
-            if dev.select_sensor(sensor):
-                dev.grab_focus()
 
-class HwmonDevice(Gtk.Expander):
-    def __init__(self, app, dir):
-        self.app = app
+class HwmonSource(Source):
+    """Devices under /sys/class/hwmon"""
+    name = "hwmon"
+    default = True
+
+    def __init__(self, model, root="/sys/class/hwmon"):
+        super().__init__(model)
+        self.root = root
+
+    def find_devices(self, cache=None):
+        """Devices found in the `TopologyCache` are created from it and
+        revalidated in the background."""
+        dirs = sorted(reglob(self.root + "/hwmon[0-9]+"))
+        for dir in dirs:
+            entry = cache.lookup(dir) if cache else None
+            device = HwmonDevice(self.app, dir, cached=entry, source=self)
+            if empty(device.get_sensors()):
+                print("Found no sensors in {}".format(dir))
+                if cache and entry is None:
+                    cache.store(device)
+                continue
+            else:
+                self.devices.append(device)
+        if cache:
+            cache.retain(dirs)
+            self.revalidate(cache)
+
+    def revalidate(self, cache):
+        """Re-probe devices one at a time on idle, replacing the sensors of
+        any device whose sensors changed, then store them in the cache and
+        save it once their labels were read."""
+        pending = list(self.devices)
+        def step():
+            if not pending:
+                if any(device.labels_pending() for device in self.devices):
+                    GLib.timeout_add(LABEL_WAIT_MS, step, priority=GLib.PRIORITY_LOW)
+                    return False
+                for device in self.devices:
+                    cache.store(device)
+                cache.save()
+                return False
+            device = pending.pop(0)
+            if device.probe() != device.probed:
+                print("Sensors of {} changed, re-probing".format(device.dir))
+                device.reprobe()
+                if self.model.virtual is not None:
+                    self.model.virtual.load(self.model)
+                if self.app.win:
+                    self.app.win.plots.recreate_plots()
+            return True
+        GLib.idle_add(step, priority=GLib.PRIORITY_LOW)
+
+class HwmonDevice(Device):
+    """A hwmon device and its sensors"""
+    def __init__(self, app, dir, cached=None, source=None):
+        if cached:
+            id = cached['id']
+            name = cached['name']
+        else:
+            # The `id` only becomes the device identifier for now.
+            # It may be needed to have this a device path or something like that,
+            # also a device might have multiple hwmon instances. TODO
+            id = os.path.basename(os.readlink(dir + "/device"))
+            name = readlineStrip(dir + "/name")
+        super().__init__(app, id=id, name=name, hwmonInstance=os.path.basename(dir),
+                         source=source)
         self.dir = dir
-        # The `id` only becomes the device identifier for now.
-        # It may be needed to have this a device path or something like that,
-        # also a device might have multiple hwmon instances. TODO
-        self.id = os.path.basename(os.readlink(dir + "/device"))
-        self.name = readlineStrip(dir + "/name")
-        self.hwmonInstance = os.path.basename(dir)
-
-        self.config_section = self.app.config[self.id]
-        self.config_section.write()
-        super().__init__(expanded=self.config_section.getboolean('expanded'),
-                         halign=Gtk.Align.BASELINE)
-        
-        box = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL)
-        label_name = Gtk.Label(label=self.name, hexpand=True, halign=Gtk.Align.START)
-        label_id = Gtk.Label(label="<small>{}</small>".format(self.hwmonInstance), halign=Gtk.Align.END, margin_end=10)
-        label_id.set_use_markup(True)
-        box.append(label_name)
-        box.append(label_id)
-        self.set_label_widget(box)
-
-        self.connect('notify::expanded', self.on_expanded)
-
-        # List Store
-        store = Gio.ListStore(item_type=Sensor)
-        for sensor in self.find_sensors():
-            store.append(sensor)
-
-        # Selection model
-        ss = Gtk.SingleSelection(autoselect=False, model=store, can_unselect=True)
-        self.ss = ss
-
-        # Column View
-        self.view = Gtk.ColumnView.new(model=ss)
-
-        # Function to setup factory for creating cell widgets
-        def setup_factory(column_title, item_property, **kw):
-            factory = Gtk.SignalListItemFactory()
-
-            def factory_bind(_, item):
-                if item_property == "name":
-                    sensor = item.get_item()
-                    if sensor.has_configuration():
-                        box = Gtk.Box()
-                        label = Gtk.Label(label=sensor.get_property(item_property),
-                                          hexpand=True,
-                                          xalign=0,
-                                          ellipsize=Pango.EllipsizeMode.END)
-                        cfg = Gtk.Button.new_from_icon_name("preferences-system")
-                        cfg.connect('clicked', lambda *a: sensor.configure(app=self.app))
-                        box.append(label)
-                        box.append(cfg)
-                        item.set_child(box)
-                    else:
-                        item.set_child(Gtk.Label(label=sensor.get_property(item_property),
-                                                 xalign=0,
-                                                 ellipsize=Pango.EllipsizeMode.END))
-                elif item_property == "valueStr":
-                    label = Gtk.Label(label=item.get_item().get_property(item_property))
-                    item.set_child(label)
-                    item.get_item().bind_property("valueStr", item.get_child(), "label",
-                                                  GObject.BindingFlags.SYNC_CREATE)
-                elif item_property == "plot":
-                    check = Gtk.CheckButton(active=item.get_item().plot)
-                    colorDialog = Gtk.ColorDialog(with_alpha=False)
-                    color = Gtk.ColorDialogButton(dialog=colorDialog, rgba=item.get_item().color)
-                    color.connect("notify::rgba", lambda *a: item.get_item().set_color_rgba(color.get_rgba()))
-
-                    box = Gtk.Box()
-                    box.append(check)
-                    box.append(color)
-                    item.set_child(box)
-                    item.get_item().bind_property("plot", check, "active",
-                                                  GObject.BindingFlags.BIDIRECTIONAL)
-                    item.get_item().connect("notify::plot", lambda *args: self.app.win.plots.recreate_plots())
-
-            factory.connect('bind', factory_bind)
-            column = Gtk.ColumnViewColumn(title=column_title, factory=factory, **kw)
-            self.view.append_column(column)
-        
-        setup_factory("Name", "name", expand=True)
-        setup_factory("Value", "valueStr")
-        setup_factory("Plot", "plot")
-
-        self.store = store
-        self.set_child(self.view)
-    
-    def find_sensors(self) -> Iterator[Sensor]:
-        """Scans /sys/class/hwmon"""
+        # Runtime PM state of the parent device, e.g. "suspended" for a
+        # discrete GPU that is powered down
+        self.runtime_status = os.path.join(dir, "device", "power", "runtime_status")
 
+        if cached:
+            self.probed = [(kind, measurement) for (kind, measurement, _) in cached['sensors']]
+            labels = [label for (_, _, label) in cached['sensors']]
+        else:
+            self.probed = self.probe()
+            labels = [None] * len(self.probed)
+        for ((kind, measurement), label) in zip(self.probed, labels):
+            self.store.append(self.create_sensor(kind, measurement, label))
+
+    def probe(self) -> list[tuple[str, str]]:
+        """Scans the hwmon directory for (sensor class name, measurement)"""
+        found = []
         for temp in reglob("temp[0-9]+_input$", root_dir=self.dir):
-            name = temp.split('_')[0]
-            cfg = self.app.config["{}:{}".format(self.id, name)]
-            yield Temperature(self, name, cfg)
+            found.append(("Temperature", temp.split('_')[0]))
         
         for fan in reglob("fan[0-9]+_input$", root_dir=self.dir):
-            name = fan.split('_')[0]
-            cfg = self.app.config["{}:{}".format(self.id, name)]
-            yield Fan(self, name, cfg)
+            found.append(("Fan", fan.split('_')[0]))
         
         for pwm in reglob("pwm[0-9]+$", root_dir=self.dir):
-            name = pwm
-            cfg = self.app.config["{}:{}".format(self.id, name)]
-            yield Pwm(self, name, cfg)
+            found.append(("Pwm", pwm))
         
         for power in reglob("power[0-9]+_label$", root_dir=self.dir):
-            name = power.split('_')[0]
-            cfg = self.app.config["{}:{}".format(self.id, name)]
-            yield Power(self, name, cfg)
+            found.append(("Power", power.split('_')[0]))
 
         for energy in reglob("energy[0-9]+_label$", root_dir=self.dir):
-            name = energy.split('_')[0]
-            cfg = self.app.config["{}:{}".format(self.id, name)]
-            yield Energy(self, name, cfg)
+            found.append(("Energy", energy.split('_')[0]))
+        return found
 
-    
-    def select_sensor(self, sensor: Sensor):
-        for (i, s) in enumerate(self.store):
-            if s == sensor:
-                #self.view.scroll_to(i, None, Gtk.ListScrollFlags.SELECT)
-                self.set_expanded(True)
-                self.ss.set_selected(i)
-                #self.ss.grab_focus()
-                return True
-        self.ss.set_selected(Gtk.INVALID_LIST_POSITION)
-    
-    def on_expanded(self, *a):
-        self.config_section['expanded'] = str(self.get_property('expanded'))
-        self.app.config.write()
+    def suspended(self):
+        # Reading the status doesn't resume the device
+        try:
+            return readlineStrip(self.runtime_status) == "suspended"
+        except OSError:
+            return False
+
+    def create_sensor(self, kind, measurement, label=None) -> Sensor:
+        return SENSOR_CLASSES[kind](self, measurement, self.sensor_config(measurement), label=label)
+
+    def labels_pending(self) -> bool:
+        return any(sensor.label_pending for sensor in self.store)
+
+    def reprobe(self):
+        """Replace the sensors with freshly probed ones"""
+        self.probed = self.probe()
+        self.store.splice(0, self.store.get_n_items(),
+                          [self.create_sensor(kind, measurement) for (kind, measurement) in self.probed])
+
+    def topology(self) -> list[tuple[str, str, str | bool | None]]:
+        """(sensor class name, measurement, label) of all sensors, for
+        caching. The label is `NO_LABEL` if the sensor has none."""
+        return [(kind, sensor.measurement,
+                 NO_LABEL if sensor.label is None and not sensor.label_pending else sensor.label)
+                for ((kind, _), sensor) in zip(self.probed, self.store)]
 
-    def get_sensors(self, plot : bool | None = None, unit : int | None = None):
-        """Return sensors using filters.
-        
-        No filters -> All sensors
-        """
-        for item in self.store:
-            if plot != None and item.plot != plot:
-                continue
-            if unit != None and item.unit != unit:
-                continue
-            yield item
 
 class HwmonSensor(Sensor):
-    def __init__(self, device, measurement, config):
+    # Contents of the `_label` file, if there is one
+    label = None
+    # Converts attribute contents to the sensor's unit, for limits
+    convert = None
+    # Whether the `_label` file is still being read
+    label_pending = False
+
+    def __init__(self, device, measurement, config, label=None):
         self.device = device
         self.measurement = measurement
         super().__init__(measurement, config)
-        try:
-            #label = readStrip(os.path.join(self.device.dir, self.measurement + "_label"))
-            label = readGio(os.path.join(self.device.dir, self.measurement + "_label"))()
-            self.name = label
-        except (FileNotFoundError, GLib.GError):
-            pass
+        if label is None:
+            # Labels are loaded in the background, the measurement name is
+            # shown until then.
+            self.label_pending = True
+            readGioAsync(os.path.join(self.device.dir, self.measurement + "_label"),
+                         self.on_label, on_error=self.on_no_label)
+        elif label is not NO_LABEL:
+            self.on_label(label)
+
+    def on_label(self, label):
+        self.label_pending = False
+        self.label = label
+        self.name = label
+
+    def on_no_label(self):
+        self.label_pending = False
     
-    def format_valueStr(self):
-        self.valueStr = Unit(self.unit).format_value(self.value)
+    def format_value(self):
+        if self.value is None:
+            return ""
+        return Unit(self.unit).format_value(self.value)
     
     def has_configuration(self):
         return False
 
+    def limit(self, attr):
+        if self.convert is None:
+            return None
+        try:
+            return self.convert(readlineStrip(
+                os.path.join(self.device.dir, "{}_{}".format(self.measurement, attr))))
+        except (OSError, ValueError):
+            return None
+
+    def alarm(self):
+        try:
+            return readlineStrip(os.path.join(self.device.dir, self.measurement + "_alarm")) != "0"
+        except OSError:
+            return None
+
 class Temperature(HwmonSensor):
     unit = Unit.CELCIUS.value
+    convert = staticmethod(convertTemp)
 
     def get_value(self):
         # return convertTemp(readlineStrip(
@@ -220,6 +276,7 @@ class Temperature(HwmonSensor):
 
 class Fan(HwmonSensor):
     unit = Unit.RPM.value
+    convert = staticmethod(int)
 
     def get_value(self):
         # return int(readlineStrip(
@@ -242,6 +299,8 @@ class Pwm(HwmonSensor):
                readGio(path_enable)() == "5"
 
     def configure(self, app=None):
+        # Imported on demand, the curve editor is not needed at startup
+        from thermals.curve import CurveHwmonWindow
         win = CurveHwmonWindow(self,
             application = app,
             title = "{} {}".format(self.device.name, self.measurement))
@@ -250,6 +309,7 @@ class Pwm(HwmonSensor):
 
 class Power(HwmonSensor):
     unit = Unit.WATT.value
+    convert = staticmethod(convertWatt)
     def get_value(self):
         # return convertWatt(readlineStrip(
         #     os.path.join(self.device.dir, self.measurement + "_average")
@@ -260,28 +320,17 @@ class Power(HwmonSensor):
             return readGio(os.path.join(self.device.dir, self.measurement + "_input"), func = convertWatt)()
 
 class Energy(HwmonSensor):
-    # Energy reads energy counters in Joules.
-    # `get_value` converts it to Watts and therefor needs the previous value.
+    # Energy reads energy counters in microjoules and shows the average
+    # power since the previous read, see `thermals.energy`.
     unit = Unit.WATT.value
-    previous_joules = None
-    # time = None # set when `refresh`ed
+    sampleable = False
+
+    def __init__(self, device, measurement, config, label=None):
+        self.counter = Counter(counter_range(config))
+        super().__init__(device, measurement, config, label=label)
 
     def get_value(self):
-        current_joules = readGio(
-            os.path.join(self.device.dir, self.measurement + "_input"),
-            func = convertWatt)()
+        uj = readGio(os.path.join(self.device.dir, self.measurement + "_input"), func = int)()
+        return self.counter.add(uj, monotonic_ns())
 
-        if not self.previous_joules or not self.time:
-            self.previous_joules = current_joules
-            return
-        
-        dt = monotonic_s() - self.time
-        if dt <= 0:
-            return
-        difference = current_joules - self.previous_joules
-        if difference < 0:
-            # Counter has wrapped around, and we don't have a value.
-            # Maybe someone can fix this.
-            return
-        self.previous_joules = current_joules
-        return difference / dt
+SENSOR_CLASSES = {cls.__name__: cls for cls in (Temperature, Fan, Pwm, Power, Energy)}
@@ -1,39 +1,33 @@
 import sys
+import tracemalloc
+if "--memory-report" in sys.argv:
+    # Before the other imports, so their allocations are traced too
+    tracemalloc.start()
 import os, os.path
 from time import monotonic_ns
 
 import gi
 gi.require_version('Gtk', '4.0')
 gi.require_version('Adw', '1')
-from gi.repository import Gtk, Adw, GObject, GLib
+from gi.repository import Gtk, Gdk, Adw, GObject, GLib, Gio
 import configparser
 
-from thermals.plots import Plots
 from thermals.hwmon import Hwmon
+from thermals.sensorview import SensorView
 from thermals.history import History
-from thermals.utils import time_it
+from thermals.config import Config
+from thermals.scheduler import Scheduler
+from thermals.trigger import Triggers
+from thermals.utils import time_it, StartupProfile
 
 HWMON_READ_INTERVAL = 1000
+# Seconds between reads while the window is hidden or minimized
+BACKGROUND_READ_INTERVAL = 10
+# Target time from process start until the window is painted
+STARTUP_BUDGET_MS = 500
 
-class Config(configparser.ConfigParser):
-    def __init__(self, *args, **kw):
-        super().__init__(*args, **kw)
-        os.makedirs(os.path.dirname(self.filepath()), exist_ok=True)
-    def filepath(self):
-        return os.path.join(GLib.get_user_config_dir(), "thermals", "thermals.ini")
-    def read(self):
-        super().read(self.filepath())
-    def write(self):
-        with open(self.filepath(), 'w') as configfile:
-            super().write(configfile)
-    def __getitem__(self, section):
-        if not self.has_section(section) and \
-           not section == "DEFAULT":
-            self.add_section(section)
-        section = super().__getitem__(section)
-        # Monkeypatch a write method
-        section.write = self.write
-        return section
+profile = StartupProfile(STARTUP_BUDGET_MS)
+profile.mark("interpreter and imports")
 
 class MainWindow(Gtk.ApplicationWindow):
     @time_it("Initialize MainWindow")
@@ -42,7 +36,11 @@ class MainWindow(Gtk.ApplicationWindow):
         self.app = application
 
         # Makes sure the config is written when MainWindow is closed
-        self.connect('close-request', lambda *args: self.app.config.write())
+        self.connect('close-request', self.on_close_request)
+        # Sample less while nobody is looking
+        self.connect('notify::visible', self.on_visibility_changed)
+        self.connect('realize', lambda *a: self.get_surface().connect(
+            'notify::state', self.on_visibility_changed))
 
         # Restore window size
         try:
@@ -60,6 +58,9 @@ class MainWindow(Gtk.ApplicationWindow):
             self.show_hwmon_error_message()
             return
         
+        # Imported here, plotting pulls in the heatmap, statistics and
+        # frame-time modules
+        from thermals.plots import Plots
         self.plots = Plots(self.app)
         self.plots.create_plots()
 
@@ -67,9 +68,9 @@ class MainWindow(Gtk.ApplicationWindow):
             .bind_property('dark', self.plots, 'darkStyle',
                            GObject.BindingFlags.SYNC_CREATE)
         
+        self.sensor_view = SensorView(self.app, self.app.hwmon)
         hpane = Gtk.Paned(orientation=Gtk.Orientation.HORIZONTAL)
-        hpane.set_start_child(Gtk.ScrolledWindow(
-            child=self.app.hwmon, hscrollbar_policy=Gtk.PolicyType.NEVER))
+        hpane.set_start_child(self.sensor_view)
         hpane.set_resize_start_child(False)
 
         # hpane.append(self.plots)
@@ -78,6 +79,36 @@ class MainWindow(Gtk.ApplicationWindow):
         hpane.set_position(420)
         self.hpane = hpane
         self.set_child(hpane)
+
+        profile.mark("window construction")
+        if profile.enabled:
+            self.connect('map', self.on_map_profile)
+
+    def on_close_request(self, *args):
+        self.app.config.write()
+        if self.app.config.getboolean('background', 'on_close', fallback=False):
+            # Keep sampling in the background instead of quitting
+            self.set_visible(False)
+            self.app.hold_background()
+            return True
+        return False
+
+    def on_visibility_changed(self, *args):
+        surface = self.get_surface()
+        minimized = surface is not None and \
+            bool(surface.get_state() & Gdk.ToplevelState.MINIMIZED)
+        background = not self.get_visible() or minimized
+        self.app.scheduler.set_background(background)
+        # Captures are only looked at in the plots
+        self.app.triggers.set_paused(background)
+
+    def on_map_profile(self, *args):
+        clock = self.get_frame_clock()
+        def after_paint(*args):
+            clock.disconnect(handler)
+            profile.mark("first frame")
+            profile.report()
+        handler = clock.connect('after-paint', after_paint)
     
     def show_hwmon_error_message(self):
         cbox = Gtk.CenterBox()
@@ -93,7 +124,7 @@ class MainWindow(Gtk.ApplicationWindow):
         self.plots.on_notify_default_size(*args)
     
     def select_sensor(self, sensor):
-        self.app.hwmon.select_sensor(sensor)
+        self.sensor_view.select_sensor(sensor)
 
 class Thermals(Adw.Application):
     def __init__(self, **kwargs):
@@ -103,26 +134,127 @@ class Thermals(Adw.Application):
 
         self.config = Config()
         self.config.read()
-        self.config['DEFAULT']['expanded'] = 'True'
-        self.config['DEFAULT']['color'] = "rgb(127, 127, 127)"
-        self.config['DEFAULT']['plot'] = 'True'
+        profile.mark("config")
 
         # Initialize Hwmon reading
         self.hwmon = Hwmon(self)
-        self.hwmon.find_devices()
+        cache = None
+        if "--no-topology-cache" not in sys.argv:
+            from thermals.topology import TopologyCache
+            cache = TopologyCache().load()
+        self.hwmon.find_devices(cache=cache)
+        profile.mark("hwmon discovery")
 
-        self.history = History(self)
+        # Attach to a running collector, otherwise sample in-process
+        self.subscriber = None
+        if "--no-collector" not in sys.argv:
+            from thermals.collector import Subscriber, socket_path
+            self.subscriber = Subscriber.connect(socket_path(self.config),
+                                                 self.on_collector_schema,
+                                                 self.on_collector_lost)
+        if self.subscriber:
+            self.history = self.subscriber.history
+        else:
+            self.history = History(self)
+
+        self.exporter = None
+        if "--exporter" in sys.argv or \
+           self.config.getboolean('exporter', 'enabled', fallback=False):
+            from thermals.exporter import Exporter
+            try:
+                self.exporter = Exporter.from_config(self.config)
+                self.exporter.start()
+            except OSError as e:
+                print("Running without the exporter, can't serve metrics: {}".format(e))
+
+        self.held = False
+        self.scheduler = Scheduler(self.on_timer, HWMON_READ_INTERVAL,
+            self.config.getint('background', 'interval', fallback=BACKGROUND_READ_INTERVAL))
+        self.triggers = Triggers(self)
+        self.memory = None
+        if "--memory-report" in sys.argv:
+            from thermals.memory import MemoryReporter
+            self.memory = MemoryReporter(self)
+        self.connect('shutdown', self.on_shutdown)
+
+        overlay = Gio.SimpleAction.new("frame-overlay", None)
+        overlay.connect('activate', self.on_frame_overlay)
+        self.add_action(overlay)
+        self.set_accels_for_action("app.frame-overlay", ["<Control><Shift>f"])
+
+        # kickoff sensor update timer once the main loop runs, so the
+        # first read doesn't delay the window
+        GLib.idle_add(self.start_sampling)
+
+    def on_frame_overlay(self, *args):
+        from thermals.frametime import monitor
+        monitor.toggle()
 
-        # kickoff sensor update timer
+    def on_shutdown(self, *args):
+        self.scheduler.stop()
+        self.triggers.stop()
+        if self.memory:
+            self.memory.stop()
+        self.history.close()
+
+    def start_sampling(self):
         self.on_timer()
+        self.scheduler.start()
+        self.triggers.arm(self.hwmon.get_sensors())
+        return GLib.SOURCE_REMOVE
     
     def on_timer(self):
-        GLib.timeout_add(HWMON_READ_INTERVAL, self.on_timer)
-        self.hwmon.refresh()
-        self.history.historize_sensors()
+        if self.scheduler.background:
+            if self.subscriber:
+                # The collector does alerting and recording
+                return
+            sensors = list(self.background_sensors())
+            self.hwmon.refresh(sensors)
+            self.history.historize_sensors(sensors)
+            if self.exporter:
+                # All sensors, the others with the values of their last
+                # read, so their series don't disappear from scrapes
+                self.exporter.update(self.hwmon.get_sensors())
+            return
+        if self.subscriber:
+            self.subscriber.update_sensors(self.hwmon.get_sensors())
+        else:
+            self.hwmon.refresh()
+            self.history.historize_sensors()
+        if self.exporter:
+            self.exporter.update(self.hwmon.get_sensors())
         if self.win:
+            self.win.sensor_view.queue_update()
             self.win.plots.refresh()
 
+    def background_sensors(self):
+        """Sensors that are sampled in the background: those with alert
+        rules and those the archive records (`record = True` in their
+        section, or all with `[archive] all = True`)"""
+        archive = self.history.archive
+        for sensor in self.hwmon.get_sensors():
+            if self.history.alerts.has_rules(sensor) or \
+               sensor.config.getboolean('record', fallback=False) or \
+               (archive is not None and archive.records(sensor)):
+                yield sensor
+
+    def hold_background(self):
+        if not self.held:
+            self.held = True
+            self.hold()
+
+    def on_collector_schema(self, history):
+        self.history = history
+        if self.win:
+            self.win.plots.recreate_plots()
+
+    def on_collector_lost(self):
+        print("Falling back to in-process sampling")
+        self.subscriber = None
+        self.history = History(self)
+        if self.win:
+            self.win.plots.recreate_plots()
+
     def select_sensor(self, sensor):
         self.win.select_sensor(sensor)
 
@@ -130,6 +262,9 @@ class Thermals(Adw.Application):
         if not self.win:
             self.win = MainWindow(application=app)
         self.win.present()
+        if self.held:
+            self.held = False
+            self.release()
 
 def main():
     app = Thermals(application_id="is.tum.Thermals")
@@ -0,0 +1,251 @@
+"""Memory accounting: bytes held by `History`, live objects, signal handlers
+and allocation sites.
+
+With `--memory-report` allocations are traced from startup and a report is
+printed every hour and on exit, each compared to the one before, so slow
+leaks of long sessions show up. "Memory" below the plots opens the same
+report in a window, where snapshots can be taken and compared on demand.
+
+Object counts only see objects tracked by Python's garbage collector,
+which includes the Python wrappers of GObjects but not GObjects that were
+never handed to Python.
+"""
+import gc
+import sys
+import tracemalloc
+from collections import Counter
+
+from gi.repository import Gtk, GObject, GLib, Pango
+
+from thermals.history import Measurement
+from thermals.plots import PlotCanvas
+from thermals.sensor import Sensor
+from thermals.utils import monotonic_s, time_it
+
+# Seconds between reports with `--memory-report`
+REPORT_INTERVAL = 3600
+# Measurements per series whose size is measured, the rest is estimated
+SAMPLE = 64
+# Lines of allocation sites and differences shown
+TOP = 15
+TRACE_FILTERS = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+]
+
+def format_bytes(n) -> str:
+    if abs(n) < 1024:
+        return "{} B".format(n)
+    for unit in ("KiB", "MiB", "GiB"):
+        n /= 1024
+        if abs(n) < 1024 or unit == "GiB":
+            return "{:.1f} {}".format(n, unit)
+
+def format_change(now, before, bytes=False) -> str:
+    if before is None:
+        return ""
+    change = now - before
+    return " ({}{})".format("+" if change >= 0 else "",
+                            format_bytes(change) if bytes else change)
+
+def rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as fd:
+            return int(fd.read().split()[1]) * 4096
+    except (OSError, ValueError, IndexError):
+        return 0
+
+def measurement_bytes(m) -> int:
+    return sys.getsizeof(m) + sys.getsizeof(m.__dict__) + \
+        sys.getsizeof(m.time) + sys.getsizeof(m.value)
+
+def series_bytes(dq) -> int:
+    """Bytes of a deque of `Measurement`s, estimated from its newest ones"""
+    size = sys.getsizeof(dq)
+    if not dq:
+        return size
+    tail = [dq[-i] for i in range(1, min(len(dq), SAMPLE) + 1)]
+    return size + round(sum(measurement_bytes(m) for m in tail) / len(tail) * len(dq))
+
+def history_bytes(history, sensors) -> dict:
+    """{sensor: {tier: bytes}}, tiers being resolutions and ("raw", res).
+    A collector's shared ring is counted at 8 bytes per row."""
+    shared = hasattr(history, 'ring')
+    raw = getattr(history, 'raw', {})
+    held = {}
+    for sensor in sensors:
+        if sensor not in history.sensors:
+            continue
+        tiers = {}
+        for (res, series) in history.sensors[sensor].items():
+            tiers[res] = history.retention * 8 if shared else series_bytes(series)
+        if sensor in raw:
+            for (res, series) in raw[sensor].items():
+                tiers[("raw", res)] = series_bytes(series)
+        held[sensor] = tiers
+    return held
+
+def live_objects():
+    """({name: count} of the classes of interest, live GObjects)"""
+    classes = [("Sensor", Sensor), ("Measurement", Measurement), ("PlotCanvas", PlotCanvas),
+               ("Gtk.Widget", Gtk.Widget), ("Gtk.ListItem", Gtk.ListItem)]
+    objects = gc.get_objects()
+    types = Counter(type(o) for o in objects)
+    counts = {name: sum(n for (t, n) in types.items() if issubclass(t, cls))
+              for (name, cls) in classes}
+    gobjects = [o for o in objects if isinstance(o, GObject.Object)]
+    return counts, gobjects
+
+def signal_handlers(gobjects):
+    """{type name: unblocked signal handlers} of `gobjects`, None if
+    handlers can't be enumerated. Each handler found is blocked so the
+    next is found, then all are unblocked again."""
+    counts = Counter()
+    mask = GObject.SignalMatchType.UNBLOCKED
+    try:
+        for obj in gobjects:
+            found = []
+            while (handler := GObject.signal_handler_find(obj, mask, 0, 0, None, None, None)):
+                GObject.signal_handler_block(obj, handler)
+                found.append(handler)
+            for handler in found:
+                GObject.signal_handler_unblock(obj, handler)
+            if found:
+                counts[type(obj).__name__] += len(found)
+    except (AttributeError, TypeError):
+        return None
+    return counts
+
+class Report:
+    @time_it("Memory report")
+    def __init__(self, app):
+        self.time = monotonic_s()
+        self.rss = rss_bytes()
+        self.history = history_bytes(app.history, app.hwmon.get_sensors())
+        self.objects, gobjects = live_objects()
+        self.handlers = signal_handlers(gobjects)
+        del gobjects
+        self.snapshot = None
+        if tracemalloc.is_tracing():
+            self.snapshot = tracemalloc.take_snapshot().filter_traces(TRACE_FILTERS)
+
+    def tiers(self) -> Counter:
+        totals = Counter()
+        for tiers in self.history.values():
+            totals.update(tiers)
+        return totals
+
+    def format(self, previous=None) -> str:
+        lines = ["RSS {}{}".format(format_bytes(self.rss),
+                                   format_change(self.rss, previous and previous.rss, True))]
+        if previous is not None:
+            lines[0] += ", {}s after the previous report".format(self.time - previous.time)
+
+        tiers = self.tiers()
+        before = previous.tiers() if previous else {}
+        lines.append("History {}{}".format(
+            format_bytes(sum(tiers.values())),
+            format_change(sum(tiers.values()), sum(before.values()) if previous else None, True)))
+        names = sorted(tiers, key=lambda t: (t[1], 1) if isinstance(t, tuple) else (t, 0))
+        lines.append("  {:<40} ".format("Sensor") +
+                     " ".join("{:>10}".format(tier_name(t)) for t in names))
+        for (sensor, held) in sorted(self.history.items(), key=lambda i: -sum(i[1].values())):
+            lines.append("  {:<40} ".format("{}/{}".format(sensor.device.name, sensor.name)[:40]) +
+                         " ".join("{:>10}".format(format_bytes(held[t]) if t in held else "")
+                                  for t in names))
+
+        lines.append("Live objects")
+        for (name, n) in self.objects.items():
+            lines.append("  {:<14} {}{}".format(
+                name, n, format_change(n, previous and previous.objects.get(name))))
+
+        if self.handlers is None:
+            lines.append("Signal handlers: can't be enumerated with this PyGObject")
+        else:
+            total = sum(self.handlers.values())
+            before = sum(previous.handlers.values()) \
+                if previous and previous.handlers is not None else None
+            lines.append("Signal handlers {}{}".format(total, format_change(total, before)))
+            for (name, n) in self.handlers.most_common(TOP):
+                lines.append("  {:<30} {}".format(name, n))
+
+        if self.snapshot is None:
+            lines.append("Allocations aren't traced, start with --memory-report")
+            return "\n".join(lines)
+        lines.append("Allocation sites since tracing started")
+        for stat in self.snapshot.statistics('lineno')[:TOP]:
+            lines.append("  {:>10} {:>8} blocks  {}".format(
+                format_bytes(stat.size), stat.count, stat.traceback))
+        if previous is not None and previous.snapshot is not None:
+            lines.append("Allocation sites since the previous report")
+            for stat in self.snapshot.compare_to(previous.snapshot, 'lineno')[:TOP]:
+                lines.append("  {:>10} {:>+8} blocks  {}".format(
+                    ("+" if stat.size_diff >= 0 else "") + format_bytes(stat.size_diff),
+                    stat.count_diff, stat.traceback))
+        return "\n".join(lines)
+
+def tier_name(tier) -> str:
+    if isinstance(tier, tuple):
+        return "raw {}s".format(tier[1])
+    return "{}s".format(tier)
+
+class MemoryReporter:
+    """Prints a report every `REPORT_INTERVAL` seconds and on exit"""
+    def __init__(self, app):
+        self.app = app
+        self.previous = None
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.source = GLib.timeout_add_seconds(REPORT_INTERVAL, self.on_timeout)
+
+    def on_timeout(self):
+        self.print_report()
+        return GLib.SOURCE_CONTINUE
+
+    def print_report(self):
+        report = Report(self.app)
+        print("Memory report:")
+        print(report.format(self.previous))
+        self.previous = report
+
+    def stop(self):
+        GLib.source_remove(self.source)
+        self.print_report()
+
+class MemoryWindow(Gtk.ApplicationWindow):
+    def __init__(self, app):
+        super().__init__(application=app, title="Memory", default_width=900, default_height=600)
+        self.app = app
+        self.previous = None
+
+        snapshot = Gtk.Button.new_with_label("Snapshot")
+        snapshot.connect('clicked', lambda *a: self.take())
+        self.traceButton = Gtk.Button.new_with_label("Trace allocations")
+        self.traceButton.set_tooltip_text("Trace allocations from now on, "
+                                          "--memory-report traces from startup")
+        self.traceButton.connect('clicked', self.on_trace)
+        self.traceButton.set_visible(not tracemalloc.is_tracing())
+
+        self.text = Gtk.TextView(editable=False, monospace=True, wrap_mode=Pango.WrapMode.NONE)
+        header = Gtk.Box(spacing=10, margin_start=6, margin_end=6, margin_top=6, margin_bottom=6)
+        header.append(snapshot)
+        header.append(self.traceButton)
+        header.append(Gtk.Label(label="Differences are to the previous snapshot", xalign=0))
+        box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
+        box.append(header)
+        box.append(Gtk.ScrolledWindow(child=self.text, vexpand=True))
+        self.set_child(box)
+        self.take()
+
+    def take(self):
+        report = Report(self.app)
+        self.text.get_buffer().set_text(report.format(self.previous))
+        self.previous = report
+
+    def on_trace(self, button):
+        tracemalloc.start()
+        button.set_visible(False)
+        # Snapshots without traces can't be compared to ones with
+        self.previous = None
+        self.take()
@@ -5,6 +5,16 @@ from gi.repository import Gtk, GObject
 from thermals.utils import Unit, monotonic_s, time_it
 from time import monotonic_ns
 from thermals.sensor import Sensor
+from thermals.stats import HOUR, DAY
+from thermals.heatmap import Heatmap
+from thermals.frametime import monitor
+
+# Plots with at least this many sensors default to a heatmap
+HEATMAP_SENSORS = 32
+# Half width in pixels of the marker of a capture, see `thermals.trigger`
+MARKER_SIZE = 6
+# Seconds the percentiles and energy totals in a plot's title are kept
+SUMMARY_INTERVAL = 10
 
 class Plots(Gtk.Box):
     timeSelections = [
@@ -17,6 +27,7 @@ class Plots(Gtk.Box):
     ]
     plotSeconds = GObject.Property(type=int, default=timeSelections[0][1])
     darkStyle = GObject.Property(type=bool, default=False)
+    showRaw = GObject.Property(type=bool, default=False)
 
     def __init__(self, app):
         super().__init__(orientation=Gtk.Orientation.VERTICAL)
@@ -31,11 +42,30 @@ class Plots(Gtk.Box):
         clearMinMax = Gtk.Button.new_with_label("Clear Min/Max")
         clearMinMax.connect('clicked', self.on_clear_min_max)
 
+        self.statsPanel = StatsPanel(self.app, self)
+        statsButton = Gtk.MenuButton(label="Statistics", popover=self.statsPanel)
+
+        showRaw = Gtk.ToggleButton(label="Unfiltered",
+                                   tooltip_text="Also show values before the sensors' filters")
+        self.bind_property('showRaw', showRaw, 'active',
+                           GObject.BindingFlags.BIDIRECTIONAL | GObject.BindingFlags.SYNC_CREATE)
+        self.connect('notify::showRaw', lambda *a: self.refresh())
+
+        correlate = Gtk.Button.new_with_label("Correlation")
+        correlate.connect('clicked', self.on_correlate)
+
+        memory = Gtk.Button.new_with_label("Memory")
+        memory.connect('clicked', self.on_memory)
+
         self.append(self.paned)
         bottomBox = Gtk.Box(spacing=10)
         bottomBox.append(Gtk.Label(label="History:"))
         bottomBox.append(timeSelector)
         bottomBox.append(clearMinMax)
+        bottomBox.append(statsButton)
+        bottomBox.append(showRaw)
+        bottomBox.append(correlate)
+        bottomBox.append(memory)
         self.append(bottomBox)
 
     def on_notify_default_size(self, *args):
@@ -59,6 +89,7 @@ class Plots(Gtk.Box):
             canvas.app = self.app
             self.bind_property('plotSeconds', canvas, 'plotSeconds', GObject.BindingFlags.SYNC_CREATE)
             self.bind_property('darkStyle', canvas, 'darkStyle', GObject.BindingFlags.SYNC_CREATE)
+            self.bind_property('showRaw', canvas, 'showRaw', GObject.BindingFlags.SYNC_CREATE)
             self.canvases.append(canvas)
             self.paned.append(canvas)
 
@@ -85,6 +116,56 @@ class Plots(Gtk.Box):
             canvas.scan_min_max(monotonic_s() - canvas.plotSeconds)
             canvas.do_draw()
 
+    def on_correlate(self, *args):
+        from thermals.analysis import AnalysisWindow
+        AnalysisWindow(self.app, self).present()
+
+    def on_memory(self, *args):
+        from thermals.memory import MemoryWindow
+        MemoryWindow(self.app).present()
+
+class StatsPanel(Gtk.Popover):
+    """Percentiles, mean and standard deviation of the plotted sensors"""
+    windows = [("Visible", None), ("1 hour", HOUR), ("24 hours", DAY)]
+    columns = ["Sensor", "p50", "p95", "p99", "Mean", "Stddev"]
+
+    def __init__(self, app, plots):
+        super().__init__()
+        self.app = app
+        self.plots = plots
+
+        self.windowSelector = Gtk.DropDown.new_from_strings([s for (s, _) in self.windows])
+        self.windowSelector.connect("notify::selected", lambda *a: self.populate())
+        self.grid = Gtk.Grid(column_spacing=12, row_spacing=4)
+
+        box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=10)
+        box.append(self.windowSelector)
+        box.append(self.grid)
+        self.set_child(box)
+        self.connect('show', lambda *a: self.populate())
+
+    def populate(self):
+        while (child := self.grid.get_first_child()) is not None:
+            self.grid.remove(child)
+        for (col, title) in enumerate(self.columns):
+            label = Gtk.Label(xalign=0)
+            label.set_markup("<b>{}</b>".format(title))
+            self.grid.attach(label, col, 0, 1, 1)
+
+        seconds = self.windows[self.windowSelector.get_selected()][1] or self.plots.plotSeconds
+        now = monotonic_s()
+        stats = self.app.history.stats
+        for (row, sensor) in enumerate(self.app.hwmon.get_sensors(plot=True), start=1):
+            sketch = stats.window([sensor], seconds, now)
+            if sketch is None or not sketch.n:
+                continue
+            unit = Unit(sensor.unit)
+            cells = ["{}/{}".format(sensor.device.name, sensor.name)] + \
+                    [unit.format_value(sketch.percentile(q)) for q in (50, 95, 99)] + \
+                    [unit.format_value(sketch.mean), unit.format_value(sketch.stddev())]
+            for (col, text) in enumerate(cells):
+                self.grid.attach(Gtk.Label(label=text, xalign=0), col, row, 1, 1)
+
 class MultiPaned(Gtk.Paned):
     """
     A GTK4 Paned can only hold two widgets.
@@ -131,10 +212,30 @@ def values(seq):
         for b in dq:
             yield b.value
 
+def points(series, t_min):
+    """(time, value) newest first while later than `t_min`. A run of equal
+    values is two points, its end and its start, drawn as one segment."""
+    for b in reversed(series):
+        if b.time_end <= t_min:
+            return
+        yield (b.time_end, b.value)
+        if b.time_end != b.time:
+            yield (b.time, b.value)
+
 class PlotCanvas(Gtk.Box):
     darkStyle = GObject.Property(type=bool, default=False)
     plotSeconds = GObject.Property(type=int)
+    showRaw = GObject.Property(type=bool, default=False)
     _history_resolution = None
+    # `Capture` shown instead of the history, see `thermals.trigger`
+    zoom = None
+    # Path vertices of the last draw, see `thermals.frametime`
+    vertices = 0
+    # Percentiles and energy part of the title, the (sensors, plotSeconds)
+    # and time it was computed for, see `summary`
+    _summary = ""
+    _summary_key = None
+    _summary_time = None
     
     # These are the mins and max of values in this plot, updated by
     # `draw` or `scan_min_max`.
@@ -150,6 +251,9 @@ class PlotCanvas(Gtk.Box):
 
     _time_min = None
     _time_max = None
+    # Size of the last drawn frame, used for resolution selection and
+    # coordinate lookups so they agree with what is on screen.
+    _size = (0, 0)
 
     def __init__(self, unit, hwmon, app):
         super().__init__(orientation=Gtk.Orientation.VERTICAL)
@@ -157,9 +261,25 @@ class PlotCanvas(Gtk.Box):
         self.hwmon = hwmon
         self.app = app
 
-        self.title = Gtk.Label()
+        self.config = app.config['plot:{}'.format(unit.name.lower())]
+        self.heatmap = None
+
+        self.title = Gtk.Label(hexpand=True)
         self.format_title()
+        self.heatmapToggle = Gtk.ToggleButton(icon_name="view-grid-symbolic",
+                                              tooltip_text="Heatmap")
+        self.unzoomButton = Gtk.Button(icon_name="zoom-out-symbolic", visible=False,
+                                       tooltip_text="Back to history")
+        self.unzoomButton.connect('clicked', lambda *a: self.set_zoom(None))
+        header = Gtk.Box()
+        header.append(self.title)
+        header.append(self.unzoomButton)
+        header.append(self.heatmapToggle)
         self.canvas = Gtk.DrawingArea(hexpand=True, vexpand=True)
+        self.heatmapToggle.connect('toggled', self.on_heatmap_toggled)
+        self.connect('notify::darkStyle', self.on_style_changed)
+        self.heatmapToggle.set_active(self.config.getboolean(
+            'heatmap', fallback=len(self.sensors()) >= HEATMAP_SENSORS))
 
         ctrl = Gtk.EventControllerMotion()
         ctrl.connect('motion', self.on_motion)
@@ -169,22 +289,87 @@ class PlotCanvas(Gtk.Box):
         gesture.connect('released', self.on_click_released)
         self.canvas.add_controller(gesture)
 
-        self.canvas.set_draw_func(self.draw, None)
+        monitor.instrument(self.canvas, self.draw, "Plot {}".format(unit.title()),
+                           lambda: self.vertices)
 
-        self.append(self.title)
+        self.append(header)
         self.append(self.canvas)
     
     def format_title(self):
+        title = self.unit.title()
+        if self.zoom is not None:
+            title += "  {}/{} {}, {:.1f}s".format(
+                self.zoom.sensor.device.name, self.zoom.sensor.name, self.zoom.reason,
+                self.zoom.end - self.zoom.start)
         if self._value_min is None or self._value_max is None:
-            self.title.set_markup("<b>{}</b>".format(self.unit.title()))
-        else:
-            self.title.set_markup("<b>{}</b>  Min: {} Max: {}".format(
-                self.unit.title(), self.unit.format_value(self._value_min),
-                self.unit.format_value(self._value_max)))
+            self.title.set_markup("<b>{}</b>".format(title))
+            return
+        markup = "<b>{}</b>  Min: {} Max: {}".format(
+            title, self.unit.format_value(self._value_min),
+            self.unit.format_value(self._value_max))
+        if self.zoom is not None:
+            self.title.set_markup(markup)
+            return
+        self.title.set_markup(markup + self.summary())
+
+    def summary(self) -> str:
+        """Percentiles and energy totals of the plotted sensors over the
+        window. Merging the sketches is proportional to the window, so it is
+        redone only every `SUMMARY_INTERVAL` seconds or when the sensors or
+        window change."""
+        sensors = self.sensors()
+        key = (tuple(sensors), self.plotSeconds)
+        now = monotonic_s()
+        if key == self._summary_key and now - self._summary_time < SUMMARY_INTERVAL:
+            return self._summary
+        self._summary_key, self._summary_time = key, now
+        markup = ""
+        stats = getattr(self.history, 'stats', None)
+        sketch = stats and stats.window(sensors, self.plotSeconds, now)
+        if sketch and sketch.n:
+            markup += "  p50: {} p95: {} p99: {}".format(
+                *(self.unit.format_value(sketch.percentile(q)) for q in (50, 95, 99)))
+        # Totals of the plotted energy counters, see `thermals.energy`
+        energy = getattr(self.history, 'energy', None)
+        counted = [s for s in sensors if hasattr(s, 'counter')]
+        totals = energy.totals(counted) if energy and counted else None
+        if totals:
+            markup += "  Energy: {:.2f} Wh this hour, {:.1f} Wh today".format(*totals)
+            average = energy.watts(counted, self.plotSeconds, monotonic_ns())
+            if average is not None:
+                markup += ", avg {}".format(self.unit.format_value(average))
+        self._summary = markup
+        return markup
     
     def do_draw(self):
         #self._history_resolution = None
+        if self.heatmap is not None:
+            # Once per tick, drawing only paints the image
+            self.update_heatmap()
         self.canvas.queue_draw()
+
+    def create_heatmap(self):
+        return Heatmap((0.1, 0.12, 0.12) if self.darkStyle else (0.964, 0.96, 0.913))
+
+    def on_style_changed(self, *args):
+        # Empty cells are painted in the background of the style
+        if self.heatmap is not None:
+            self.heatmap = self.create_heatmap()
+            self.canvas.queue_draw()
+
+    def on_heatmap_toggled(self, toggle):
+        if toggle.get_active():
+            self.heatmap = self.create_heatmap()
+        else:
+            self.heatmap = None
+        if toggle.get_active() != self.config.getboolean('heatmap', fallback=None):
+            self.config['heatmap'] = str(toggle.get_active())
+            self.config.write()
+        self.canvas.queue_draw()
+
+    def update_heatmap(self):
+        self.heatmap.update(self.history, self.sensors(), self.history_resolution,
+                            self.plotSeconds, monotonic_s())
     
     def sensors(self) -> list[Sensor]:
         return list(self.hwmon.get_sensors(plot=True, unit=self.unit.value))
@@ -195,7 +380,7 @@ class PlotCanvas(Gtk.Box):
             return self._history_resolution
         else:
             for res in self.history.resolutions:
-                pxPerMs = self.get_width() / (self.plotSeconds / res)
+                pxPerMs = self._size[0] / (self.plotSeconds / res)
                 if pxPerMs < 1.5:
                     continue
                 print("History resolution selected: {} {}px/ms".format(res, pxPerMs))
@@ -205,9 +390,64 @@ class PlotCanvas(Gtk.Box):
             return self._history_resolution
             
     def data(self, sensor):
+        if self.zoom is not None:
+            return self.zoom_data(sensor)
         return self.history.sensors[sensor][self.history_resolution]
 
+    def zoom_data(self, sensor):
+        """The capture's samples for its sensor, the finest history
+        around it for the others"""
+        if sensor is self.zoom.sensor:
+            return self.zoom.samples
+        t_min, t_max = self.zoom.start - 1, self.zoom.end + 1
+        series = self.history.sensors[sensor][self.history.resolutions[0]]
+        recent = list(takewhile(lambda m: m.time >= t_min, reversed(series)))
+        return [m for m in reversed(recent) if m.time <= t_max]
+
+    def captures(self):
+        sensors = self.sensors()
+        return [capture for capture in getattr(self.history, 'captures', ())
+                if capture.sensor in sensors]
+
+    def set_zoom(self, capture):
+        """Show `capture` instead of the history, None to go back"""
+        self.zoom = capture
+        self.unzoomButton.set_visible(capture is not None)
+        self.clear_min_max()
+        self.canvas.queue_draw()
+
+    def capture_at(self, x, y):
+        """Capture whose marker is at `x`, `y`, or None"""
+        w, h = self._size
+        if self.zoom is not None or not w or self._time_min is None or y > MARKER_SIZE * 2:
+            return None
+        for capture in reversed(self.captures()):
+            cx = w * (capture.trigger_time - self._time_min) / (self._time_max - self._time_min)
+            if abs(cx - x) <= MARKER_SIZE:
+                return capture
+        return None
+
+    def draw_captures(self, c, translate_x, h):
+        """Shade captured spans and mark their triggers at the top"""
+        for capture in self.captures():
+            if capture.end < self._time_min or capture.start > self._time_max:
+                continue
+            x0, x1 = translate_x(capture.start), translate_x(capture.end)
+            c.set_source_rgba(*capture.sensor.RGB_triple(), 0.15)
+            c.rectangle(x0, 0, max(x1 - x0, 1), h)
+            c.fill()
+            x = translate_x(capture.trigger_time)
+            c.set_source_rgb(*capture.sensor.RGB_triple())
+            c.move_to(x - MARKER_SIZE, 0)
+            c.line_to(x + MARKER_SIZE, 0)
+            c.line_to(x, MARKER_SIZE * 1.5)
+            c.close_path()
+            c.fill()
+
     def draw(self, area, c, w, h, data):
+        if self._size[0] != w:
+            self._history_resolution = None
+        self._size = (w, h)
         if self.darkStyle:
             bg_color = (0.1, 0.12, 0.12)
             fg_color = (0.3, 0.3, 0.3)
@@ -219,21 +459,35 @@ class PlotCanvas(Gtk.Box):
         c.paint()
 
         # time window that we are plotting
-        t_min = monotonic_s() - self.plotSeconds
-        t_max = monotonic_s()
+        if self.zoom is not None:
+            t_min, t_max = self.zoom.start, self.zoom.end
+        else:
+            t_min = monotonic_s() - self.plotSeconds
+            t_max = monotonic_s()
         self._time_min = t_min
         self._time_max = t_max
 
+        # Time -> Canvas x coord
+        def translate_x(time: float) -> float:
+            return w * ((time - t_min) / (t_max - t_min))
+
+        if self.heatmap is not None and self.zoom is None:
+            if self._value_min is None or self._value_max is None:
+                self.scan_min_max(t_min)
+            if self.heatmap.key is None:
+                self.update_heatmap()
+            self.heatmap.draw(c, w, h)
+            self.draw_captures(c, translate_x, h)
+            self.vertices = 0
+            self.format_title()
+            return
+
         # The value range that we are plotting. Then add _
         if self._value_min is None or self._value_max is None:
             self.scan_min_max(t_min)
         v_min = self._value_min - (self._value_max - self._value_min) * self._viewport_margin
         v_max = self._value_max + (self._value_max - self._value_min) * self._viewport_margin
 
-        # Time -> Canvas x coord
-        def translate_x(time: float) -> float:
-            return w * ((time - t_min) / (t_max - t_min))
-        
         # Sensor value -> Canvas y coord
         def translate_y(value: float) -> float:
             return h * (1 - ((value - v_min) / (v_max - v_min)))
@@ -256,17 +510,44 @@ class PlotCanvas(Gtk.Box):
             c.stroke()
         c.set_dash([])
 
+        if self.zoom is None:
+            self.draw_captures(c, translate_x, h)
+        else:
+            c.set_source_rgb(*self.zoom.sensor.RGB_triple())
+            c.set_line_width(1)
+            c.set_dash([2, 4])
+            c.move_to(translate_x(self.zoom.trigger_time), 0)
+            c.line_to(translate_x(self.zoom.trigger_time), h)
+            c.stroke()
+            c.set_dash([])
+
+        # Values before the filters, faint and under the filtered lines
+        raw = getattr(self.history, 'raw', None)
+        vertices = 0
+        if self.showRaw and raw and self.zoom is None:
+            c.set_line_width(1)
+            for sensor in self.sensors():
+                if sensor not in raw:
+                    continue
+                line = list(points(raw[sensor][self.history_resolution], t_min))
+                if not line:
+                    continue
+                c.set_source_rgba(*sensor.RGB_triple(), 0.35)
+                c.move_to(translate_x(line[0][0]), translate_y(line[0][1]))
+                for (t, v) in line[1:]:
+                    c.line_to(translate_x(t), translate_y(v))
+                c.stroke()
+                vertices += len(line)
+
         # Draw sensors
         c.set_line_width(2)
         lines_drawn = 0
         for sensor in self.sensors():
-            hiter = takewhile(lambda h: h.time > t_min, reversed(self.data(sensor)))
+            hiter = points(self.data(sensor), t_min)
             
             c.set_source_rgb(*sensor.RGB_triple())
             try:
-                b = next(hiter)
-                v0 = b.value
-                t0 = b.time
+                (t0, v0) = next(hiter)
             except StopIteration:
                 continue
 
@@ -276,12 +557,11 @@ class PlotCanvas(Gtk.Box):
                 self._value_max = v0
         
             c.move_to(translate_x(t0), translate_y(v0))
-            for b in hiter:
-                t = b.time
-                v = b.value
+            for (t, v) in hiter:
                 c.line_to(translate_x(t), translate_y(v))
                 lines_drawn += 1
             c.stroke()
+        self.vertices = vertices + lines_drawn
         self.format_title()
     
     def clear_min_max(self):
@@ -295,10 +575,10 @@ class PlotCanvas(Gtk.Box):
             self._value_min = 0
         else:
             self._value_min = min(values(
-                [takewhile(lambda h: h.time >= t_min, reversed(self.data(s))) for s in sensors]
+                [takewhile(lambda h: h.time_end >= t_min, reversed(self.data(s))) for s in sensors]
                 ))
         self._value_max = max(values(
-            [takewhile(lambda h: h.time >= t_min, reversed(self.data(s))) for s in sensors]
+            [takewhile(lambda h: h.time_end >= t_min, reversed(self.data(s))) for s in sensors]
             ))
         if self._value_min >= self._value_max:
             # Add some space when there is no/one value
@@ -307,8 +587,15 @@ class PlotCanvas(Gtk.Box):
     
     @time_it("Coord to Sensor value")
     def get_info_at_coord(self, x, y, radius=25, multiple=False):
-        h = self.canvas.get_height()
-        w = self.canvas.get_width()
+        w, h = self._size
+        if not w or not h or self._time_min is None:
+            return [] if multiple else (None, None, None)
+        if self.heatmap is not None and self.zoom is None:
+            # One cell per sensor and step, no distance search
+            (sensor, time, value) = self.heatmap.lookup(x, y, w, h)
+            if multiple:
+                return [] if sensor is None else [(0, sensor, time, value)]
+            return (sensor, time, value)
 
         v_min = self._value_min - (self._value_max-self._value_min) * self._viewport_margin
         v_max = self._value_max + (self._value_max-self._value_min) * self._viewport_margin
@@ -321,10 +608,11 @@ class PlotCanvas(Gtk.Box):
 
         line_distances = []
         for sensor in self.sensors():
-            hiter = dropwhile(lambda h: h.time < t, self.data(sensor))
+            hiter = dropwhile(lambda h: h.time_end < t, self.data(sensor))
             try:
                 b = next(hiter)
-                st = b.time
+                # Within a run, its value at `t`
+                st = max(b.time, t)
                 sv = b.value
                 if abs(st-t) > radius_t or abs(v-sv) > radius_v:
                     continue
@@ -340,6 +628,11 @@ class PlotCanvas(Gtk.Box):
             return sensor, time, value
         
     def on_motion(self, ctrl, x, y):
+        capture = self.capture_at(x, y)
+        if capture is not None:
+            self.set_tooltip_text("{}/{} {}, click to zoom in".format(
+                capture.sensor.device.name, capture.sensor.name, capture.reason))
+            return
         sensors = self.get_info_at_coord(x, y, multiple=True)
         if sensors:
             self.set_tooltip_text("\n".join(
@@ -353,6 +646,10 @@ class PlotCanvas(Gtk.Box):
             # `n_press` is "number of presses with this release" which will increase
             # for each press, so we ignore subsequent presses here
             return
+        capture = self.capture_at(x, y)
+        if capture is not None:
+            self.set_zoom(capture)
+            return
         (sensor, time, value) = self.get_info_at_coord(x, y)
         if sensor:
             self.app.select_sensor(sensor)
\ No newline at end of file
@@ -0,0 +1,289 @@
+"""Query the archive from a shell: `thermals query` or `python -m thermals.query`.
+
+    thermals query --from 02:00 --to 03:00 --label 'Core*' --bucket 60 --agg max
+    thermals query --from -7d --device coretemp.0 --above 90 --format json
+
+Only chunks overlapping the time range are opened, and records are located
+by bisecting. Buckets are aggregated one at a time and written as soon as
+they are complete, so memory stays bounded by one chunk. Percentiles are
+interpolated within the histogram bins of `thermals.stats`, like the
+statistics panel. NumPy is used when available.
+"""
+import argparse
+import csv
+import json
+import math
+import re
+import sys
+from datetime import datetime, time as dtime
+from fnmatch import fnmatchcase
+from time import time
+
+from thermals.archive import Chunk, list_chunks, directory_from_config, np
+from thermals.config import Config
+from thermals.stats import Sketch, BIN_WIDTH
+from thermals.utils import Unit
+
+# A sample counts towards time above threshold for at most this many
+# seconds, longer gaps mean nothing was recorded
+MAX_GAP = 60
+RELATIVE = re.compile(r"^-(\d+(?:\.\d+)?)([smhd])$")
+SECONDS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+def parse_time(text, now) -> float:
+    """Epoch seconds of `now`, `-90m`, `02:00` (today), an ISO date or
+    time, or a number of seconds since the epoch"""
+    if text == "now":
+        return now
+    match = RELATIVE.match(text)
+    if match:
+        return now - float(match.group(1)) * SECONDS[match.group(2)]
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    try:
+        return datetime.combine(datetime.fromtimestamp(now).date(),
+                                dtime.fromisoformat(text)).timestamp()
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(text).timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError("Invalid time {!r}".format(text))
+
+class Aggregate:
+    """Aggregates of one sensor in one bucket"""
+    __slots__ = ('column', 'sketch', 'above')
+
+    def __init__(self, column):
+        self.column = column
+        self.sketch = Sketch(BIN_WIDTH.get(Unit[column['unit']], 1))
+        self.above = 0.0
+
+    def result(self, aggregations):
+        sketch = self.sketch
+        values = {}
+        for agg in aggregations:
+            if agg == 'min':
+                values[agg] = sketch.min if sketch.n else None
+            elif agg == 'max':
+                values[agg] = sketch.max if sketch.n else None
+            elif agg == 'mean':
+                values[agg] = sketch.mean if sketch.n else None
+            elif agg == 'count':
+                values[agg] = sketch.n
+            elif agg.startswith('p'):
+                values[agg] = sketch.percentile(float(agg[1:]))
+        return values
+
+class Query:
+    def __init__(self, start, end, bucket=None, devices=None, labels=None,
+                 aggregations=("min", "max", "mean"), above=None):
+        self.start = start
+        self.end = end
+        self.bucket = bucket
+        self.devices = devices
+        self.labels = labels
+        self.aggregations = aggregations
+        self.percentiles = any(agg.startswith('p') for agg in aggregations)
+        self.above = above
+        self.current = None
+        self.aggregates = {}
+
+    def selects(self, column) -> bool:
+        if self.devices and not any(fnmatchcase(column['device'], d) for d in self.devices):
+            return False
+        if self.labels and not any(fnmatchcase(column['label'], l) or
+                                   fnmatchcase(column['measurement'], l) for l in self.labels):
+            return False
+        return True
+
+    def bucket_of(self, t):
+        if self.bucket is None:
+            return self.start
+        return self.start + (t - self.start) // self.bucket * self.bucket
+
+    def run(self, directory):
+        """Yield (bucket start, column, aggregates) ordered by time"""
+        for (hour, path) in list_chunks(directory, self.start, self.end):
+            chunk = Chunk(path)
+            selected = [i for (i, c) in enumerate(chunk.columns) if self.selects(c)]
+            if selected and len(chunk):
+                first, last = chunk.search(self.start), chunk.search(self.end)
+                if first < last:
+                    if np is not None:
+                        yield from self.scan_numpy(chunk, selected, first, last)
+                    else:
+                        yield from self.scan(chunk, selected, first, last)
+            chunk.close()
+        yield from self.flush()
+
+    def enter(self, bucket):
+        """Start `bucket`, yielding the results of the previous one"""
+        if bucket != self.current:
+            yield from self.flush()
+            self.current = bucket
+
+    def flush(self):
+        for (key, aggregate) in self.aggregates.items():
+            yield (self.current, aggregate.column, aggregate)
+        self.aggregates = {}
+
+    def aggregate(self, column):
+        aggregate = self.aggregates.get(column['key'])
+        if aggregate is None:
+            aggregate = self.aggregates[column['key']] = Aggregate(column)
+        return aggregate
+
+    def scan(self, chunk, selected, first, last):
+        """Pure Python, one value at a time"""
+        columns = [chunk.columns[i] for i in selected]
+        previous, dt = None, 0
+        # One record past the range, for the interval of the last one
+        for row in chunk.rows(first, last + 1 if last < len(chunk) else last):
+            if previous is not None:
+                dt = row[0] - previous[0]
+                yield from self.add_row(previous, dt, selected, columns)
+            previous = row
+        if previous is not None and previous[0] < self.end:
+            # Last record of the chunk, assume the interval before it
+            yield from self.add_row(previous, dt, selected, columns)
+
+    def add_row(self, row, dt, selected, columns):
+        yield from self.enter(self.bucket_of(row[0]))
+        dt = min(max(dt, 0), MAX_GAP)
+        for (i, column) in zip(selected, columns):
+            value = row[i + 1]
+            if math.isnan(value):
+                continue
+            aggregate = self.aggregate(column)
+            aggregate.sketch.add(value)
+            if self.above is not None and value > self.above:
+                aggregate.above += dt
+
+    def scan_numpy(self, chunk, selected, first, last):
+        """All selected columns of a bucket at once"""
+        records = chunk.array(first, min(last + 1, len(chunk)))
+        times = records['time']
+        dt = np.clip(np.diff(times), 0, MAX_GAP)
+        if len(dt) < last - first:
+            # Last record of the chunk, assume the interval before it
+            dt = np.append(dt, dt[-1] if len(dt) else 0)
+        times = times[:last - first]
+        values = records['values'][:last - first][:, selected].astype(np.float64)
+        columns = [chunk.columns[i] for i in selected]
+        widths = np.array([BIN_WIDTH.get(Unit[c['unit']], 1) for c in columns])
+
+        if self.bucket is None:
+            splits = [0, len(times)]
+        else:
+            ids = (times - self.start) // self.bucket
+            splits = [0] + list(np.flatnonzero(np.diff(ids)) + 1) + [len(times)]
+        for (a, b) in zip(splits, splits[1:]):
+            yield from self.enter(self.bucket_of(times[a]))
+            segment = values[a:b]
+            valid = ~np.isnan(segment)
+            n = valid.sum(axis=0)
+            mean = np.where(n > 0, np.nansum(segment, axis=0) / np.maximum(n, 1), 0)
+            m2 = np.nansum((segment - mean) ** 2, axis=0)
+            low = np.where(valid, segment, np.inf).min(axis=0)
+            high = np.where(valid, segment, -np.inf).max(axis=0)
+            if self.above is not None:
+                above = ((np.where(valid, segment, -np.inf) > self.above) * dt[a:b, None]).sum(axis=0)
+            if self.percentiles:
+                bins = np.floor(segment / widths)
+            for j in np.flatnonzero(n):
+                part = Sketch(widths[j])
+                part.n = int(n[j])
+                part.mean = float(mean[j])
+                part.m2 = float(m2[j])
+                part.min = float(low[j])
+                part.max = float(high[j])
+                if self.percentiles:
+                    keys, counts = np.unique(bins[valid[:, j], j], return_counts=True)
+                    part.bins = dict(zip(keys.astype(int).tolist(), counts.tolist()))
+                aggregate = self.aggregate(columns[j])
+                aggregate.sketch.merge(part)
+                if self.above is not None:
+                    aggregate.above += float(above[j])
+
+FIELDS = ["time", "device", "measurement", "label"]
+
+def format_time(t):
+    return datetime.fromtimestamp(t).isoformat(timespec='seconds')
+
+def write(results, query, output, format):
+    fields = FIELDS + list(query.aggregations) + (["above_s"] if query.above is not None else [])
+    writer = None
+    if format == "csv":
+        writer = csv.writer(output)
+        writer.writerow(fields)
+    for (bucket, column, aggregate) in results:
+        row = {
+            'time': format_time(bucket),
+            'device': column['device'],
+            'measurement': column['measurement'],
+            'label': column['label'],
+        }
+        for (agg, value) in aggregate.result(query.aggregations).items():
+            # Values are stored as 32 bit floats
+            row[agg] = round(value, 3) if isinstance(value, float) else value
+        if query.above is not None:
+            row['above_s'] = round(aggregate.above, 3)
+        if writer:
+            writer.writerow(["" if row[f] is None else row[f] for f in fields])
+        else:
+            output.write(json.dumps(row) + "\n")
+
+def main(argv=None):
+    now = time()
+    parser = argparse.ArgumentParser(prog="thermals query",
+                                     description="Aggregate recorded sensor values")
+    parser.add_argument("--from", dest="start", default="-1h",
+                        help="start: now, -90m, -2h, -7d, HH:MM, ISO date/time or epoch (default -1h)")
+    parser.add_argument("--to", dest="end", default="now", help="end, same formats as --from")
+    parser.add_argument("--device", action="append", help="device id glob, may be repeated")
+    parser.add_argument("--label", action="append",
+                        help="sensor label or measurement glob, may be repeated")
+    parser.add_argument("--bucket", type=float, help="seconds per bucket (default: one bucket)")
+    parser.add_argument("--agg", default="min,max,mean",
+                        help="comma separated: min, max, mean, count, pNN (default min,max,mean)")
+    parser.add_argument("--above", type=float, help="also report seconds above this value")
+    parser.add_argument("--format", choices=["csv", "json"], default="csv",
+                        help="csv or JSON lines (default csv)")
+    parser.add_argument("--archive", help="archive directory (default from thermals.ini)")
+    args = parser.parse_args(argv)
+
+    aggregations = [agg.strip() for agg in args.agg.split(",") if agg.strip()]
+    for agg in aggregations:
+        if agg not in ("min", "max", "mean", "count") and not re.match(r"^p\d+(\.\d+)?$", agg):
+            parser.error("Unknown aggregation {!r}".format(agg))
+    try:
+        start, end = parse_time(args.start, now), parse_time(args.end, now)
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
+    if args.bucket is not None and args.bucket <= 0:
+        parser.error("--bucket must be positive")
+
+    if args.archive:
+        directory = args.archive
+    else:
+        config = Config()
+        config.read()
+        directory = directory_from_config(config)
+
+    query = Query(start, end, bucket=args.bucket, devices=args.device, labels=args.label,
+                  aggregations=aggregations, above=args.above)
+    try:
+        write(query.run(directory), query, sys.stdout, args.format)
+    except FileNotFoundError:
+        print("No archive in {}, enable it in the [archive] section of thermals.ini"
+              .format(directory), file=sys.stderr)
+        return 1
+    except BrokenPipeError:
+        pass
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
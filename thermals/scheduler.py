@@ -0,0 +1,95 @@
+"""Sampling timer with a low-wakeup background mode.
+
+In the foreground the callback runs every `interval` milliseconds. In the
+background it runs every `background_interval` seconds through
+`GLib.timeout_add_seconds`, which lets GLib coalesce the wakeup with
+other second-granularity timers of the process and the system.
+
+With `--power-report` the wakeups per second and CPU time per hour of each
+mode are printed when the mode changes and on exit.
+"""
+import resource
+import sys
+from time import monotonic
+
+from gi.repository import GLib
+
+class ModeStats:
+    """Wakeups and CPU time spent in one mode"""
+    def __init__(self):
+        self.wakeups = 0
+        self.seconds = 0.0
+        self.cpu = 0.0
+
+    def rate(self):
+        if not self.seconds:
+            return (0.0, 0.0)
+        return (self.wakeups / self.seconds, self.cpu / self.seconds * 3600)
+
+def cpu_time() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+class Scheduler:
+    def __init__(self, callback, interval, background_interval):
+        self.callback = callback
+        self.interval = interval
+        self.background_interval = background_interval
+        self.background = False
+        self.running = False
+        self.source = None
+        self.report = "--power-report" in sys.argv
+        self.stats = {False: ModeStats(), True: ModeStats()}
+        self._since = monotonic()
+        self._cpu_since = cpu_time()
+
+    def start(self):
+        self.running = True
+        if self.source is not None:
+            GLib.source_remove(self.source)
+        if self.background:
+            self.source = GLib.timeout_add_seconds(self.background_interval, self.on_timeout)
+        else:
+            self.source = GLib.timeout_add(self.interval, self.on_timeout)
+
+    def on_timeout(self):
+        self.stats[self.background].wakeups += 1
+        self.callback()
+        return GLib.SOURCE_CONTINUE
+
+    def set_background(self, background):
+        if background == self.background:
+            return
+        self.account()
+        if self.report:
+            self.print_report()
+        self.background = background
+        if not self.running:
+            # Picked up by `start`
+            return
+        self.start()
+        if not background:
+            # Catch up right away when coming back to the foreground
+            self.callback()
+
+    def account(self):
+        now, cpu = monotonic(), cpu_time()
+        stats = self.stats[self.background]
+        stats.seconds += now - self._since
+        stats.cpu += cpu - self._cpu_since
+        self._since, self._cpu_since = now, cpu
+
+    def print_report(self):
+        for (background, stats) in self.stats.items():
+            wakeups, cpu = stats.rate()
+            print("{:<10} {:8.0f}s {:8.3f} wakeups/s {:8.2f} CPU s/h".format(
+                "background" if background else "foreground", stats.seconds, wakeups, cpu))
+
+    def stop(self):
+        self.account()
+        if self.report:
+            self.print_report()
+        self.running = False
+        if self.source is not None:
+            GLib.source_remove(self.source)
+            self.source = None
@@ -1,17 +1,80 @@
-from gi.repository import GObject, Gdk
+from gi.repository import GObject, Gdk, GLib
 
+import math
 from time import monotonic_ns
 
 from thermals.utils import Unit, monotonic_s
+from thermals.filters import parse_chain
+
+# Seconds a sensor isn't read after a failed read, doubled with every
+# further failure up to `MAX_BACKOFF`
+BACKOFF = 1
+MAX_BACKOFF = 300
+# A sensor spends at most 1/READ_BUDGET of the time being read, slower
+# reads delay the next one
+READ_BUDGET = 50
+
+class ReadLatency:
+    """Running mean and deviation of a sensor's read durations, counting
+    the reads far slower than usual"""
+    ALPHA = 0.1
+    # Reads before outliers are counted
+    WARMUP = 10
+    # Deviations above the mean, and milliseconds, a read must exceed to count
+    DEVIATIONS = 4
+    MIN_MS = 1
+
+    def __init__(self):
+        self.reads = 0
+        self.mean = 0.0
+        self.var = 0.0
+        self.max = 0.0
+        self.outliers = 0
+
+    def add(self, ms) -> bool:
+        """Add a read, True if it was an outlier"""
+        outlier = self.reads >= self.WARMUP and ms > self.MIN_MS and \
+            ms > self.mean + self.DEVIATIONS * math.sqrt(self.var)
+        if outlier:
+            self.outliers += 1
+        if self.reads == 0:
+            self.mean = ms
+        else:
+            diff = ms - self.mean
+            self.mean += self.ALPHA * diff
+            self.var = (1 - self.ALPHA) * (self.var + self.ALPHA * diff * diff)
+        self.reads += 1
+        self.max = max(self.max, ms)
+        return outlier
 
 class Sensor(GObject.Object):
     name = GObject.Property(type=str)
     #value = GObject.Property(type=int)
     valueStr = GObject.Property(type=str)
-    time = GObject.Property(type=int)
     plot = GObject.Property(type=bool, default=False)
     color = GObject.Property(type=Gdk.RGBA)
     unit = GObject.Property(type=int)
+    # Set by the first `refresh`. Plain attributes rather than properties,
+    # they change on every tick and nothing binds to them.
+    value = None
+    time = None
+    # `monotonic_ns` before the last read, for latency measurements
+    read_ns = None
+    # The value before `filters`, see `thermals.filters`
+    raw = None
+    filters = None
+    # Whether `get_value` may be called between refreshes, by
+    # `thermals.trigger`. Not for sensors computing rates from the last read.
+    sampleable = True
+    # Why there is no value, shown instead of it: "suspended" while the
+    # device is runtime suspended, "error" after a failed read
+    state = None
+    # Consecutive failed reads, and the `monotonic_ns` before which
+    # `refresh` doesn't read, see `due`
+    failures = 0
+    due_ns = 0
+    # `ReadLatency` of `refresh`, created by the first read
+    latency = None
 
     def __init__(self, name, config):
         super().__init__()
@@ -21,9 +84,10 @@ class Sensor(GObject.Object):
         self.color = Gdk.RGBA()
         self.color.parse(config['color'])
         self.plot = config.getboolean('plot')
-
-        self.value = self.get_value()
-        self.format_valueStr()
+        try:
+            self.filters = parse_chain(config.get('filter'))
+        except ValueError as e:
+            print("Ignoring filter of {}: {}".format(name, e))
 
         self.connect('notify::plot', self.on_plot)
     
@@ -33,16 +97,84 @@ class Sensor(GObject.Object):
     def get_value(self):
         raise NotImplementedError
     
-    def format_valueStr(self):
+    def format_value(self) -> str:
         raise NotImplementedError
+
+    def format_valueStr(self) -> bool:
+        """Update `valueStr`, only notifying when the text changed"""
+        text = self.state if self.state is not None else self.format_value()
+        if text == self.valueStr:
+            return False
+        self.valueStr = text
+        return True
+
+    def limit(self, attr):
+        """Limit `attr` ("min", "max", "crit") the driver exposes, or None"""
+        return None
+
+    def alarm(self):
+        """State of the driver's alarm flag, or None if there is none"""
+        return None
     
+    def due(self, now_ns) -> bool:
+        """Whether `refresh` should read, False while backing off"""
+        return now_ns >= self.due_ns
+
     def refresh(self):
-        #t0 = monotonic_ns()
-        self.value = self.get_value()
+        """Read and `update`. Failed reads back off exponentially and slow
+        reads are spaced out, see `BACKOFF` and `READ_BUDGET`."""
+        read_ns = monotonic_ns()
+        try:
+            value = self.get_value()
+        except (GLib.Error, OSError, ValueError) as e:
+            self.failed(read_ns, e)
+            return
+        ms = (monotonic_ns() - read_ns) / 1000000
+        if self.latency is None:
+            self.latency = ReadLatency()
+        if self.latency.add(ms):
+            print("Reading {} took {:.1f}ms, usually {:.1f}ms".format(
+                self.name, ms, self.latency.mean))
+        self.due_ns = read_ns + int(self.latency.mean * 1000000 * READ_BUDGET)
+        if self.failures:
+            print("Reading {} works again after {} failures".format(self.name, self.failures))
+            self.failures = 0
+        self.update(value, read_ns)
+
+    def failed(self, read_ns, error):
+        """Clear the value and skip reads for a growing while"""
+        backoff = min(BACKOFF * 2 ** self.failures, MAX_BACKOFF)
+        if self.failures == 0 or backoff < MAX_BACKOFF:
+            print("Reading {} failed: {}, retrying in {}s".format(self.name, error, backoff))
+        self.failures += 1
+        self.due_ns = read_ns + backoff * 1000000000
+        self.clear("error", read_ns)
+
+    def suspend(self, read_ns):
+        """Skip a read because the device is runtime suspended, reading
+        would wake it up"""
+        self.clear("suspended", read_ns)
+
+    def clear(self, state, read_ns):
+        self.update(None, read_ns)
+        self.state = state
+
+    def update(self, value, read_ns):
+        """Store a value read at `read_ns`, by `refresh` or by a source
+        reading many sensors at once"""
+        self.state = None
+        self.read_ns = read_ns
+        self.raw = value
+        if self.filters is not None and value is not None:
+            value = self.filters.apply(value, read_ns / 1000000000)
+        self.value = value
         self.time = monotonic_s()
-        self.format_valueStr()
-        #t1 = monotonic_ns()
-        #print("Sensor {} refresh took {} ns".format(self.name, t1-t0))
+
+    def set_filter(self, spec):
+        """Replace the filter chain, raises ValueError for invalid `spec`"""
+        self.filters = parse_chain(spec)
+        self.config['filter'] = spec or ""
+        self.config.write()
     
     def set_color_rgba(self, color: Gdk.RGBA):
         self.color = color
@@ -0,0 +1,389 @@
+from collections import OrderedDict
+
+from gi.repository import Gtk, GObject, Gio, GLib, Pango
+
+from thermals.utils import Unit, monotonic_s, time_it
+from thermals.sensor import Sensor
+from thermals import sparkline
+
+# Sparklines kept for rows that were scrolled out of view
+SPARKLINES_CACHED = 256
+
+class SensorView(Gtk.Box):
+    """One virtualized tree of all devices and their sensors.
+
+    Devices are the top level of a `Gtk.TreeListModel` whose children are
+    the devices' sensor stores. Rows are sorted by the ColumnView's sorter
+    and filtered by text and unit; only rows on screen are realized.
+    """
+    def __init__(self, app, hwmon):
+        super().__init__(orientation=Gtk.Orientation.VERTICAL)
+        self.app = app
+        self.hwmon = hwmon
+        self._update_queued = False
+        # While filtering, devices are expanded without persisting it
+        self._filtering = False
+        self._filter_text = ""
+
+        # Filter controls
+        self.search = Gtk.SearchEntry(placeholder_text="Filter sensors", hexpand=True)
+        self.search.connect('search-changed', self.on_search_changed)
+        self.units = [None] + list(Unit)
+        self.unitSelector = Gtk.DropDown.new_from_strings(
+            ["All"] + [unit.title() for unit in self.units[1:]])
+        self.unitSelector.connect('notify::selected', self.on_unit_selected)
+        filterBox = Gtk.Box(spacing=6, margin_start=6, margin_end=6, margin_top=6, margin_bottom=6)
+        self.config = app.config['sensorview']
+        self.sparkToggle = Gtk.ToggleButton(icon_name="utilities-system-monitor-symbolic",
+                                            tooltip_text="Trends of the last minutes",
+                                            active=self.config.getboolean('sparklines',
+                                                                          fallback=False))
+        filterBox.append(self.search)
+        filterBox.append(self.unitSelector)
+        filterBox.append(self.sparkToggle)
+        self.append(filterBox)
+
+        # Models: devices -> tree -> sort -> filter -> selection
+        self.devices = Gio.ListStore(item_type=GObject.Object)
+        # (store, handler id) of the watched sensors, keyed by sensor
+        self.watched = {}
+        for device in hwmon.devices:
+            self.devices.append(device)
+            # Plots are recreated when a sensor is (un)ticked. Connected
+            # here once per sensor rather than per bound row.
+            for sensor in device.store:
+                self.watch_sensor(sensor, device.store)
+            device.store.connect('items-changed', self.on_items_changed)
+        self.tree = Gtk.TreeListModel.new(self.devices, False, False, self.create_children)
+
+        self.view = Gtk.ColumnView(vexpand=True)
+        self.rowSorter = Gtk.TreeListRowSorter.new(self.view.get_sorter())
+        self.sortModel = Gtk.SortListModel(model=self.tree, sorter=self.rowSorter)
+        self.filter = Gtk.CustomFilter.new(self.filter_row)
+        self.filterModel = Gtk.FilterListModel(model=self.sortModel, filter=self.filter,
+                                               incremental=True)
+        self.ss = Gtk.SingleSelection(autoselect=False, model=self.filterModel, can_unselect=True)
+        self.view.set_model(self.ss)
+
+        # Bindings and sensors of bound rows, released on unbind. Keyed by list item.
+        self.bindings = {}
+        self.bound = {}
+        # Sensors of bound sparkline cells, and sparklines by sensor,
+        # least recently shown first
+        self.sparkBound = {}
+        self.sparklines = OrderedDict()
+        self.colorDialog = Gtk.ColorDialog(with_alpha=False)
+        self.build_columns()
+
+        self.sparkColumn.set_visible(self.sparkToggle.get_active())
+        self.sparkToggle.connect('toggled', self.on_spark_toggled)
+
+        self.append(Gtk.ScrolledWindow(child=self.view, vexpand=True,
+                                       hscrollbar_policy=Gtk.PolicyType.NEVER))
+        self.restore_expanded()
+
+    def create_children(self, item, *args):
+        if isinstance(item, Sensor):
+            return None
+        return item.store
+
+    def restore_expanded(self):
+        for i in range(self.devices.get_n_items()):
+            row = self.tree.get_child_row(i)
+            device = row.get_item()
+            row.set_expanded(device.config_section.getboolean('expanded'))
+            row.connect('notify::expanded', self.on_row_expanded)
+
+    def on_row_expanded(self, row, _):
+        if self._filtering:
+            return
+        device = row.get_item()
+        device.config_section['expanded'] = str(row.get_expanded())
+        self.app.config.write()
+
+    def build_columns(self):
+        # Cell widgets are created once in `setup` and reused for whatever
+        # row they are bound to.
+        def setup_name(_, item):
+            expander = Gtk.TreeExpander()
+            box = Gtk.Box()
+            label = Gtk.Label(hexpand=True, xalign=0, ellipsize=Pango.EllipsizeMode.END)
+            detail = Gtk.Label(margin_end=10)
+            cfg = Gtk.Button.new_from_icon_name("preferences-system")
+            cfg.connect('clicked', lambda *a: item.get_item().get_item().configure(app=self.app))
+            box.append(label)
+            box.append(detail)
+            box.append(cfg)
+            # Secondary click edits the filters of a sensor
+            menu = Gtk.GestureClick(button=3)
+            menu.connect('pressed', lambda *a: self.edit_filter(item.get_item().get_item(), box))
+            box.add_controller(menu)
+            expander.set_child(box)
+            item.set_child(expander)
+
+        def bind_name(_, item):
+            row = item.get_item()
+            obj = row.get_item()
+            expander = item.get_child()
+            expander.set_list_row(row)
+            label = expander.get_child().get_first_child()
+            detail = label.get_next_sibling()
+            cfg = detail.get_next_sibling()
+            if isinstance(obj, Sensor):
+                detail.set_visible(False)
+                cfg.set_visible(obj.has_configuration())
+                self.bindings[item] = [obj.bind_property("name", label, "label",
+                                                         GObject.BindingFlags.SYNC_CREATE)]
+            else:
+                label.set_label(obj.name)
+                detail.set_markup("<small>{}</small>".format(obj.hwmonInstance))
+                detail.set_visible(True)
+                cfg.set_visible(False)
+
+        def setup_value(_, item):
+            item.set_child(Gtk.Label())
+
+        def bind_value(_, item):
+            obj = item.get_item().get_item()
+            if isinstance(obj, Sensor):
+                # The value may be stale, off-screen rows are not updated
+                obj.format_valueStr()
+                self.bound[item] = obj
+                self.bindings[item] = [obj.bind_property(
+                    "valueStr", item.get_child(), "label", GObject.BindingFlags.SYNC_CREATE)]
+            else:
+                item.get_child().set_label("")
+
+        def setup_plot(_, item):
+            check = Gtk.CheckButton()
+            color = Gtk.ColorDialogButton(dialog=self.colorDialog)
+            def on_rgba(*a):
+                sensor = item.get_item().get_item() if item.get_item() else None
+                if isinstance(sensor, Sensor) and not color.get_rgba().equal(sensor.color):
+                    sensor.set_color_rgba(color.get_rgba())
+            color.connect("notify::rgba", on_rgba)
+            box = Gtk.Box()
+            box.append(check)
+            box.append(color)
+            item.set_child(box)
+
+        def bind_plot(_, item):
+            obj = item.get_item().get_item()
+            box = item.get_child()
+            box.set_visible(isinstance(obj, Sensor))
+            if not isinstance(obj, Sensor):
+                return
+            check = box.get_first_child()
+            check.get_next_sibling().set_rgba(obj.color)
+            self.bindings[item] = [obj.bind_property("plot", check, "active",
+                                                     GObject.BindingFlags.BIDIRECTIONAL |
+                                                     GObject.BindingFlags.SYNC_CREATE)]
+
+        def setup_spark(_, item):
+            area = Gtk.DrawingArea(content_width=sparkline.MAX_COLUMNS,
+                                   content_height=sparkline.HEIGHT, valign=Gtk.Align.CENTER)
+            area.set_draw_func(lambda area, c, w, h, data: self.draw_sparkline(item, c, w, h))
+            item.set_child(area)
+
+        def bind_spark(_, item):
+            obj = item.get_item().get_item()
+            if isinstance(obj, Sensor):
+                self.sparkBound[item] = obj
+                if self.sparkColumn.get_visible():
+                    # Catches up on what happened while the row was hidden
+                    self.update_sparkline(item, obj)
+
+        def unbind(_, item):
+            self.bound.pop(item, None)
+            self.sparkBound.pop(item, None)
+            for binding in self.bindings.pop(item, []):
+                binding.unbind()
+
+        def teardown(_, item):
+            item.set_child(None)
+
+        def add_column(column_title, setup, bind, sorter=None, **kw):
+            factory = Gtk.SignalListItemFactory()
+            factory.connect('setup', setup)
+            factory.connect('bind', bind)
+            factory.connect('unbind', unbind)
+            factory.connect('teardown', teardown)
+            column = Gtk.ColumnViewColumn(title=column_title, factory=factory, sorter=sorter, **kw)
+            self.view.append_column(column)
+            return column
+
+        add_column("Name", setup_name, bind_name,
+                   sorter=Gtk.CustomSorter.new(self.compare_names), expand=True)
+        self.valueSorter = Gtk.CustomSorter.new(self.compare_values)
+        self.valueColumn = add_column("Value", setup_value, bind_value, sorter=self.valueSorter)
+        add_column("Plot", setup_plot, bind_plot)
+        self.sparkColumn = add_column("Trend", setup_spark, bind_spark)
+
+    def sparkline(self, sensor):
+        spark = self.sparklines.get(sensor)
+        if spark is None:
+            spark = self.sparklines[sensor] = sparkline.Sparkline(sensor)
+            if len(self.sparklines) > SPARKLINES_CACHED:
+                self.sparklines.popitem(last=False)
+        else:
+            self.sparklines.move_to_end(sensor)
+        return spark
+
+    def update_sparkline(self, item, sensor):
+        area = item.get_child()
+        self.sparkline(sensor).update(self.app.history, monotonic_s(), area.get_scale_factor())
+        area.queue_draw()
+
+    def draw_sparkline(self, item, c, w, h):
+        sensor = self.sparkBound.get(item)
+        if sensor is not None:
+            self.sparkline(sensor).draw(c, w, h)
+
+    def on_spark_toggled(self, toggle):
+        self.sparkColumn.set_visible(toggle.get_active())
+        self.config['sparklines'] = str(toggle.get_active())
+        self.app.config.write()
+        if toggle.get_active():
+            for (item, sensor) in self.sparkBound.items():
+                self.update_sparkline(item, sensor)
+        else:
+            self.sparklines.clear()
+
+    def edit_filter(self, sensor, parent):
+        if not isinstance(sensor, Sensor):
+            return
+        popover = Gtk.Popover()
+        entry = Gtk.Entry(width_chars=30, placeholder_text="outlier:4, median:5, ema:10",
+                          text=sensor.filters.spec if sensor.filters else "")
+        def apply(*args):
+            try:
+                sensor.set_filter(entry.get_text().strip())
+            except ValueError as e:
+                entry.add_css_class("error")
+                entry.set_tooltip_text(str(e))
+                return
+            # Recompute what is shown, unless a collector does the filtering
+            if hasattr(self.app.history, 'refilter'):
+                self.app.history.refilter(sensor)
+                self.app.win.plots.refresh()
+            popover.popdown()
+        entry.connect('activate', apply)
+        box = Gtk.Box(spacing=6)
+        box.append(Gtk.Label(label="Filter:"))
+        box.append(entry)
+        popover.set_child(box)
+        popover.set_parent(parent)
+        popover.connect('closed', lambda *a: GLib.idle_add(popover.unparent))
+        popover.popup()
+
+    def compare_names(self, a, b, *args):
+        a = a.name.lower()
+        b = b.name.lower()
+        return (a > b) - (a < b)
+
+    def sort_value(self, obj):
+        """Value to sort by, devices sort by their highest matching sensor"""
+        if isinstance(obj, Sensor):
+            return obj.value if obj.value is not None else float('-inf')
+        return max((s.value for s in obj.store
+                    if s.value is not None and self.matches(s)), default=float('-inf'))
+
+    def compare_values(self, a, b, *args):
+        a = self.sort_value(a)
+        b = self.sort_value(b)
+        return (a > b) - (a < b)
+
+    def matches(self, sensor) -> bool:
+        unit = self.units[self.unitSelector.get_selected()]
+        if unit is not None and sensor.unit != unit.value:
+            return False
+        if self._filter_text:
+            text = "{} {} {}".format(sensor.device.name, sensor.name, sensor.measurement).lower()
+            return self._filter_text in text
+        return True
+
+    def filter_row(self, row, *args):
+        obj = row.get_item()
+        if isinstance(obj, Sensor):
+            return self.matches(obj)
+        return any(self.matches(s) for s in obj.store)
+
+    def on_search_changed(self, entry):
+        old, new = self._filter_text, entry.get_text().lower()
+        self._filter_text = new
+        if new.startswith(old):
+            change = Gtk.FilterChange.MORE_STRICT
+        elif old.startswith(new):
+            change = Gtk.FilterChange.LESS_STRICT
+        else:
+            change = Gtk.FilterChange.DIFFERENT
+        self.set_filtering(bool(new))
+        self.filter.changed(change)
+
+    def on_unit_selected(self, *args):
+        self.set_filtering(self.unitSelector.get_selected() != 0 or bool(self._filter_text))
+        self.filter.changed(Gtk.FilterChange.DIFFERENT)
+
+    def set_filtering(self, filtering):
+        """Expand all devices while filtering, restore afterwards"""
+        if filtering == self._filtering:
+            return
+        self._filtering = filtering
+        for i in range(self.devices.get_n_items()):
+            row = self.tree.get_child_row(i)
+            if filtering:
+                row.set_expanded(True)
+            else:
+                row.set_expanded(row.get_item().config_section.getboolean('expanded'))
+
+    def watch_sensor(self, sensor, store):
+        if sensor not in self.watched:
+            self.watched[sensor] = (store, sensor.connect("notify::plot", self.on_plot_toggled))
+
+    def on_plot_toggled(self, *args):
+        self.app.win.plots.recreate_plots()
+
+    def on_items_changed(self, store, position, removed, added):
+        if removed:
+            present = set(store)
+            for (sensor, (watched_store, handler)) in list(self.watched.items()):
+                if watched_store == store and sensor not in present:
+                    sensor.disconnect(handler)
+                    del self.watched[sensor]
+        for i in range(position, position + added):
+            self.watch_sensor(store.get_item(i), store)
+
+    def queue_update(self):
+        """Apply the values of the last refresh on the next frame"""
+        if not self._update_queued:
+            self._update_queued = True
+            self.add_tick_callback(self.on_tick)
+
+    @time_it("SensorView update")
+    def on_tick(self, *args):
+        self._update_queued = False
+        # Only rows on screen are bound, everything else is skipped
+        for sensor in self.bound.values():
+            sensor.format_valueStr()
+        if self.sparkColumn.get_visible():
+            for (item, sensor) in self.sparkBound.items():
+                self.update_sparkline(item, sensor)
+        if self.view.get_sorter() is not None and self.is_sorted_by_value():
+            self.valueSorter.changed(Gtk.SorterChange.DIFFERENT)
+        return GLib.SOURCE_REMOVE
+
+    def is_sorted_by_value(self) -> bool:
+        sorter = self.view.get_sorter()
+        return sorter.get_primary_sort_column() == self.valueColumn
+
+    def select_sensor(self, sensor):
+        for i in range(self.devices.get_n_items()):
+            row = self.tree.get_child_row(i)
+            if row.get_item() == sensor.device:
+                row.set_expanded(True)
+        for i in range(self.filterModel.get_n_items()):
+            if self.filterModel.get_item(i).get_item() == sensor:
+                self.view.scroll_to(i, None, Gtk.ListScrollFlags.SELECT | Gtk.ListScrollFlags.FOCUS, None)
+                return True
+        self.ss.set_selected(Gtk.INVALID_LIST_POSITION)
+        return False
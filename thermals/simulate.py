@@ -0,0 +1,258 @@
+"""Replays recorded temperatures through a fan curve being edited.
+
+"Simulate" in the fan curve editor takes the monitored temperature sensor's
+values over a window, from `History` or the archive, and pushes them through
+the curve's points the way the driver does: linear between points, flat
+before the first and after the last. The resulting PWM is plotted under the
+PWM actually recorded. If the fan's RPM was recorded along with its PWM, a
+line is fitted from PWM to RPM and the RPM the curve would have given is
+plotted too. The whole window is interpolated at once with NumPy, so it is
+redone on every step of dragging a point.
+"""
+from time import time
+
+from gi.repository import Gtk, Pango
+
+from thermals.analysis import snapshot, resample
+from thermals.archive import Chunk, list_chunks, directory_from_config
+from thermals.utils import Unit, monotonic_s, time_it
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# (title, seconds) of the windows simulated
+WINDOWS = [("10 minutes", 600), ("1 hour", 3600), ("6 hours", 6 * 3600),
+           ("1 day", 24 * 3600)]
+SOURCES = ["History", "Archive"]
+# Points with a spinning fan, and PWM range among them, needed for a fit
+FIT_MIN_POINTS = 20
+FIT_MIN_SPREAD = 10
+# Step in seconds of the grid RPM and PWM are matched on
+FIT_STEP = 1
+PLOT_HEIGHT = 180
+
+def key(sensor):
+    """Column key of `sensor` in the archive"""
+    return "{}:{}".format(sensor.device.id, sensor.measurement)
+
+def history_series(history, sensors, seconds):
+    """{sensor: (times, values)} over the last `seconds`, times relative to
+    now. Sensors without history are left out."""
+    present = [s for s in sensors if s is not None and s in history.sensors]
+    _, series = snapshot(history, present, seconds)
+    now = monotonic_s()
+    found = {}
+    for (sensor, points) in zip(present, series):
+        if len(points) >= 2:
+            a = np.array(points, dtype=float)
+            found[sensor] = (a[:, 0] - now, a[:, 1])
+    return found
+
+@time_it("Archive series")
+def archive_series(directory, sensors, seconds):
+    """{sensor: (times, values)} from the archive, like `history_series`"""
+    now = time()
+    start = now - seconds
+    parts = {}
+    try:
+        chunks = list_chunks(directory, start, now)
+    except OSError:
+        return {}
+    for (_, path) in chunks:
+        chunk = Chunk(path)
+        try:
+            if not len(chunk):
+                continue
+            keys = [c['key'] for c in chunk.columns]
+            records = chunk.array(chunk.search(start), len(chunk))
+            for sensor in sensors:
+                if sensor is None or key(sensor) not in keys:
+                    continue
+                values = records['values'][:, keys.index(key(sensor))].astype(float)
+                present = ~np.isnan(values)
+                parts.setdefault(sensor, []).append(
+                    (records['time'][present] - now, values[present]))
+            del records
+        finally:
+            chunk.close()
+    found = {}
+    for (sensor, arrays) in parts.items():
+        times = np.concatenate([t for (t, _) in arrays])
+        if len(times) >= 2:
+            found[sensor] = (times, np.concatenate([v for (_, v) in arrays]))
+    return found
+
+def interpolate(temps, points):
+    """PWM of the curve `points` [(temp, pwm)] at `temps`"""
+    xs = np.array([p[0] for p in points], dtype=float)
+    ys = np.array([p[1] for p in points], dtype=float)
+    # `np.interp` is flat outside the points, like the driver
+    return np.interp(temps, xs, ys)
+
+class RpmModel:
+    """RPM as a line of PWM above the lowest PWM seen spinning, 0 below"""
+    def __init__(self, slope, intercept, stall):
+        self.slope = slope
+        self.intercept = intercept
+        self.stall = stall
+
+    @staticmethod
+    def fit(pwm, rpm):
+        """Fit to (times, values) of a PWM and its fan, None if they don't
+        overlap enough"""
+        if pwm is None or rpm is None:
+            return None
+        _, matrix = resample([np.column_stack(pwm), np.column_stack(rpm)], FIT_STEP)
+        if matrix is None:
+            return None
+        spinning = matrix[1] > 0
+        x, y = matrix[0][spinning], matrix[1][spinning]
+        if len(x) < FIT_MIN_POINTS or np.ptp(x) < FIT_MIN_SPREAD:
+            return None
+        slope, intercept = np.polyfit(x, y, 1)
+        return RpmModel(slope, intercept, x.min())
+
+    def predict(self, pwm):
+        return np.where(pwm >= self.stall, np.maximum(self.slope * pwm + self.intercept, 0), 0)
+
+    def describe(self) -> str:
+        return "RPM ≈ {:.1f} × PWM {:+.0f} above PWM {:.0f}".format(
+            self.slope, self.intercept, self.stall)
+
+class Simulation:
+    """Recorded series of one window and the curve's result over them"""
+    def __init__(self, temps, pwm, model):
+        # (times, values) with times in seconds relative to now
+        self.temps = temps
+        self.pwm = pwm
+        self.model = model
+        self.sim_pwm = None
+        self.sim_rpm = None
+
+    def run(self, points):
+        self.sim_pwm = interpolate(self.temps[1], points)
+        if self.model is not None:
+            self.sim_rpm = self.model.predict(self.sim_pwm)
+
+class SimulationPlot(Gtk.DrawingArea):
+    """Recorded PWM in grey, simulated PWM and predicted RPM in color, over
+    the window with now at the right"""
+    def __init__(self):
+        super().__init__(hexpand=True, content_height=PLOT_HEIGHT)
+        self.simulation = None
+        self.seconds = WINDOWS[0][1]
+        self.set_draw_func(self.draw, None)
+
+    def show(self, simulation, seconds):
+        self.simulation = simulation
+        self.seconds = seconds
+        self.queue_draw()
+
+    def draw(self, area, c, w, h, data):
+        c.set_source_rgb(0.5, 0.5, 0.5)
+        c.set_line_width(1)
+        c.rectangle(0.5, 0.5, w - 1, h - 1)
+        c.stroke()
+        sim = self.simulation
+        if sim is None or sim.sim_pwm is None:
+            return
+        x = lambda t: w * (1 + t / self.seconds)
+        pwm_y = lambda v: h - v * h / 255
+        if sim.pwm is not None:
+            self.draw_series(c, w, *sim.pwm, x, pwm_y, (0.6, 0.6, 0.6), 1.5)
+        if sim.sim_rpm is not None:
+            top = max(float(sim.sim_rpm.max()), 1) * 1.1
+            c.set_dash([4, 3])
+            self.draw_series(c, w, sim.temps[0], sim.sim_rpm, x,
+                             lambda v: h - v * h / top, (0.2, 0.6, 0.3), 1)
+            c.set_dash([])
+            c.set_source_rgb(0.2, 0.6, 0.3)
+            c.move_to(w - 90, 14)
+            c.show_text(Unit.RPM.format_value(top))
+        self.draw_series(c, w, sim.temps[0], sim.sim_pwm, x, pwm_y, (0.2, 0.4, 0.9), 2)
+
+    def draw_series(self, c, w, times, values, x, y, rgb, width):
+        # At most two points per pixel
+        step = max(1, len(times) // int(w * 2 or 1))
+        c.set_source_rgb(*rgb)
+        c.set_line_width(width)
+        c.move_to(x(times[0]), y(values[0]))
+        for (t, v) in zip(times[::step], values[::step]):
+            c.line_to(x(t), y(v))
+        c.line_to(x(times[-1]), y(values[-1]))
+        c.stroke()
+
+class SimulationPanel(Gtk.Box):
+    """Source and window selection, status and plot of the simulation of
+    `curve`, the fan curve of the Pwm sensor `pwm`"""
+    def __init__(self, app, pwm, curve):
+        super().__init__(orientation=Gtk.Orientation.VERTICAL, spacing=6)
+        self.app = app
+        self.pwm = pwm
+        self.curve = curve
+        self.temp = None
+        self.simulation = None
+
+        self.source = Gtk.DropDown.new_from_strings(SOURCES)
+        self.source.connect('notify::selected', lambda *a: self.load())
+        self.window = Gtk.DropDown.new_from_strings([title for (title, _) in WINDOWS])
+        self.window.connect('notify::selected', lambda *a: self.load())
+        self.status = Gtk.Label(xalign=0, hexpand=True, ellipsize=Pango.EllipsizeMode.END)
+        self.plot = SimulationPlot()
+
+        top = Gtk.Box(spacing=10)
+        top.append(Gtk.Label(label="Replay:"))
+        top.append(self.source)
+        top.append(self.window)
+        top.append(self.status)
+        self.append(top)
+        self.append(self.plot)
+
+    def fan(self):
+        """Fan of the same number on the same device, e.g. fan2 for pwm2"""
+        name = "fan" + self.pwm.measurement[3:]
+        for sensor in self.pwm.device.get_sensors():
+            if sensor.measurement == name:
+                return sensor
+        return None
+
+    def set_temp(self, sensor):
+        self.temp = sensor
+        self.load()
+
+    def load(self):
+        """Read the series of the selected window and simulate them"""
+        self.simulation = None
+        if np is None:
+            self.status.set_text("NumPy is required for the simulation")
+            return
+        if self.temp is None:
+            self.status.set_text("Select a temperature to simulate")
+            return
+        seconds = WINDOWS[self.window.get_selected()][1]
+        fan = self.fan()
+        sensors = [self.temp, self.pwm, fan]
+        if SOURCES[self.source.get_selected()] == "Archive":
+            found = archive_series(directory_from_config(self.app.config), sensors, seconds)
+        else:
+            found = history_series(self.app.history, sensors, seconds)
+        if self.temp not in found:
+            self.status.set_text("No recorded values of {} in this window".format(self.temp.name))
+            self.plot.show(None, seconds)
+            return
+        model = RpmModel.fit(found.get(self.pwm), found.get(fan))
+        self.simulation = Simulation(found[self.temp], found.get(self.pwm), model)
+        self.status.set_text("{} values of {}{}".format(
+            len(found[self.temp][0]), self.temp.name,
+            ", " + model.describe() if model is not None else ", no RPM model"))
+        self.plot.seconds = seconds
+        self.update()
+
+    def update(self):
+        """Simulate the curve's current points"""
+        if self.simulation is None:
+            return
+        self.simulation.run(self.curve.data)
+        self.plot.show(self.simulation, self.plot.seconds)
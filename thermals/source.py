@@ -0,0 +1,109 @@
+"""Sources of devices and sensors.
+
+A `Source` finds its devices once at startup and reads the values of its
+sensors in batches: `read(sensors)` is called once per refresh with all of
+its sensors due, so a source backed by a single file (like `/proc/stat`)
+reads it once for all of them. Sensors store what was read with
+`Sensor.update`; `History`, `Plots` and everything else only see sensors
+and their `Unit`.
+
+Sensors of a device that is runtime suspended (`Device.suspended`) are not
+read, reading would wake the device up. Sensors whose reads fail back off,
+see `Sensor.refresh`.
+"""
+from time import monotonic_ns
+
+from gi.repository import GObject, Gio
+
+from thermals.sensor import Sensor
+from thermals.utils import Unit, time_it
+
+class Device(GObject.Object):
+    """A group of sensors, one top level row in the `SensorView` tree"""
+    # Set by subclasses or `__init__`. `hwmonInstance` is shown next to the
+    # name, it is the hwmon directory for hwmon devices.
+    id = None
+    name = None
+    hwmonInstance = None
+    source = None
+
+    def __init__(self, app, id=None, name=None, hwmonInstance=None, source=None):
+        super().__init__()
+        self.app = app
+        if id is not None:
+            self.id = id
+        if name is not None:
+            self.name = name
+        if hwmonInstance is not None:
+            self.hwmonInstance = hwmonInstance
+        if source is not None:
+            self.source = source
+        self.config_section = app.config[self.id]
+        self.store = Gio.ListStore(item_type=Sensor)
+
+    def sensor_config(self, measurement):
+        return self.app.config["{}:{}".format(self.id, measurement)]
+
+    def get_sensors(self, plot : bool | None = None, unit : int | None = None):
+        """Return sensors using filters.
+
+        No filters -> All sensors
+        """
+        for item in self.store:
+            if plot != None and item.plot != plot:
+                continue
+            if unit != None and item.unit != unit:
+                continue
+            yield item
+
+    def suspended(self) -> bool:
+        """Whether the device is runtime suspended and shouldn't be read"""
+        return False
+
+class Source:
+    """Finds devices and reads their sensors. See the module docstring."""
+    # Key in the `[sources]` config section enabling the source
+    name = None
+    # Enabled without configuration
+    default = False
+
+    def __init__(self, model):
+        self.model = model
+        self.app = model.app
+        self.devices = []
+
+    def enabled(self) -> bool:
+        return self.app.config['sources'].getboolean(self.name, self.default)
+
+    def find_devices(self, cache=None):
+        raise NotImplementedError
+
+    def read(self, sensors):
+        """Refresh `sensors`, all of them from this source"""
+        now = monotonic_ns()
+        for sensor in sensors:
+            if sensor.due(now):
+                time_it("{} refresh".format(sensor))(sensor.refresh)()
+
+class FileSensor(Sensor):
+    """A sensor reading one number from one file"""
+    def __init__(self, device, measurement, path, unit, scale=1, label=None):
+        self.device = device
+        self.measurement = measurement
+        self.path = path
+        self.scale = scale
+        self.label = label
+        super().__init__(label or measurement, device.sensor_config(measurement))
+        self.unit = unit.value
+
+    def get_value(self):
+        with open(self.path, 'rb') as fd:
+            return int(fd.read()) / self.scale
+
+    def format_value(self):
+        if self.value is None:
+            return ""
+        return Unit(self.unit).format_value(self.value)
+
+    def has_configuration(self):
+        return False
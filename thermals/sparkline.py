@@ -0,0 +1,151 @@
+"""Small trend lines of the last minutes of a sensor, for the sensor list.
+
+Like `thermals.heatmap`, each sparkline is a cached image whose columns form
+a ring, one column per `History` step. A tick advances the ring and draws
+only the newest column; the image is rebuilt from history when it missed
+ticks (e.g. while its row was scrolled out of view) and redrawn when a
+value leaves its range. Only rows on screen are updated.
+"""
+import math
+from array import array
+
+import cairo
+
+SECONDS = 300
+# Width in columns, the finest resolution fitting `SECONDS` in it is used
+MAX_COLUMNS = 100
+HEIGHT = 20
+RANGE_MARGIN = 0.1
+
+def resolution(history):
+    for res in history.resolutions:
+        if SECONDS // res <= MAX_COLUMNS:
+            return res
+    return history.resolutions[-1]
+
+class Sparkline:
+    def __init__(self, sensor):
+        self.sensor = sensor
+        self.surface = None
+        # History, resolution and scale the image was built for
+        self.history = None
+        self.res = None
+        self.scale = 1
+        self.columns = 0
+        # Values by ring column, NaN where there is none
+        self.values = None
+        # History step of the newest column and its ring index
+        self.step = None
+        self.head = 0
+        self.v_min = None
+        self.v_max = None
+
+    def update(self, history, now, scale=1):
+        """Shift in the newest value, or rebuild if anything changed"""
+        res = resolution(history)
+        step = now // res
+        if history is not self.history or res != self.res or scale != self.scale or \
+           not 0 <= step - self.step <= 1:
+            self.rebuild(history, res, now, scale)
+            return
+        if step > self.step:
+            self.head = (self.head + 1) % self.columns
+            self.values[self.head] = math.nan
+            self.step = step
+            self.draw_column(self.head)
+        series = history.sensors[self.sensor][res]
+        if not series:
+            return
+        tail = series[-1]
+        age = step - tail.time // res
+        if not 0 <= age < self.columns:
+            return
+        col = (self.head - age) % self.columns
+        self.values[col] = tail.value
+        if self.extend_range([tail.value]):
+            self.redraw()
+        else:
+            # The next column's segment starts at this value
+            self.draw_column(col)
+            if col != self.head:
+                self.draw_column((col + 1) % self.columns)
+
+    def rebuild(self, history, res, now, scale):
+        self.history = history
+        self.res = res
+        self.scale = scale
+        self.columns = max(1, SECONDS // res)
+        self.surface = cairo.ImageSurface(cairo.FORMAT_ARGB32,
+                                          self.columns * scale, HEIGHT * scale)
+        self.surface.set_device_scale(scale, scale)
+        self.values = array('d', [math.nan]) * self.columns
+        self.step = now // res
+        self.head = self.columns - 1
+        for m in reversed(history.sensors[self.sensor][res]):
+            newest = self.step - m.time_end // res
+            if newest >= self.columns:
+                break
+            for age in range(max(newest, 0), min(self.step - m.time // res, self.columns - 1) + 1):
+                self.values[(self.head - age) % self.columns] = m.value
+        self.v_min = self.v_max = None
+        self.extend_range(self.values)
+        self.redraw()
+
+    def extend_range(self, values) -> bool:
+        """Widen the range to include `values`, True if it changed"""
+        present = [v for v in values if not math.isnan(v)]
+        if not present:
+            return False
+        low, high = min(present), max(present)
+        if self.v_min is not None and low >= self.v_min and high <= self.v_max:
+            return False
+        if self.v_min is not None:
+            low, high = min(low, self.v_min), max(high, self.v_max)
+        margin = max(high - low, 1) * RANGE_MARGIN
+        self.v_min, self.v_max = low - margin, high + margin
+        return True
+
+    def y(self, value):
+        return HEIGHT * (1 - (value - self.v_min) / (self.v_max - self.v_min))
+
+    def redraw(self):
+        for col in range(self.columns):
+            self.draw_column(col)
+
+    def draw_column(self, col):
+        """Segment from the previous column's value to this one's"""
+        c = cairo.Context(self.surface)
+        c.rectangle(col, 0, 1, HEIGHT)
+        c.clip()
+        c.set_operator(cairo.OPERATOR_CLEAR)
+        c.paint()
+        value = self.values[col]
+        if math.isnan(value) or self.v_min is None:
+            return
+        previous = math.nan
+        if col != (self.head + 1) % self.columns:
+            previous = self.values[(col - 1) % self.columns]
+        if math.isnan(previous):
+            previous = value
+        c.set_operator(cairo.OPERATOR_OVER)
+        c.set_source_rgb(*self.sensor.RGB_triple())
+        c.set_line_width(1.5)
+        c.move_to(col, self.y(previous))
+        c.line_to(col + 1, self.y(value))
+        c.stroke()
+
+    def draw(self, c, w, h):
+        """Paint oldest to newest, left to right, scaled to `w` × `h`"""
+        if self.surface is None:
+            return
+        c.save()
+        c.scale(w / self.columns, h / HEIGHT)
+        split = (self.head + 1) % self.columns
+        for (src, dst, width) in ((split, 0, self.columns - split),
+                                  (0, self.columns - split, split)):
+            if width <= 0:
+                continue
+            c.set_source_surface(self.surface, dst - src, 0)
+            c.rectangle(dst, 0, width, HEIGHT)
+            c.fill()
+        c.restore()
@@ -0,0 +1,137 @@
+"""Streaming per-sensor statistics over rolling windows.
+
+Every sample updates two mergeable `Sketch`es per sensor, one for the
+current minute and one for the current hour, in O(1). Window statistics
+merge at most an hour of minute sketches plus a day of hour sketches, so
+nothing ever rescans raw samples.
+"""
+import math
+from collections import deque
+
+from thermals.utils import Unit
+
+# Histogram bin width per unit, the precision of percentiles
+BIN_WIDTH = {
+    Unit.CELCIUS: 0.5,
+    Unit.RPM: 10,
+    Unit.PWM: 1,
+    Unit.WATT: 0.5,
+    Unit.MHZ: 25,
+    Unit.PERCENT: 0.5,
+}
+
+MINUTE = 60
+HOUR = 60 * 60
+DAY = 24 * HOUR
+
+class Sketch:
+    """Welford moments and a sparse fixed-width histogram"""
+    __slots__ = ('width', 'n', 'mean', 'm2', 'min', 'max', 'bins')
+
+    def __init__(self, width):
+        self.width = width
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.bins = {}
+
+    def add(self, value):
+        self.n += 1
+        delta = value - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (value - self.mean)
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        b = math.floor(value / self.width)
+        self.bins[b] = self.bins.get(b, 0) + 1
+
+    def merge(self, other):
+        """Merge `other` into this sketch (Chan et al.)"""
+        if other.n == 0:
+            return self
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.m2 += other.m2 + delta * delta * self.n * other.n / n
+        self.mean += delta * other.n / n
+        self.n = n
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        for (b, count) in other.bins.items():
+            self.bins[b] = self.bins.get(b, 0) + count
+        return self
+
+    def stddev(self):
+        return math.sqrt(self.m2 / self.n) if self.n else None
+
+    def percentile(self, q):
+        """Approximate `q`th percentile (0-100), interpolated within a bin"""
+        if not self.n:
+            return None
+        rank = q / 100 * self.n
+        seen = 0
+        for b in sorted(self.bins):
+            count = self.bins[b]
+            if seen + count >= rank:
+                value = (b + (rank - seen) / count) * self.width
+                return min(max(value, self.min), self.max)
+            seen += count
+        return self.max
+
+class SensorStats:
+    """Minute and hour sketches of one sensor, oldest first"""
+    def __init__(self, width):
+        self.width = width
+        self.minutes = deque([], HOUR // MINUTE + 1)
+        self.hours = deque([], DAY // HOUR + 1)
+
+    def add(self, value, time):
+        for (buckets, span) in ((self.minutes, MINUTE), (self.hours, HOUR)):
+            start = time - time % span
+            if not buckets or buckets[-1][0] != start:
+                buckets.append((start, Sketch(self.width)))
+            buckets[-1][1].add(value)
+
+    def window(self, seconds, now, into=None):
+        """Merge the sketches covering the last `seconds` into `into`"""
+        sketch = into if into is not None else Sketch(self.width)
+        t_min = now - seconds
+        if seconds <= HOUR:
+            for (start, s) in self.minutes:
+                if start + MINUTE > t_min:
+                    sketch.merge(s)
+        else:
+            # Whole hours from the hour sketches, the rest from minutes
+            # of the current hour.
+            current = now - now % HOUR
+            for (start, s) in self.hours:
+                if start + HOUR > t_min and start < current:
+                    sketch.merge(s)
+            for (start, s) in self.minutes:
+                if start >= current:
+                    sketch.merge(s)
+        return sketch
+
+class Statistics:
+    def __init__(self):
+        self.sensors = {}
+
+    def add(self, sensor, value=None, time=None):
+        stats = self.sensors.get(sensor)
+        if stats is None:
+            stats = self.sensors[sensor] = SensorStats(BIN_WIDTH.get(Unit(sensor.unit), 1))
+        stats.add(sensor.value if value is None else value,
+                  sensor.time if time is None else time)
+
+    def window(self, sensors, seconds, now) -> Sketch | None:
+        """Combined statistics of `sensors` (of one unit) over `seconds`"""
+        sketch = None
+        for sensor in sensors:
+            stats = self.sensors.get(sensor)
+            if stats is None:
+                continue
+            sketch = stats.window(seconds, now, into=sketch)
+        return sketch
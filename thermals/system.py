@@ -0,0 +1,162 @@
+"""Sources besides hwmon: thermal zones, CPU frequencies and utilization.
+
+Enabled in `thermals.ini`:
+
+    [sources]
+    thermal_zone = True
+    cpufreq = True
+    procstat = True
+"""
+import os.path
+import re
+from time import monotonic_ns
+
+from thermals.sensor import Sensor
+from thermals.source import Source, Device, FileSensor
+from thermals.utils import Unit, readlineStrip, reglob
+
+def natural_key(path):
+    """Sort key ordering cpu2 before cpu10"""
+    return [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", path)]
+
+class ThermalZoneSource(Source):
+    """/sys/class/thermal/thermal_zone*"""
+    name = "thermal_zone"
+    root = "/sys/class/thermal"
+
+    def find_devices(self, cache=None):
+        device = Device(self.app, id="thermal", name="Thermal zones",
+                        hwmonInstance="thermal", source=self)
+        for dir in sorted(reglob(self.root + "/thermal_zone[0-9]+$"), key=natural_key):
+            try:
+                label = readlineStrip(os.path.join(dir, "type"))
+            except OSError:
+                label = None
+            device.store.append(ThermalZone(device, dir, label))
+        if device.store.get_n_items():
+            self.devices.append(device)
+
+class ThermalZone(FileSensor):
+    # Trip point types standing in for hwmon limits
+    TRIP_TYPES = {"crit": "critical", "max": "hot"}
+
+    def __init__(self, device, dir, label):
+        self.dir = dir
+        super().__init__(device, os.path.basename(dir), os.path.join(dir, "temp"),
+                         Unit.CELCIUS, scale=1000, label=label)
+
+    def limit(self, attr):
+        trip_type = self.TRIP_TYPES.get(attr)
+        if trip_type is None:
+            return None
+        try:
+            for path in reglob("trip_point_[0-9]+_type$", root_dir=self.dir):
+                if readlineStrip(os.path.join(self.dir, path)) == trip_type:
+                    temp = path[:-len("type")] + "temp"
+                    return int(readlineStrip(os.path.join(self.dir, temp))) / 1000
+        except (OSError, ValueError):
+            pass
+        return None
+
+class CpuFreqSource(Source):
+    """Current frequency of each CPU from cpufreq"""
+    name = "cpufreq"
+    root = "/sys/devices/system/cpu"
+
+    def find_devices(self, cache=None):
+        device = Device(self.app, id="cpufreq", name="CPU frequency",
+                        hwmonInstance="cpufreq", source=self)
+        for dir in sorted(reglob(self.root + "/cpu[0-9]+$"), key=natural_key):
+            if os.path.exists(os.path.join(dir, "cpufreq", "scaling_cur_freq")):
+                device.store.append(CpuFreq(device, dir))
+        if device.store.get_n_items():
+            self.devices.append(device)
+
+class CpuFreq(FileSensor):
+    def __init__(self, device, dir):
+        self.cpufreq = os.path.join(dir, "cpufreq")
+        cpu = os.path.basename(dir)
+        super().__init__(device, cpu, os.path.join(self.cpufreq, "scaling_cur_freq"),
+                         Unit.MHZ, scale=1000, label="CPU {}".format(cpu[3:]))
+
+    def limit(self, attr):
+        if attr != "max":
+            return None
+        try:
+            return int(readlineStrip(os.path.join(self.cpufreq, "cpuinfo_max_freq"))) / 1000
+        except (OSError, ValueError):
+            return None
+
+class ProcStatSource(Source):
+    """CPU utilization from /proc/stat. One read of the file per refresh
+    updates all CPUs."""
+    name = "procstat"
+    path = "/proc/stat"
+
+    def find_devices(self, cache=None):
+        device = Device(self.app, id="cpu", name="CPU utilization",
+                        hwmonInstance="stat", source=self)
+        try:
+            cpus = self.parse()
+        except OSError:
+            return
+        for cpu in cpus:
+            device.store.append(CpuUtilization(device, cpu))
+        self.devices.append(device)
+
+    def parse(self) -> dict[str, tuple[int, int]]:
+        """{"cpu" or "cpuN": (busy, total)} in clock ticks since boot"""
+        counters = {}
+        with open(self.path) as fd:
+            for line in fd:
+                if not line.startswith("cpu"):
+                    break
+                cpu, *fields = line.split()
+                # user nice system idle iowait irq softirq steal, guest
+                # time is included in user and nice
+                ticks = [int(field) for field in fields[:8]]
+                total = sum(ticks)
+                counters[cpu] = (total - ticks[3] - ticks[4], total)
+        return counters
+
+    def read(self, sensors):
+        read_ns = monotonic_ns()
+        try:
+            counters = self.parse()
+        except OSError:
+            counters = {}
+        for sensor in sensors:
+            sensor.update(sensor.utilization(counters.get(sensor.measurement)), read_ns)
+
+class CpuUtilization(Sensor):
+    # (busy, total) ticks of the previous read
+    previous = None
+    sampleable = False
+
+    def __init__(self, device, cpu):
+        self.device = device
+        self.measurement = cpu
+        label = "All CPUs" if cpu == "cpu" else "CPU {}".format(cpu[3:])
+        super().__init__(label, device.sensor_config(cpu))
+        self.unit = Unit.PERCENT.value
+
+    def utilization(self, counters):
+        """Busy percentage since the previous read"""
+        previous, self.previous = self.previous, counters
+        if counters is None or previous is None:
+            return None
+        busy, total = counters[0] - previous[0], counters[1] - previous[1]
+        if total <= 0:
+            return None
+        return 100 * busy / total
+
+    def get_value(self):
+        return self.utilization(self.device.source.parse().get(self.measurement))
+
+    def format_value(self):
+        if self.value is None:
+            return ""
+        return Unit(self.unit).format_value(self.value)
+
+    def has_configuration(self):
+        return False
@@ -0,0 +1,62 @@
+"""On-disk cache of discovered hwmon devices and their sensors.
+
+Entries are keyed by the hwmon directory and validated by the directory
+mtime and the driver name, which changes when a driver is reloaded or a
+different device takes over the hwmon instance.
+"""
+import json
+import os
+import os.path
+
+from gi.repository import GLib
+
+from thermals.utils import readlineStrip
+
+CACHE_VERSION = 2
+
+class TopologyCache:
+    def __init__(self, path=None):
+        self.path = path or os.path.join(GLib.get_user_cache_dir(), "thermals", "topology.json")
+        self.devices = {}
+
+    def load(self):
+        try:
+            with open(self.path) as fd:
+                data = json.load(fd)
+            if data.get('version') == CACHE_VERSION:
+                self.devices = data['devices']
+        except (OSError, ValueError, KeyError):
+            self.devices = {}
+        return self
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, 'w') as fd:
+            json.dump({'version': CACHE_VERSION, 'devices': self.devices}, fd)
+        os.replace(tmp, self.path)
+
+    def lookup(self, dir):
+        """Return the cached entry for `dir` if it is still valid"""
+        entry = self.devices.get(dir)
+        if entry is None:
+            return None
+        try:
+            if os.stat(dir).st_mtime_ns != entry['mtime'] or \
+               readlineStrip(os.path.join(dir, "name")) != entry['name']:
+                return None
+        except OSError:
+            return None
+        return entry
+
+    def store(self, device):
+        self.devices[device.dir] = {
+            'mtime': os.stat(device.dir).st_mtime_ns,
+            'id': device.id,
+            'name': device.name,
+            'sensors': device.topology(),
+        }
+
+    def retain(self, dirs):
+        """Forget devices that are not in `dirs`"""
+        self.devices = {dir: entry for (dir, entry) in self.devices.items() if dir in dirs}
@@ -0,0 +1,212 @@
+"""Triggered high-rate captures around interesting moments.
+
+Armed sensors are read at a high rate into a small ring of recent samples.
+When their trigger condition is met, the ring and the following seconds are
+stored as a `Capture` in `History.captures`, which the plots mark and can
+zoom into. Triggers are set in the sensor's section of `thermals.ini`:
+
+    [coretemp.0:temp1]
+    trigger = above:90      ; or below:300, or slope:5 (units per second)
+    trigger_pre = 2         ; seconds kept before the trigger
+    trigger_post = 5        ; seconds captured after the trigger
+
+    [trigger]
+    rate = 25               ; samples per second, 20 to 50
+
+Checking a condition is a comparison or two per sample, and no timer runs
+while no sensor is armed. Sensors computing rates from their previous read
+(energy counters, CPU utilization, virtual sensors) can't be armed.
+"""
+from collections import deque
+from time import monotonic_ns
+
+from gi.repository import GLib
+
+from thermals.history import Measurement
+from thermals.utils import Unit
+
+DEFAULT_RATE = 25
+MIN_RATE = 20
+MAX_RATE = 50
+DEFAULT_PRE = 2
+DEFAULT_POST = 5
+# Seconds over which `slope` is measured, single samples are too noisy
+SLOPE_WINDOW = 0.5
+
+class Condition:
+    def __init__(self, limit):
+        self.limit = limit
+
+    def test(self, ring, t, value) -> bool:
+        raise NotImplementedError
+
+    def describe(self, unit) -> str:
+        raise NotImplementedError
+
+class Above(Condition):
+    """Crossing `limit` upwards"""
+    def test(self, ring, t, value):
+        return value > self.limit and bool(ring) and ring[-1][1] <= self.limit
+
+    def describe(self, unit):
+        return "above {}".format(unit.format_value(self.limit))
+
+class Below(Condition):
+    """Crossing `limit` downwards"""
+    def test(self, ring, t, value):
+        return value < self.limit and bool(ring) and ring[-1][1] >= self.limit
+
+    def describe(self, unit):
+        return "below {}".format(unit.format_value(self.limit))
+
+class Slope(Condition):
+    """Changing by more than `limit` per second, either way"""
+    def __init__(self, limit, window):
+        super().__init__(abs(limit))
+        # Samples back to compare with, set from the rate
+        self.window = max(1, window)
+
+    def test(self, ring, t, value):
+        if len(ring) < self.window:
+            return False
+        (t0, v0) = ring[-self.window]
+        return t > t0 and abs(value - v0) / (t - t0) > self.limit
+
+    def describe(self, unit):
+        return "changing {}/s".format(unit.format_value(self.limit))
+
+def parse_condition(spec, rate):
+    """Condition for `spec` like "above:90", raises ValueError"""
+    name, _, arg = spec.strip().partition(":")
+    limit = float(arg)
+    if name == "above":
+        return Above(limit)
+    if name == "below":
+        return Below(limit)
+    if name == "slope":
+        return Slope(limit, round(SLOPE_WINDOW * rate))
+    raise ValueError("Unknown trigger {!r}".format(name))
+
+class Capture:
+    """High-rate samples of one sensor around a trigger"""
+    def __init__(self, sensor, reason, trigger_time, samples):
+        self.sensor = sensor
+        self.reason = reason
+        self.trigger_time = trigger_time
+        # `Measurement`s with times in fractional seconds
+        self.samples = samples
+
+    @property
+    def start(self):
+        return self.samples[0].time
+
+    @property
+    def end(self):
+        return self.samples[-1].time
+
+class Armed:
+    """Pre-trigger ring and capture state of one sensor"""
+    def __init__(self, sensor, condition, rate, pre, post):
+        self.sensor = sensor
+        self.condition = condition
+        self.post = post
+        # (time, value) of the last `pre` seconds
+        self.ring = deque([], max(1, round(pre * rate)))
+        # (trigger time, samples) while capturing
+        self.capturing = None
+
+    def sample(self, t, value):
+        """Add a sample, returns a finished `Capture` or None"""
+        if self.capturing is not None:
+            trigger_time, samples = self.capturing
+            samples.append((t, value))
+            if t - trigger_time < self.post:
+                return None
+            self.capturing = None
+            # Start over, so a capture is not also the next one's pre-trigger
+            self.ring.clear()
+            return self.finish(trigger_time, samples)
+        if self.condition.test(self.ring, t, value):
+            self.capturing = (t, list(self.ring) + [(t, value)])
+        else:
+            self.ring.append((t, value))
+        return None
+
+    def finish(self, trigger_time, samples):
+        measurements = []
+        for (t, value) in samples:
+            m = Measurement()
+            m.time = m.time_end = t
+            m.value, m.sensor = value, self.sensor
+            measurements.append(m)
+        reason = self.condition.describe(Unit(self.sensor.unit))
+        return Capture(self.sensor, reason, trigger_time, measurements)
+
+class Triggers:
+    def __init__(self, app):
+        self.app = app
+        rate = app.config['trigger'].getint('rate', fallback=DEFAULT_RATE)
+        self.rate = min(max(rate, MIN_RATE), MAX_RATE)
+        self.armed = []
+        self.source = None
+        self.paused = False
+
+    def arm(self, sensors):
+        """Arm the `sensors` with a `trigger` in their section"""
+        self.armed = []
+        for sensor in sensors:
+            spec = sensor.config.get('trigger')
+            if not spec:
+                continue
+            if not sensor.sampleable:
+                print("Ignoring trigger of {}: it can't be read out of turn".format(sensor.name))
+                continue
+            try:
+                condition = parse_condition(spec, self.rate)
+                pre = sensor.config.getfloat('trigger_pre', fallback=DEFAULT_PRE)
+                post = sensor.config.getfloat('trigger_post', fallback=DEFAULT_POST)
+            except ValueError as e:
+                print("Ignoring trigger of {}: {}".format(sensor.name, e))
+                continue
+            self.armed.append(Armed(sensor, condition, self.rate, pre, post))
+        self.update_timer()
+
+    def set_paused(self, paused):
+        """Stop sampling, e.g. while the window is hidden"""
+        self.paused = paused
+        if paused:
+            for armed in self.armed:
+                armed.ring.clear()
+                armed.capturing = None
+        self.update_timer()
+
+    def update_timer(self):
+        running = bool(self.armed) and not self.paused
+        if running and self.source is None:
+            self.source = GLib.timeout_add(1000 // self.rate, self.on_timeout)
+        elif not running and self.source is not None:
+            GLib.source_remove(self.source)
+            self.source = None
+
+    def on_timeout(self):
+        for armed in self.armed:
+            # Not while suspended or backing off, see `Sensor.refresh`
+            if armed.sensor.state is not None:
+                continue
+            t = monotonic_ns() / 1000000000
+            try:
+                value = armed.sensor.get_value()
+            except (GLib.Error, OSError, ValueError):
+                continue
+            if value is None:
+                continue
+            capture = armed.sample(t, value)
+            if capture is not None:
+                print("Captured {} {} around {:.1f}s".format(
+                    capture.sensor.name, capture.reason, capture.trigger_time))
+                self.app.history.captures.append(capture)
+        return GLib.SOURCE_CONTINUE
+
+    def stop(self):
+        self.armed = []
+        self.update_timer()
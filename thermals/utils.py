@@ -1,55 +1,97 @@
 import sys
 import os
 import re
-from gi.repository import Gio
-from enum import Enum
-from time import monotonic_ns
+from gi.repository import Gio, GLib
+from time import monotonic_ns, clock_gettime_ns, CLOCK_BOOTTIME
 from collections.abc import Iterator
 
 
-class Unit(Enum):
-    CELCIUS = 0
-    RPM = 1
-    PWM = 2
-    WATT = 3
+class UnitRegistry(type):
+    """Lets `Unit` be used like an Enum that sources can extend:
+    `Unit.CELCIUS`, `Unit(0)`, `Unit["CELCIUS"]` and `list(Unit)`."""
+    def __iter__(cls):
+        return iter(cls._by_value.values())
+
+    def __len__(cls):
+        return len(cls._by_value)
+
+    def __getitem__(cls, name):
+        return cls._by_name[name]
+
+    def __call__(cls, value):
+        if isinstance(value, cls):
+            return value
+        try:
+            return cls._by_value[value]
+        except KeyError:
+            raise ValueError("{!r} is not a valid Unit".format(value)) from None
+
+class Unit(metaclass=UnitRegistry):
+    """Unit of a sensor's values. Sources add their own with `Unit.register`."""
+    _by_value = {}
+    _by_name = {}
+
+    def __init__(self, value, name, symbol, title, plot_lines, digits):
+        self.value = value
+        self.name = name
+        self.symbol = symbol
+        self._title = title
+        self._plot_lines = plot_lines
+        # Digits to round to, or a function of the value returning them
+        self.digits = digits
+
+    def register(name, symbol, title, plot_lines=10, digits=0, cls=None):
+        """Add a unit, available as `Unit.<name>` from then on"""
+        if cls is None:
+            cls = Unit
+        if name in Unit._by_name:
+            return Unit._by_name[name]
+        unit = cls.__new__(cls)
+        unit.__init__(len(Unit._by_value), name, symbol, title, plot_lines, digits)
+        Unit._by_value[unit.value] = unit
+        Unit._by_name[name] = unit
+        setattr(Unit, name, unit)
+        return unit
+
+    def __repr__(self):
+        return "<Unit.{}: {}>".format(self.name, self.value)
 
     def __str__(self):
-        match self:
-            case Unit.CELCIUS: return "°C"
-            case Unit.RPM: return "RPM"
-            case Unit.PWM: return ""
-            case Unit.WATT: return "W"
+        return self.symbol
 
     def title(self) -> str:
-        match self:
-            case Unit.CELCIUS: return "Celcius"
-            case Unit.RPM: return "RPM"
-            case Unit.PWM: return "PWM"
-            case Unit.WATT: return "Watt"
+        return self._title
 
     def plot_lines(self) -> int:
-        match self:
-            case Unit.RPM: return 250
-            case Unit.CELCIUS: return 10
-            case Unit.PWM: return 10
-            case Unit.WATT: return 10
-    
+        return self._plot_lines
+
     def round(self, value):
-        match self:
-            case Unit.RPM: return round(value)
-            case Unit.CELCIUS: return round(value, 1)
-            case Unit.PWM: return round(value)
-            case Unit.WATT:
-                if value < 100: return round(value, 1)
-                else: return round(value)
+        digits = self.digits(value) if callable(self.digits) else self.digits
+        return round(value, digits) if digits else round(value)
 
     def format_value(self, value):
-        if self == Unit.PWM:
-            return "{}%".format(round(value/2.55))
-        elif self == Unit.CELCIUS:
-            return "{}{}".format(self.round(value), self)
-        else:
-            return "{} {}".format(self.round(value), self)
+        return "{} {}".format(self.round(value), self)
+
+class Celcius(Unit):
+    def format_value(self, value):
+        return "{}{}".format(self.round(value), self)
+
+class Percentage(Unit):
+    def format_value(self, value):
+        return "{}%".format(self.round(value))
+
+class DutyCycle(Unit):
+    def format_value(self, value):
+        return "{}%".format(round(value/2.55))
+
+# Registration order defines the values, which are stored in configs and
+# rings. Append only.
+Unit.register("CELCIUS", "°C", "Celcius", plot_lines=10, digits=1, cls=Celcius)
+Unit.register("RPM", "RPM", "RPM", plot_lines=250)
+Unit.register("PWM", "", "PWM", plot_lines=10, cls=DutyCycle)
+Unit.register("WATT", "W", "Watt", plot_lines=10, digits=lambda value: 1 if value < 100 else 0)
+Unit.register("MHZ", "MHz", "MHz", plot_lines=500)
+Unit.register("PERCENT", "%", "Percent", plot_lines=10, digits=1, cls=Percentage)
 
 def readlineStrip(path: str) -> str:
     with open(path, 'r') as fd:
@@ -67,6 +109,22 @@ def readGio(path, func = lambda x: x, decode = 'utf-8'):
         return func(contents.strip())
     return inner
 
+def readGioAsync(path, callback, func = lambda x: x, decode = 'utf-8', on_error = None):
+    """Read `path` in the background and call `callback` with the result
+    on the main loop. If the file can't be read only `on_error` is called,
+    if given."""
+    def done(file, result):
+        try:
+            status, contents, etag_out = file.load_contents_finish(result)
+        except GLib.Error:
+            if on_error is not None:
+                on_error()
+            return
+        if decode:
+            contents = contents.decode(decode)
+        callback(func(contents.strip()))
+    Gio.File.new_for_path(path).load_contents_async(None, done)
+
 def time_it(explain):
     def wrap(f):
         def inner(*args, **kw):
@@ -82,6 +140,46 @@ def time_it(explain):
             return f
     return wrap
 
+def process_start_ns() -> int:
+    """Process start time on the `monotonic_ns` clock (best effort)"""
+    try:
+        with open("/proc/self/stat") as fd:
+            # Field 22 is the start time in clock ticks since boot. The
+            # command name (field 2) may contain spaces, so split after it.
+            ticks = int(fd.read().rsplit(')', 1)[1].split()[19])
+        since_start = clock_gettime_ns(CLOCK_BOOTTIME) - ticks * 1000000000 // os.sysconf('SC_CLK_TCK')
+        return monotonic_ns() - since_start
+    except (OSError, ValueError, IndexError):
+        return monotonic_ns()
+
+class StartupProfile:
+    """Records named phases of startup, enabled by `--startup-profile`"""
+    def __init__(self, budget_ms):
+        self.enabled = "--startup-profile" in sys.argv
+        self.budget_ms = budget_ms
+        self.phases = []
+        self.last = process_start_ns()
+        self.start = self.last
+
+    def mark(self, phase):
+        """Close the phase `phase` that ran since the previous mark"""
+        if not self.enabled:
+            return
+        now = monotonic_ns()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def report(self):
+        if not self.enabled or not self.phases:
+            return
+        total = (self.last - self.start) / 1000000
+        print("Startup profile:")
+        for (phase, ns) in self.phases:
+            print("  {:<24} {:8.2f}ms".format(phase, ns / 1000000))
+        print("  {:<24} {:8.2f}ms (budget {}ms{})".format(
+            "total", total, self.budget_ms, ", EXCEEDED" if total > self.budget_ms else ""))
+        self.phases = []
+
 def empty(gen: Iterator) -> bool:
     try:
         next(gen)
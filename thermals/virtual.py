@@ -0,0 +1,237 @@
+"""Virtual sensors computed from other sensors.
+
+Defined in `thermals.ini`, one section per sensor:
+
+    [virtual:cpu_max]
+    expr = max({coretemp.0:temp*})
+    unit = celcius
+    label = Hottest core
+
+    [virtual:gpu_delta]
+    expr = {0000:03:00.0:temp1} - {nct6775.656:temp2}
+    unit = celcius
+
+References are `{device id:measurement}` (or `{virtual:name}`); globs in the
+measurement expand to all matching sensors and may only be used as
+arguments of `min`, `max`, `sum` and `avg`. Other functions are `abs` and
+`ddt(x)`, the change of `x` per second.
+
+Expressions are compiled once into nested closures and evaluated in
+dependency order on every refresh; references between virtual sensors that
+form a cycle are rejected.
+"""
+import ast
+import operator
+import re
+from fnmatch import fnmatchcase
+from time import monotonic_ns
+
+from thermals.sensor import Sensor
+from thermals.source import Device
+from thermals.utils import Unit
+
+SECTION_PREFIX = "virtual:"
+REFERENCE = re.compile(r"\{([^{}]+)\}")
+
+BINARY = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.Pow: operator.pow,
+}
+
+AGGREGATES = {
+    'min': min,
+    'max': max,
+    'sum': sum,
+    'avg': lambda values: sum(values) / len(values),
+}
+
+class ExpressionError(ValueError):
+    pass
+
+def compile_expression(expr, resolve):
+    """Compile `expr` into a function of no arguments.
+
+    `resolve(reference)` returns the list of sensors a `{reference}` stands
+    for. Returns (function, set of referenced sensors)."""
+    refs = []
+    def replace(match):
+        refs.append(resolve(match.group(1)))
+        return "_r{}".format(len(refs) - 1)
+    try:
+        tree = ast.parse(REFERENCE.sub(replace, expr), mode='eval')
+    except SyntaxError as e:
+        raise ExpressionError("Invalid expression {!r}: {}".format(expr, e))
+
+    def value(sensor):
+        return sensor.value
+
+    def build(node, many=False):
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+            constant = node.value
+            return lambda: constant
+        if isinstance(node, ast.Name) and node.id.startswith("_r"):
+            sensors = refs[int(node.id[2:])]
+            if many:
+                return lambda: [value(s) for s in sensors]
+            if len(sensors) != 1:
+                raise ExpressionError("{!r} needs exactly one sensor in {!r}".format(node.id, expr))
+            sensor = sensors[0]
+            return lambda: sensor.value
+        if isinstance(node, ast.BinOp) and type(node.op) in BINARY:
+            op = BINARY[type(node.op)]
+            left, right = build(node.left), build(node.right)
+            def binop():
+                a, b = left(), right()
+                if a is None or b is None:
+                    return None
+                try:
+                    # As floats, so large powers overflow rather than
+                    # growing into huge integers
+                    result = op(float(a), float(b))
+                except (ZeroDivisionError, OverflowError):
+                    return None
+                # A negative base with a fractional exponent is complex
+                return result if isinstance(result, float) else None
+            return binop
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+            operand = build(node.operand)
+            def neg():
+                a = operand()
+                return None if a is None else -a
+            return neg
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and not node.keywords:
+            name = node.func.id
+            if name in AGGREGATES:
+                agg = AGGREGATES[name]
+                args = [build(arg, many=True) for arg in node.args]
+                def aggregate():
+                    values = []
+                    for arg in args:
+                        v = arg()
+                        if isinstance(v, list):
+                            values.extend(x for x in v if x is not None)
+                        elif v is not None:
+                            values.append(v)
+                    return agg(values) if values else None
+                return aggregate
+            if name == 'abs' and len(node.args) == 1:
+                arg = build(node.args[0])
+                def absolute():
+                    a = arg()
+                    return None if a is None else abs(a)
+                return absolute
+            if name == 'ddt' and len(node.args) == 1:
+                arg = build(node.args[0])
+                state = [None, None]
+                def ddt():
+                    a, now = arg(), monotonic_ns()
+                    previous, t = state
+                    state[0], state[1] = a, now
+                    if a is None or previous is None or now == t:
+                        return None
+                    return (a - previous) / ((now - t) / 1000000000)
+                return ddt
+        raise ExpressionError("Unsupported {} in {!r}".format(ast.dump(node), expr))
+
+    func = build(tree.body)
+    return func, {s for sensors in refs for s in sensors}
+
+class VirtualSensor(Sensor):
+    # Expressions may use `ddt`, which depends on the previous evaluation
+    sampleable = False
+
+    def __init__(self, device, measurement, config):
+        self.device = device
+        self.measurement = measurement
+        self.expr = config['expr']
+        self.evaluate = None
+        self.depends = set()
+        super().__init__(config.get('label', measurement), config)
+        self.unit = Unit[config.get('unit', 'celcius').upper()].value
+
+    def compile(self, resolve):
+        self.evaluate, self.depends = compile_expression(self.expr, resolve)
+
+    def get_value(self):
+        return self.evaluate()
+
+    def format_value(self):
+        if self.value is None:
+            return ""
+        return Unit(self.unit).format_value(self.value)
+
+    def has_configuration(self):
+        return False
+
+class VirtualDevice(Device):
+    """Sensors computed from other sensors. Has no source, `Hwmon.refresh`
+    evaluates them after all sources were read."""
+    id = "virtual"
+    name = "Virtual"
+    hwmonInstance = "virtual"
+
+    def load(self, hwmon):
+        """(Re)create the virtual sensors defined in the config, resolving
+        references against the sensors of `hwmon`"""
+        sensors = {}
+        for section in self.app.config.sections():
+            if section.startswith(SECTION_PREFIX):
+                name = section[len(SECTION_PREFIX):]
+                try:
+                    sensors[name] = VirtualSensor(self, name, self.app.config[section])
+                except (KeyError, ValueError) as e:
+                    print("Ignoring virtual sensor {}: {}".format(name, e))
+
+        def resolve(reference):
+            device_id, _, pattern = reference.rpartition(':')
+            if device_id == VirtualDevice.id:
+                found = [s for (n, s) in sensors.items() if fnmatchcase(n, pattern)]
+            else:
+                found = [s for s in hwmon.get_sensors()
+                         if s.device.id == device_id and fnmatchcase(s.measurement, pattern)]
+            if not found:
+                raise ExpressionError("No sensor matches {{{}}}".format(reference))
+            return found
+
+        for (name, sensor) in list(sensors.items()):
+            try:
+                sensor.compile(resolve)
+            except ExpressionError as e:
+                print("Ignoring virtual sensor {}: {}".format(name, e))
+                del sensors[name]
+
+        ordered = dependency_order(sensors.values())
+        self.store.splice(0, self.store.get_n_items(), ordered)
+
+def dependency_order(sensors):
+    """Virtual `sensors` ordered so dependencies come first. Sensors in or
+    depending on a cycle, or on a virtual sensor not in `sensors`, are
+    dropped."""
+    sensors = list(sensors)
+    virtual = set(sensors)
+    ordered, done, visiting, broken = [], set(), set(), set()
+
+    def visit(sensor):
+        if sensor in done:
+            return sensor not in broken
+        if sensor in visiting:
+            print("Ignoring virtual sensor {}: cyclic reference".format(sensor.measurement))
+            broken.add(sensor)
+            return False
+        visiting.add(sensor)
+        ok = all([visit(dep) if dep in virtual else not isinstance(dep, VirtualSensor)
+                  for dep in sensor.depends])
+        visiting.discard(sensor)
+        done.add(sensor)
+        if ok and sensor not in broken:
+            ordered.append(sensor)
+            return True
+        broken.add(sensor)
+        return False
+
+    for sensor in sensors:
+        visit(sensor)
+    return ordered